@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+micro benchmark for the bme280 module:
+ - i2c transactions per reading, legacy (calibration read every call) vs cached device
+ - compensation throughput, per sample vs. compensateBatch()
+
+usage: bench_bme280.py [--offline] [-n samples]
+  --offline uses a register image instead of the real sensor
+"""
+
+import time
+import struct
+import random
+import argparse
+
+import bme280
+
+
+class CountingBus():
+    """wraps a smbus2 compatible bus and counts transactions"""
+    def __init__(self, i2cbus):
+        self.i2cbus = i2cbus
+        self.transactions = 0
+        self.bytes = 0
+
+    def read_i2c_block_data(self, addr, register, length):
+        self.transactions += 1
+        self.bytes += length
+        return self.i2cbus.read_i2c_block_data(addr, register, length)
+
+    def write_byte_data(self, addr, register, value):
+        self.transactions += 1
+        self.bytes += 1
+        return self.i2cbus.write_byte_data(addr, register, value)
+
+    def write_i2c_block_data(self, addr, register, data):
+        self.transactions += 1
+        self.bytes += len(data) + 1
+        return self.i2cbus.write_i2c_block_data(addr, register, data)
+
+
+class RegisterImageBus():
+    """answers block reads from a static bme280 register image"""
+    def __init__(self, registers):
+        self.registers = registers
+
+    def read_i2c_block_data(self, addr, register, length):
+        return [self.registers.get(register + i, 0) for i in range(length)]
+
+    def write_byte_data(self, addr, register, value):
+        self.registers[register] = value
+
+    def write_i2c_block_data(self, addr, register, data):
+        pass
+
+
+def offlineregisters(temp_raw=519888, pres_raw=415148, hum_raw=30000):
+    '''register image with typical data sheet calibration values'''
+    cal1 = struct.pack('<HhhHhhhhhhhh', 27504, 26435, -1000,
+                       36477, -10685, 3024, 2855, 140, -7, 15500, -14600, 6000)
+    h4, h5 = 313, 50
+    cal3 = struct.pack('<hBbBbb', 362, 0, h4 >> 4, (h4 & 0x0F) | ((h5 & 0x0F) << 4), h5 >> 4, 30)
+    registers = {}
+    registers.update({0x88 + i: b for i, b in enumerate(cal1)})
+    registers[0xA1] = 75
+    registers.update({0xE1 + i: b for i, b in enumerate(cal3)})
+    registers.update({bme280.REG_DATA + i: b for i, b in enumerate(rawframe(temp_raw, pres_raw, hum_raw))})
+    return registers
+
+
+def rawframe(temp_raw, pres_raw, hum_raw):
+    return bytes([(pres_raw >> 12) & 0xFF, (pres_raw >> 4) & 0xFF, (pres_raw << 4) & 0xF0,
+                  (temp_raw >> 12) & 0xFF, (temp_raw >> 4) & 0xFF, (temp_raw << 4) & 0xF0,
+                  (hum_raw >> 8) & 0xFF, hum_raw & 0xFF])
+
+
+def benchtransactions(i2cbus, addr, reads):
+    '''i2c transactions per reading'''
+    counting = CountingBus(i2cbus)
+    for _ in range(reads):
+        #a fresh device per call is what readBME280All() did before
+        bme280.BME280(addr, counting).read()
+    legacy = counting.transactions / reads, counting.bytes / reads
+
+    counting = CountingBus(i2cbus)
+    device = bme280.BME280(addr, counting)
+    for _ in range(reads):
+        device.read()
+    cached = counting.transactions / reads, counting.bytes / reads
+    return legacy, cached
+
+
+def benchcompensation(cal1, cal2, cal3, frames):
+    '''samples per second for the different compensation paths'''
+    results = {}
+
+    start = time.perf_counter()
+    for frame in frames:
+        bme280.compensate(bme280.decodeCalibration(cal1, cal2, cal3), frame)
+    results['legacy (decode + compensate per call)'] = len(frames) / (time.perf_counter() - start)
+
+    cal = bme280.decodeCalibration(cal1, cal2, cal3)
+    start = time.perf_counter()
+    for frame in frames:
+        bme280.compensate(cal, frame)
+    results['cached calibration, per sample'] = len(frames) / (time.perf_counter() - start)
+
+    buffer = b''.join(frames)
+    start = time.perf_counter()
+    bme280.compensateBatch(cal, buffer, use_numpy=False)
+    results['compensateBatch, python'] = len(frames) / (time.perf_counter() - start)
+
+    if bme280.loadNumpy() is not None:
+        start = time.perf_counter()
+        bme280.compensateBatch(cal, buffer)
+        results['compensateBatch, numpy'] = len(frames) / (time.perf_counter() - start)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='micro benchmark for the bme280 module')
+    parser.add_argument('--offline', action='store_true', help='use a register image instead of the real sensor')
+    parser.add_argument('-n', dest='samples', type=int, default=10000, help='samples for the compensation benchmark (default 10000)')
+    args = parser.parse_args()
+    samples = args.samples
+
+    i2cbus = RegisterImageBus(offlineregisters()) if args.offline else bme280.bus
+    addr = bme280.DEVICE
+
+    (legacy_t, legacy_b), (cached_t, cached_b) = benchtransactions(i2cbus, addr, 20)
+    print("I2C per reading, legacy : {:.1f} transactions, {:.0f} bytes".format(legacy_t, legacy_b))
+    print("I2C per reading, cached : {:.1f} transactions, {:.0f} bytes".format(cached_t, cached_b))
+
+    cal1 = i2cbus.read_i2c_block_data(addr, 0x88, 24)
+    cal2 = i2cbus.read_i2c_block_data(addr, 0xA1, 1)
+    cal3 = i2cbus.read_i2c_block_data(addr, 0xE1, 7)
+    base = bme280.BME280(addr, i2cbus).readRaw()
+    temp_raw = (base[3] << 12) | (base[4] << 4) | (base[5] >> 4)
+    pres_raw = (base[0] << 12) | (base[1] << 4) | (base[2] >> 4)
+    hum_raw = (base[6] << 8) | base[7]
+    rnd = random.Random(1)
+    frames = [rawframe(temp_raw + rnd.randint(-2000, 2000), pres_raw + rnd.randint(-2000, 2000),
+                       hum_raw + rnd.randint(-500, 500)) for _ in range(samples)]
+
+    for name, rate in benchcompensation(cal1, cal2, cal3, frames).items():
+        print("{:40s}: {:10.0f} samples/s".format(name, rate))
+
+
+if __name__ == "__main__":
+    main()
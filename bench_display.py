@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+benchmark of the oled refresh: bytes on the bus and time per refresh of the
+old showValues() (font loaded every call, cls + two full frames) versus
+hydro_display.Display (font cache, only changed page columns, nothing if the
+text is unchanged)
+
+usage: bench_display.py [--offline] [-n refreshes]
+  --offline sends to a null bus and the simulated display instead of the real one
+"""
+
+import time
+import argparse
+from PIL import ImageFont
+
+#our own modules
+import hydro_hal
+from bench_bme280 import CountingBus, RegisterImageBus
+from hydro_display import Display, FONTFILE
+from hydro_i2c import bus
+
+
+def loadfont(size):
+    '''parsed on every call like the old code did, pil's font without FreeSans (off the pi)'''
+    try:
+        return ImageFont.truetype(FONTFILE, size)
+    except OSError:
+        return ImageFont.load_default()
+
+
+def legacyshowvalues(oled, temp, humidity, info):
+    '''showValues() as it was before hydro_display'''
+    oled.cls()
+    oled.display()
+    draw = oled.canvas
+    font = loadfont(18)
+    draw.text((5, 1), "Temp: {:.1f}°C".format(temp), font=font, fill=1)
+    draw.text((5, 25), "Hum:  {:.0f} %".format(humidity), font=font, fill=1)
+    font = loadfont(14)
+    draw.text((5, 50), info, font=font, fill=1)
+    oled.display()
+
+
+def screens(count):
+    '''typical sequence: countdown changes every refresh, temp and humidity now and then'''
+    for i in range(count):
+        seconds = 3600 - i * 10
+        countdown = "%02d:%02d:%02d" % (seconds // 3600, (seconds // 60) % 60, seconds % 60)
+        yield 21.0 + (i // 30) * 0.1, 55.0 + (i // 60), "AN in " + countdown
+
+
+def benchlegacy(i2cbus, count):
+    counting = CountingBus(i2cbus)
+    oled = hydro_hal.getoled(counting)
+    counting.transactions = counting.bytes = 0
+    start = time.perf_counter()
+    for temp, hum, info in screens(count):
+        legacyshowvalues(oled, temp, hum, info)
+    return counting.bytes / count, (time.perf_counter() - start) / count
+
+
+def benchdisplay(i2cbus, count, repeat=1):
+    counting = CountingBus(i2cbus)
+    display = Display(hydro_hal.getoled(counting))
+    counting.transactions = counting.bytes = 0
+    start = time.perf_counter()
+    for temp, hum, info in screens(count):
+        for _ in range(repeat):
+            display.showvalues(temp, hum, info)
+            #render synchronously, like the worker thread would
+            if display.screen != display.renderedscreen:
+                display.render(display.screen)
+                display.renderedscreen = display.screen
+    return counting.bytes / (count * repeat), (time.perf_counter() - start) / (count * repeat)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark of the oled refresh')
+    parser.add_argument('--offline', action='store_true', help='send to a null bus and the simulated display, no pi needed')
+    parser.add_argument('-n', dest='count', type=int, default=100, help='refreshes (default 100)')
+    args = parser.parse_args()
+    count = args.count
+    if args.offline:
+        hydro_hal.select(hydro_hal.BACKEND_SIM) #lib_oled96 only exists on the pi
+    i2cbus = RegisterImageBus({}) if args.offline else bus
+
+    results = [
+        ("legacy showValues", benchlegacy(i2cbus, count)),
+        ("Display, text changes", benchdisplay(i2cbus, count)),
+        ("Display, 2 calls per change", benchdisplay(i2cbus, count, repeat=2)),
+    ]
+    for name, (nbytes, seconds) in results:
+        print("{:30s}: {:7.0f} bytes/refresh {:8.2f} ms/refresh".format(name, nbytes, seconds * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,332 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+benchmark suite of the controller hot paths, on the simulated devices of
+hydro_sim and the virtual clock of hydro_replay, so it runs on any box.
+Per benchmark: latency percentiles, cpu time and allocations (tracemalloc)
+per call. Results can be saved as json baseline and compared against one,
+a regression makes the exit code 1.
+
+usage: bench_suite.py [-n calls] [-k name] [--save file] [--compare file] [--threshold t]
+  -k           only benchmarks whose name contains this
+  --save       write the results as baseline, e.g. bench_baseline.json
+  --compare    compare with a baseline, p50, cpu time or allocations
+               growing more than threshold (default 0.25 = 25%) are regressions
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+
+#our own modules
+import hydro_hal
+hydro_hal.select('sim') #before the device modules are imported
+from hydro_logger import my_logger, listener
+from hydro_replay import VirtualClock, Replay
+from hydro_gpio import GpioInterface
+from hydro_i2c import bus as i2cbus
+from hydro_scheduler import Scheduler
+from hydro_spool import Spool, StoreAndForward
+from hydro_history import HistoryStore
+from hydro_display import Display
+from hydro_zones import defaultzones
+from hydro_sim import SimMqttClient, rawframe
+from hydro_filters import airfilter
+from hydro_analytics import PeriodStats, CHUNK
+import hydroponic_controller as controller
+import hydro_config
+import bme280
+import bh1750
+
+__all__ = ['measure', 'runsuite', 'compare']
+
+#metrics compared against the baseline
+COMPARED = ('p50', 'cpu', 'allocbytes')
+
+
+def percentile(ordered, fraction):
+    '''nearest rank percentile of a sorted list'''
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def measure(func, calls, prepare=None, warmup=10):
+    '''latency (us) percentiles and cpu time per call, then a shorter pass
+    under tracemalloc for the allocations. prepare() runs untimed before each call'''
+    for _ in range(warmup):
+        if prepare is not None:
+            prepare()
+        func()
+
+    latencies = []
+    cpu = 0.0
+    for _ in range(calls):
+        if prepare is not None:
+            prepare()
+        cpustart = time.process_time()
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+        cpu += time.process_time() - cpustart
+    latencies.sort()
+
+    #tracemalloc slows everything down a lot, so it gets its own pass
+    tracecalls = min(calls, 200)
+    allocated = 0
+    peak = 0
+    tracemalloc.start()
+    try:
+        for _ in range(tracecalls):
+            if prepare is not None:
+                prepare()
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            func()
+            current, callpeak = tracemalloc.get_traced_memory()
+            allocated += max(0, callpeak - before)
+            peak = max(peak, callpeak - before)
+    finally:
+        tracemalloc.stop()
+
+    return {"calls": calls,
+            "p50": percentile(latencies, 0.5) * 1e6,
+            "p90": percentile(latencies, 0.9) * 1e6,
+            "p99": percentile(latencies, 0.99) * 1e6,
+            "max": latencies[-1] * 1e6,
+            "mean": sum(latencies) / calls * 1e6,
+            "cpu": cpu / calls * 1e6,
+            "allocbytes": allocated / tracecalls,
+            "peakbytes": peak}
+
+
+class Context():
+    """what the benchmarks share: the virtual clock and a scratch directory"""
+    def __init__(self, clock, tmpdir):
+        self.clock = clock
+        self.tmpdir = tmpdir
+        self.sim = hydro_hal.simulation()
+
+
+def benchreadbme280all(ctx):
+    '''one bme280 reading over the (simulated) bus, normal mode like the sampler uses'''
+    bme280.getDevice().setNormalMode()
+    return None, bme280.readBME280All
+
+
+def benchcompensate(ctx):
+    cal = bme280.getDevice().loadCalibration()
+    frame = rawframe(519888, 415148, 30000)
+    return None, lambda: bme280.compensate(cal, frame)
+
+
+def benchconverttonumber(ctx):
+    data = [0x12, 0x34]
+    return None, lambda: bh1750.convertToNumber(data)
+
+
+def benchbh1750read(ctx):
+    sensor = bh1750.BH1750()
+    sensor.start()
+    return None, sensor.read
+
+
+def benchshowvalues(ctx):
+    '''display refresh with a changed countdown, render and i2c transfer included'''
+    display = Display(hydro_hal.getoled(i2cbus))
+    state = {"seconds": 3600}
+    def refresh():
+        seconds = state["seconds"] = (state["seconds"] - 10) % 3600
+        countdown = "%02d:%02d:%02d" % (seconds // 3600, (seconds // 60) % 60, seconds % 60)
+        display.showvalues(21.5, 55.0, "AN in " + countdown)
+        display.runpending()
+    return None, refresh
+
+
+def benchpublishreadings(ctx):
+    '''the 10 s publish tick: telemetry rules, store and forward, mqtt client'''
+    zone = defaultzones()[0]
+    gpio = GpioInterface()
+    scheduler = Scheduler(None)
+    scheduler.add('pump', 300, 10800, gpio.setwaterpump)
+    history = HistoryStore(':memory:')
+    sampler = controller.initsampler(history, [zone])
+    forwarder = StoreAndForward(SimMqttClient(), Spool(os.path.join(ctx.tmpdir, 'spool')))
+    telemetry = controller.inittelemetry(forwarder, zone)
+    readings = {}
+    def prepare():
+        ctx.clock.advance(10)
+        sampler.runpending()
+    return prepare, lambda: controller.publishreadings(zone, telemetry, gpio, sampler, scheduler, history, readings)
+
+
+def benchairfilter(ctx):
+    '''one bme280 sample through the filter chains, dew point and vpd'''
+    pipeline = airfilter(hydro_config.get().filters)
+    state = {"timestamp": time.time()}
+    def process():
+        state["timestamp"] += 1.0
+        pipeline.process(state["timestamp"], (21.5, 1013.2, 55.0))
+    return None, process
+
+
+def benchpumpswitch(ctx):
+    '''what operatewatertimer() did: switch the pump and save the schedule state'''
+    gpio = GpioInterface()
+    scheduler = Scheduler(os.path.join(ctx.tmpdir, 'schedule.json'))
+    scheduler.add('pump', 300, 10800, gpio.setwaterpump)
+    return lambda: ctx.clock.advance(scheduler.remaining('pump')), scheduler.runpending
+
+
+def benchlogline(ctx):
+    '''a debug line, what the caller pays: level check and the queue'''
+    return None, lambda: my_logger.debug("Water %s", "on")
+
+
+def benchhistoryflush(ctx):
+    '''one minute of samples into sqlite'''
+    history = HistoryStore(os.path.join(ctx.tmpdir, 'history.db'))
+    def prepare():
+        for _ in range(60):
+            ctx.clock.advance(1)
+            now = time.time()
+            for name, value in (('air.temp', 21.5), ('air.press', 1013.2), ('air.hum', 55.0), ('light.lux', 300.0)):
+                history.record(name, now, value)
+    return prepare, history.flush
+
+
+def benchreplaystep(ctx):
+    '''one step of the whole controller loop, clock advanced to the next due task'''
+    replay = Replay(ctx.clock)
+    state = {"wait": 0.0}
+    def step():
+        state["wait"] = replay.step()
+    return lambda: ctx.clock.advance(state["wait"]), step
+
+
+def benchanalyticschunk(ctx):
+    '''one chunk of 1 s humidity samples into the daily report statistics'''
+    import numpy as np
+    stats = PeriodStats(86400, 40.0, 80.0)
+    state = {"start": time.time()}
+    values = 60.0 + 25.0 * np.sin(np.arange(CHUNK) / 3600.0)
+    def add():
+        ts = state["start"] + np.arange(CHUNK, dtype=float)
+        state["start"] += CHUNK
+        stats.add(ts, values)
+    return None, add
+
+
+BENCHMARKS = [
+    ('bme280.readBME280All', benchreadbme280all),
+    ('bme280.compensate', benchcompensate),
+    ('bh1750.convertToNumber', benchconverttonumber),
+    ('bh1750.read', benchbh1750read),
+    ('display.showvalues', benchshowvalues),
+    ('mqtt.publishreadings', benchpublishreadings),
+    ('filters.air', benchairfilter),
+    ('pump.switch', benchpumpswitch),
+    ('log.debugline', benchlogline),
+    ('history.flush', benchhistoryflush),
+    ('controller.step', benchreplaystep),
+    ('analytics.chunk', benchanalyticschunk),
+]
+
+
+def runsuite(calls=1000, select=None):
+    '''run the benchmarks (names containing select), returns {name: result}'''
+    results = {}
+    #log lines are formatted and written like in the field, just not to the console
+    saved = listener.handlers
+    devnull = open(os.devnull, 'w')
+    listener.handlers = (logging.StreamHandler(devnull),)
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir, VirtualClock(1767225600.0) as clock:
+            ctx = Context(clock, tmpdir)
+            ctx.sim.origin = clock.time()
+            for name, setup in BENCHMARKS:
+                if select is not None and select not in name:
+                    continue
+                prepare, func = setup(ctx)
+                #slow benchmarks get fewer calls
+                results[name] = measure(func, calls // 10 if name in ('history.flush', 'pump.switch') else calls, prepare)
+    finally:
+        listener.handlers = saved
+        devnull.close()
+    return results
+
+
+def environment():
+    '''where the numbers come from'''
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        commit = None
+    return {"python": platform.python_version(), "machine": platform.machine(),
+            "platform": platform.platform(), "commit": commit, "time": time.time()}
+
+
+def compare(results, baseline, threshold=0.25):
+    '''lines describing the changes, and the names of the regressed benchmarks'''
+    lines = []
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            lines.append("{:26s} new".format(name))
+            continue
+        changes = []
+        regressed = False
+        for metric in COMPARED:
+            if not old.get(metric):
+                continue
+            change = result[metric] / old[metric] - 1.0
+            #allocations of a few bytes jitter, don't count them
+            if change > threshold and not (metric == 'allocbytes' and result[metric] - old[metric] < 64):
+                regressed = True
+            changes.append("{} {:+.0%}".format(metric, change))
+        if regressed:
+            regressions.append(name)
+        lines.append("{:26s} {}{}".format(name, ", ".join(changes), "  REGRESSION" if regressed else ""))
+    return lines, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark suite of the controller hot paths')
+    parser.add_argument('-n', dest='calls', type=int, default=1000, help='calls per benchmark (default 1000)')
+    parser.add_argument('-k', dest='select', metavar='NAME', help='only benchmarks whose name contains this')
+    parser.add_argument('--save', metavar='FILE', help='write the results as baseline, e.g. bench_baseline.json')
+    parser.add_argument('--compare', metavar='FILE', help='compare with a baseline, p50, cpu time or allocations '
+                        'growing more than threshold are regressions')
+    parser.add_argument('--threshold', type=float, default=0.25, help='default 0.25 = 25%%')
+    args = parser.parse_args()
+
+    results = runsuite(args.calls, args.select)
+    print("{:26s} {:>9s} {:>9s} {:>9s} {:>9s} {:>9s} {:>10s}".format(
+        "benchmark", "p50 us", "p90 us", "p99 us", "max us", "cpu us", "alloc B"))
+    for name, r in results.items():
+        print("{:26s} {:9.1f} {:9.1f} {:9.1f} {:9.1f} {:9.1f} {:10.0f}".format(
+            name, r["p50"], r["p90"], r["p99"], r["max"], r["cpu"], r["allocbytes"]))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({"environment": environment(), "results": results}, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print("\ncompared with {} ({})".format(baseline["environment"].get("commit"), baseline["environment"].get("machine")))
+        lines, regressions = compare(results, baseline["results"], args.threshold)
+        print("\n".join(lines))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
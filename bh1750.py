@@ -43,8 +43,9 @@ ONE_TIME_HIGH_RES_MODE_2 = 0x21
 # Device is automatically set to Power Down after measurement.
 ONE_TIME_LOW_RES_MODE = 0x23
 
-#bus = smbus.SMBus(0) # Rev 1 Pi uses 0
-bus = smbus2.SMBus(1)  # Rev 2 Pi uses 1
+ONE_TIME_MODES = (ONE_TIME_HIGH_RES_MODE_1, ONE_TIME_HIGH_RES_MODE_2, ONE_TIME_LOW_RES_MODE)
+
+from hydro_i2c import bus # shared bus of all i2c devices
 
 def convertToNumber(data):
   # Simple function to convert 2 bytes of data
@@ -58,6 +59,51 @@ def readLight(addr=DEVICE):
   data = bus.read_i2c_block_data(addr,ONE_TIME_HIGH_RES_MODE_1,2)
   return convertToNumber(data)
 
+class BH1750(object):
+  """bh1750 in one of the CONTINUOUS_* modes, reads return the latest
+  result without waiting for a conversion. In the ONE_TIME_* modes the
+  chip sleeps between reads, a read starts a conversion and waits for it"""
+
+  def __init__(self, addr=DEVICE, i2cbus=None, mode=CONTINUOUS_HIGH_RES_MODE_1):
+    self.addr = addr
+    self.bus = i2cbus or bus
+    self.mode = mode
+    self.recorder = None  # hydro_trace.TraceRecorder for the raw results
+
+  def start(self):
+    # First result is available after one measurement time (max. 180ms)
+    self.bus.write_byte(self.addr, POWER_ON)
+    self.bus.write_byte(self.addr, self.mode)
+
+  def powerDown(self):
+    self.bus.write_byte(self.addr, POWER_DOWN)
+
+  def setMode(self, mode):
+    self.mode = mode
+    if mode in ONE_TIME_MODES:
+      self.powerDown()
+    else:
+      self.start()
+
+  def readRaw(self):
+    if self.mode in ONE_TIME_MODES:
+      # Max. measurement time 24ms in low, 180ms in high resolution
+      self.bus.write_byte(self.addr, self.mode)
+      time.sleep(0.024 if self.mode == ONE_TIME_LOW_RES_MODE else 0.18)
+    # Plain 2 byte read, sending a command would restart the measurement
+    msg = smbus2.i2c_msg.read(self.addr, 2)
+    self.bus.i2c_rdwr(msg)
+    return bytes(msg)
+
+  def read(self):
+    raw = self.readRaw()
+    if self.recorder is not None:
+      self.recorder.bh1750(self.addr, raw, self.mode)
+    lux = convertToNumber(raw)
+    if self.mode in (CONTINUOUS_HIGH_RES_MODE_2, ONE_TIME_HIGH_RES_MODE_2):
+      lux /= 2
+    return lux
+
 def main():
 
   while True:
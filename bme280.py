@@ -18,17 +18,32 @@
 # https://www.raspberrypi-spy.co.uk/
 #
 #--------------------------------------
-import smbus2
 import time
+from collections import namedtuple
 from ctypes import c_short
 from ctypes import c_byte
 from ctypes import c_ubyte
 
+np = None  # numpy, imported on first use by loadNumpy(), it is slow to load on a pi zero
+_numpyChecked = False
+
+def loadNumpy():
+  # numpy module or None if it is not installed, compensateBatch() falls
+  # back to plain python then
+  global np, _numpyChecked
+  if not _numpyChecked:
+    try:
+      import numpy
+      np = numpy
+    except ImportError:
+      np = None
+    _numpyChecked = True
+  return np
+
 DEVICE = 0x76 # Default device I2C address
 
 
-bus = smbus2.SMBus(1) # Rev 2 Pi, Pi 2 & Pi 3 uses bus 1
-                     # Rev 1 Pi uses bus 0
+from hydro_i2c import bus # shared bus of all i2c devices
 
 def getShort(data, index):
   # return two bytes from data as a signed 16-bit value
@@ -50,59 +65,61 @@ def getUChar(data,index):
   result =  data[index] & 0xFF
   return result
 
-def readBME280ID(addr=DEVICE):
-  # Chip ID Register Address
-  REG_ID     = 0xD0
-  (chip_id, chip_version) = bus.read_i2c_block_data(addr, REG_ID, 2)
-  return (chip_id, chip_version)
+# Register Addresses
+REG_ID = 0xD0
+REG_DATA = 0xF7
+REG_CONTROL = 0xF4
+REG_CONFIG  = 0xF5
+REG_CONTROL_HUM = 0xF2
+REG_HUM_MSB = 0xFD
+REG_HUM_LSB = 0xFE
 
-def readBME280All(addr=DEVICE):
-  # Register Addresses
-  REG_DATA = 0xF7
-  REG_CONTROL = 0xF4
-  REG_CONFIG  = 0xF5
+# Oversample setting - page 27
+OVERSAMPLE_TEMP = 2
+OVERSAMPLE_PRES = 2
+MODE = 1
 
-  REG_CONTROL_HUM = 0xF2
-  REG_HUM_MSB = 0xFD
-  REG_HUM_LSB = 0xFE
+# Power modes - page 26
+MODE_SLEEP = 0
+MODE_FORCED = 1
+MODE_NORMAL = 3
 
-  # Oversample setting - page 27
-  OVERSAMPLE_TEMP = 2
-  OVERSAMPLE_PRES = 2
-  MODE = 1
+# Standby time between measurements in normal mode - page 28
+STANDBY_0_5MS = 0
+STANDBY_62_5MS = 1
+STANDBY_125MS = 2
+STANDBY_250MS = 3
+STANDBY_500MS = 4
+STANDBY_1000MS = 5
+STANDBY_10MS = 6
+STANDBY_20MS = 7
 
-  # Oversample setting for humidity register - page 26
-  OVERSAMPLE_HUM = 2
-  bus.write_byte_data(addr, REG_CONTROL_HUM, OVERSAMPLE_HUM)
+# IIR filter coefficient - page 18
+FILTER_OFF = 0
+FILTER_2 = 1
+FILTER_4 = 2
+FILTER_8 = 3
+FILTER_16 = 4
 
-  control = OVERSAMPLE_TEMP<<5 | OVERSAMPLE_PRES<<2 | MODE
-  bus.write_byte_data(addr, REG_CONTROL, control)
+# Oversample setting for humidity register - page 26
+OVERSAMPLE_HUM = 2
 
-  # Read blocks of calibration data from EEPROM
-  # See Page 22 data sheet
-  cal1 = bus.read_i2c_block_data(addr, 0x88, 24)
-  cal2 = bus.read_i2c_block_data(addr, 0xA1, 1)
-  cal3 = bus.read_i2c_block_data(addr, 0xE1, 7)
-
-  # Convert byte data to word values
-  dig_T1 = getUShort(cal1, 0)
-  dig_T2 = getShort(cal1, 2)
-  dig_T3 = getShort(cal1, 4)
-
-  dig_P1 = getUShort(cal1, 6)
-  dig_P2 = getShort(cal1, 8)
-  dig_P3 = getShort(cal1, 10)
-  dig_P4 = getShort(cal1, 12)
-  dig_P5 = getShort(cal1, 14)
-  dig_P6 = getShort(cal1, 16)
-  dig_P7 = getShort(cal1, 18)
-  dig_P8 = getShort(cal1, 20)
-  dig_P9 = getShort(cal1, 22)
-
-  dig_H1 = getUChar(cal2, 0)
-  dig_H2 = getShort(cal3, 0)
-  dig_H3 = getUChar(cal3, 2)
+# Size of one raw data frame (press msb..hum lsb, 0xF7..0xFE)
+FRAME_SIZE = 8
+
+# Decoded calibration coefficients, see page 22 data sheet
+Calibration = namedtuple('Calibration', [
+  'T1', 'T2', 'T3',
+  'P1', 'P2', 'P3', 'P4', 'P5', 'P6', 'P7', 'P8', 'P9',
+  'H1', 'H2', 'H3', 'H4', 'H5', 'H6'])
+
+def readBME280ID(addr=DEVICE):
+  # Chip ID Register Address
+  (chip_id, chip_version) = bus.read_i2c_block_data(addr, REG_ID, 2)
+  return (chip_id, chip_version)
 
+def decodeCalibration(cal1, cal2, cal3):
+  # Convert the three EEPROM blocks (0x88, 0xA1, 0xE1) to word values
   dig_H4 = getChar(cal3, 3)
   dig_H4 = (dig_H4 << 24) >> 20
   dig_H4 = dig_H4 | (getChar(cal3, 4) & 0x0F)
@@ -111,44 +128,71 @@ def readBME280All(addr=DEVICE):
   dig_H5 = (dig_H5 << 24) >> 20
   dig_H5 = dig_H5 | (getUChar(cal3, 4) >> 4 & 0x0F)
 
-  dig_H6 = getChar(cal3, 6)
+  return Calibration(
+    T1=getUShort(cal1, 0),
+    T2=getShort(cal1, 2),
+    T3=getShort(cal1, 4),
+    P1=getUShort(cal1, 6),
+    P2=getShort(cal1, 8),
+    P3=getShort(cal1, 10),
+    P4=getShort(cal1, 12),
+    P5=getShort(cal1, 14),
+    P6=getShort(cal1, 16),
+    P7=getShort(cal1, 18),
+    P8=getShort(cal1, 20),
+    P9=getShort(cal1, 22),
+    H1=getUChar(cal2, 0),
+    H2=getShort(cal3, 0),
+    H3=getUChar(cal3, 2),
+    H4=dig_H4,
+    H5=dig_H5,
+    H6=getChar(cal3, 6))
 
-  # Wait in ms (Datasheet Appendix B: Measurement time and current calculation)
-  wait_time = 1.25 + (2.3 * OVERSAMPLE_TEMP) + ((2.3 * OVERSAMPLE_PRES) + 0.575) + ((2.3 * OVERSAMPLE_HUM)+0.575)
-  time.sleep(wait_time/1000)  # Wait the required time  
+def readCalibration(addr=DEVICE, i2cbus=None):
+  # Read blocks of calibration data from EEPROM
+  # See Page 22 data sheet
+  i2cbus = i2cbus or bus
+  if hasattr(i2cbus, 'readblocks'):
+    # one combined transaction
+    cal1, cal2, cal3 = i2cbus.readblocks(addr, [(0x88, 24), (0xA1, 1), (0xE1, 7)])
+  else:
+    cal1 = i2cbus.read_i2c_block_data(addr, 0x88, 24)
+    cal2 = i2cbus.read_i2c_block_data(addr, 0xA1, 1)
+    cal3 = i2cbus.read_i2c_block_data(addr, 0xE1, 7)
+  return decodeCalibration(cal1, cal2, cal3)
 
-  # Read temperature/pressure/humidity
-  data = bus.read_i2c_block_data(addr, REG_DATA, 8)
+def compensate(cal, data):
+  # Compensate one raw 8 byte data frame, returns (degC, hPa, %rH)
   pres_raw = (data[0] << 12) | (data[1] << 4) | (data[2] >> 4)
   temp_raw = (data[3] << 12) | (data[4] << 4) | (data[5] >> 4)
   hum_raw = (data[6] << 8) | data[7]
 
   #Refine temperature
-  var1 = ((((temp_raw>>3)-(dig_T1<<1)))*(dig_T2)) >> 11
-  var2 = (((((temp_raw>>4) - (dig_T1)) * ((temp_raw>>4) - (dig_T1))) >> 12) * (dig_T3)) >> 14
+  var1 = ((((temp_raw>>3)-(cal.T1<<1)))*(cal.T2)) >> 11
+  var2 = (((((temp_raw>>4) - (cal.T1)) * ((temp_raw>>4) - (cal.T1))) >> 12) * (cal.T3)) >> 14
   t_fine = var1+var2
   temperature = float(((t_fine * 5) + 128) >> 8);
 
   # Refine pressure and adjust for temperature
   var1 = t_fine / 2.0 - 64000.0
-  var2 = var1 * var1 * dig_P6 / 32768.0
-  var2 = var2 + var1 * dig_P5 * 2.0
-  var2 = var2 / 4.0 + dig_P4 * 65536.0
-  var1 = (dig_P3 * var1 * var1 / 524288.0 + dig_P2 * var1) / 524288.0
-  var1 = (1.0 + var1 / 32768.0) * dig_P1
+  var2 = var1 * var1 * cal.P6 / 32768.0
+  var2 = var2 + var1 * cal.P5 * 2.0
+  var2 = var2 / 4.0 + cal.P4 * 65536.0
+  var1 = (cal.P3 * var1 * var1 / 524288.0 + cal.P2 * var1) / 524288.0
+  var1 = (1.0 + var1 / 32768.0) * cal.P1
   if var1 == 0:
     pressure=0
   else:
     pressure = 1048576.0 - pres_raw
     pressure = ((pressure - var2 / 4096.0) * 6250.0) / var1
-    var1 = dig_P9 * pressure * pressure / 2147483648.0
-    var2 = pressure * dig_P8 / 32768.0
-    pressure = pressure + (var1 + var2 + dig_P7) / 16.0
+    var1 = cal.P9 * pressure * pressure / 2147483648.0
+    var2 = pressure * cal.P8 / 32768.0
+    pressure = pressure + (var1 + var2 + cal.P7) / 16.0
 
   # Refine humidity
   humidity = t_fine - 76800.0
-  humidity = (hum_raw - (dig_H4 * 64.0 + dig_H5 / 16384.0 * humidity)) * (dig_H2 / 65536.0 * (1.0 + dig_H6 / 67108864.0 * humidity * (1.0 + dig_H3 / 67108864.0 * humidity)))
-  humidity = humidity * (1.0 - dig_H1 * humidity / 524288.0)
+  humidity = (hum_raw - (cal.H4 * 64.0 + cal.H5 / 16384.0 * humidity)) * (cal.H2 / 65536.0 * (1.0 + cal.H6 / 67108864.0 * humidity * (1.0 + cal.H3 / 67108864.0 * humidity)))
+  humidity = humidity * (1.0 - cal.H1 * humidity / 524288.0)
   if humidity > 100:
     humidity = 100
   elif humidity < 0:
@@ -156,6 +200,146 @@ def readBME280All(addr=DEVICE):
 
   return temperature/100.0,pressure/100.0,humidity
 
+def _compensateBatchNumpy(cal, frames):
+  # Same math as compensate(), over an (n, 8) uint8 array
+  data = np.asarray(frames, dtype=np.uint8).reshape(-1, FRAME_SIZE).astype(np.int64)
+  pres_raw = (data[:, 0] << 12) | (data[:, 1] << 4) | (data[:, 2] >> 4)
+  temp_raw = (data[:, 3] << 12) | (data[:, 4] << 4) | (data[:, 5] >> 4)
+  hum_raw = (data[:, 6] << 8) | data[:, 7]
+
+  var1 = (((temp_raw>>3)-(cal.T1<<1))*cal.T2) >> 11
+  var2 = (((((temp_raw>>4) - cal.T1) * ((temp_raw>>4) - cal.T1)) >> 12) * cal.T3) >> 14
+  t_fine = var1+var2
+  temperature = (((t_fine * 5) + 128) >> 8) / 100.0
+
+  var1 = t_fine / 2.0 - 64000.0
+  var2 = var1 * var1 * cal.P6 / 32768.0
+  var2 = var2 + var1 * cal.P5 * 2.0
+  var2 = var2 / 4.0 + cal.P4 * 65536.0
+  var1 = (cal.P3 * var1 * var1 / 524288.0 + cal.P2 * var1) / 524288.0
+  var1 = (1.0 + var1 / 32768.0) * cal.P1
+  valid = var1 != 0
+  safe_var1 = np.where(valid, var1, 1.0)
+  pressure = 1048576.0 - pres_raw
+  pressure = ((pressure - var2 / 4096.0) * 6250.0) / safe_var1
+  var1 = cal.P9 * pressure * pressure / 2147483648.0
+  var2 = pressure * cal.P8 / 32768.0
+  pressure = pressure + (var1 + var2 + cal.P7) / 16.0
+  pressure = np.where(valid, pressure, 0.0) / 100.0
+
+  humidity = t_fine - 76800.0
+  humidity = (hum_raw - (cal.H4 * 64.0 + cal.H5 / 16384.0 * humidity)) * (cal.H2 / 65536.0 * (1.0 + cal.H6 / 67108864.0 * humidity * (1.0 + cal.H3 / 67108864.0 * humidity)))
+  humidity = humidity * (1.0 - cal.H1 * humidity / 524288.0)
+  humidity = np.clip(humidity, 0.0, 100.0)
+
+  return temperature, pressure, humidity
+
+def _iterFrames(frames):
+  # Accept a flat bytes-like buffer of n*8 bytes or a sequence of frames
+  if isinstance(frames, (bytes, bytearray, memoryview)):
+    view = memoryview(frames)
+    for i in range(0, len(view) - FRAME_SIZE + 1, FRAME_SIZE):
+      yield view[i:i+FRAME_SIZE]
+  else:
+    for frame in frames:
+      yield frame
+
+def compensateBatch(cal, frames, use_numpy=True):
+  # Compensate many raw data frames at once, returns three sequences
+  # (temperatures, pressures, humidities). Uses numpy arrays if available,
+  # plain lists otherwise.
+  if use_numpy and loadNumpy() is not None:
+    if not isinstance(frames, np.ndarray):
+      if not isinstance(frames, (bytes, bytearray, memoryview)):
+        frames = b''.join(bytes(frame) for frame in frames)
+      frames = np.frombuffer(frames, dtype=np.uint8)
+    return _compensateBatchNumpy(cal, frames)
+
+  temps, presses, hums = [], [], []
+  for frame in _iterFrames(frames):
+    temperature, pressure, humidity = compensate(cal, frame)
+    temps.append(temperature)
+    presses.append(pressure)
+    hums.append(humidity)
+  return temps, presses, hums
+
+class BME280(object):
+  """bme280 device, calibration is read from the chip only once"""
+
+  def __init__(self, addr=DEVICE, i2cbus=None):
+    self.addr = addr
+    self.bus = i2cbus or bus
+    self.calibration = None
+    self.configured = False
+    self.mode = MODE_FORCED
+    self.recorder = None  # hydro_trace.TraceRecorder for the raw frames
+
+  def readID(self):
+    (chip_id, chip_version) = self.bus.read_i2c_block_data(self.addr, REG_ID, 2)
+    return (chip_id, chip_version)
+
+  def loadCalibration(self):
+    if self.calibration is None:
+      self.calibration = readCalibration(self.addr, self.bus)
+    return self.calibration
+
+  def configure(self):
+    # ctrl_hum only becomes effective after the next write to ctrl_meas,
+    # so it has to be written only once
+    self.bus.write_byte_data(self.addr, REG_CONTROL_HUM, OVERSAMPLE_HUM)
+    self.configured = True
+
+  def setNormalMode(self, standby=STANDBY_1000MS, iir_filter=FILTER_4):
+    # Let the chip measure on its own every standby period. The config
+    # register may be ignored in normal mode, so go to sleep first.
+    self.configure()
+    self.bus.write_byte_data(self.addr, REG_CONTROL, OVERSAMPLE_TEMP<<5 | OVERSAMPLE_PRES<<2 | MODE_SLEEP)
+    self.bus.write_byte_data(self.addr, REG_CONFIG, standby<<5 | iir_filter<<2)
+    self.bus.write_byte_data(self.addr, REG_CONTROL, OVERSAMPLE_TEMP<<5 | OVERSAMPLE_PRES<<2 | MODE_NORMAL)
+    self.mode = MODE_NORMAL
+
+  def setForcedMode(self):
+    self.bus.write_byte_data(self.addr, REG_CONTROL, OVERSAMPLE_TEMP<<5 | OVERSAMPLE_PRES<<2 | MODE_SLEEP)
+    self.mode = MODE_FORCED
+
+  def readRaw(self):
+    # Return the raw 8 byte data frame. In forced mode a measurement is
+    # started first, in normal mode the latest result is read right away.
+    if not self.configured:
+      self.configure()
+
+    if self.mode == MODE_FORCED:
+      control = OVERSAMPLE_TEMP<<5 | OVERSAMPLE_PRES<<2 | MODE
+      self.bus.write_byte_data(self.addr, REG_CONTROL, control)
+
+      # Wait in ms (Datasheet Appendix B: Measurement time and current calculation)
+      wait_time = 1.25 + (2.3 * OVERSAMPLE_TEMP) + ((2.3 * OVERSAMPLE_PRES) + 0.575) + ((2.3 * OVERSAMPLE_HUM)+0.575)
+      time.sleep(wait_time/1000)  # Wait the required time
+
+    return bytes(self.bus.read_i2c_block_data(self.addr, REG_DATA, FRAME_SIZE))
+
+  def read(self):
+    cal = self.loadCalibration()
+    frame = self.readRaw()
+    if self.recorder is not None:
+      self.recorder.bme280(self.addr, frame, cal)
+    return compensate(cal, frame)
+
+  def compensateBatch(self, frames, use_numpy=True):
+    return compensateBatch(self.loadCalibration(), frames, use_numpy)
+
+_devices = {}
+
+def getDevice(addr=DEVICE):
+  # shared device object per address, so calibration is cached
+  device = _devices.get(addr)
+  if device is None:
+    device = _devices[addr] = BME280(addr)
+  return device
+
+def readBME280All(addr=DEVICE):
+  return getDevice(addr).read()
+
 def main():
 
   (chip_id, chip_version) = readBME280ID()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+adaptive sampling: a sampler source with an AdaptiveRate is read every
+fast seconds while its values move and backs off to slow seconds while
+they don't. Every field has a step, the smallest change worth seeing.
+The source counts as active when a field changed by more than its step
+since the last sample (too slow for how fast it changes) or when it
+deviates more than its step from its running mean (noisy or drifting).
+After settle quiet seconds the interval doubles, up to slow, so it ends up
+where the change per sample is about one step. Pump switches boost the
+sources of their zone to fast for a while, that's when the air changes.
+
+From lowpower seconds on the sensors sleep between samples: the bme280
+in forced mode, the bh1750 in one time mode (see power()).
+"""
+
+import math
+
+__all__ = ['AdaptiveRate']
+
+
+class AdaptiveRate():
+    """sampling interval of one source. steps: {field: smallest change of
+    interest}, fields without step don't count. power(low) switches the
+    sensor between its normal and its sleeping mode, it's called from the
+    sampler thread when the interval crosses lowpower"""
+    def __init__(self, fast, slow, steps, settle=60.0, lowpower=None, power=None):
+        self.fast = fast
+        self.slow = max(slow, fast)
+        self.steps = dict(steps)
+        self.settle = settle
+        self.lowpower = lowpower
+        self.power = power
+        self.interval = fast
+        self.low = False #sensor is in its sleeping mode
+        self.boosted = 0.0 #unix time until which the source stays fast
+        self.fields = None
+        self.checks = [] #(index, step)
+        self.last = None
+        self.means = None
+        self.deviations = None
+        self.quiet = None #unix time since when nothing happened or of the last backoff
+        self.lasttime = None
+
+
+    def bind(self, fields):
+        '''the fields of the source, called by the sampler'''
+        self.fields = tuple(fields)
+        self.checks = [(i, self.steps[field]) for i, field in enumerate(self.fields) if field in self.steps]
+
+
+    def boost(self, until):
+        '''stay fast until unix time until, e.g. after a pump switch'''
+        self.boosted = max(self.boosted, until)
+        self.interval = self.fast
+
+
+    def isactive(self, timestamp, values):
+        if self.last is None:
+            self.last = list(values)
+            self.means = list(values)
+            self.deviations = [0.0] * len(values)
+            self.lasttime = timestamp
+            return False
+        #mean and deviation have a time constant of settle seconds, whatever the interval
+        alpha = 1.0 - math.exp(-max(timestamp - self.lasttime, 0.0) / self.settle)
+        self.lasttime = timestamp
+        active = False
+        for i, step in self.checks:
+            value = values[i]
+            error = abs(value - self.means[i])
+            self.means[i] += alpha * (value - self.means[i])
+            self.deviations[i] += alpha * (error - self.deviations[i])
+            if abs(value - self.last[i]) > step or self.deviations[i] > step:
+                active = True
+            self.last[i] = value
+        return active
+
+
+    def update(self, timestamp, values):
+        '''the interval until the next sample, after the sample values at timestamp'''
+        active = self.isactive(timestamp, values)
+        if self.quiet is None:
+            self.quiet = timestamp
+        if active or timestamp < self.boosted:
+            self.interval = self.fast
+            self.quiet = timestamp
+        elif timestamp - self.quiet >= self.settle and self.interval < self.slow:
+            self.interval = min(self.interval * 2, self.slow)
+            self.quiet = timestamp
+        self.setpower(self.lowpower is not None and self.interval >= self.lowpower)
+        return self.interval
+
+
+    def setpower(self, low):
+        if low != self.low:
+            self.low = low
+            if self.power is not None:
+                self.power(low)
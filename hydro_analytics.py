@@ -0,0 +1,484 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+offline statistics of recorded data for the growers: per zone and day or
+week the air temperature range, humidity excursions, vapour pressure
+deficit, daily light integral, pump duty cycle and tank empty incidents,
+as csv or json. Sources are history databases (the finest tier that has
+the data: raw, then 1 minute, then 1 hour) and raw data traces of
+hydro_trace (files or trace directories), several controllers at once.
+
+Everything is read in chunks of numpy arrays and folded into per period
+accumulators, so memory stays the same for a day or for years. A value
+counts until the next one, at most --maxgap seconds, longer gaps are
+missing data. Days are local days unless --utc.
+
+usage: hydro_analytics.py [--period day|week | --resample s] [--json] [--utc]
+                          [--humlow 40] [--humhigh 80] [--maxgap 300] [--jobs n]
+                          [--config hydro.toml] [name=]source...
+  source       history.db, trace-*.bin or a trace directory. Sources with
+               the same name are one controller, default name is the file
+               (the directory for history.db)
+  --resample   min/mean/max of every metric every s seconds instead of the
+               report, e.g. 300 for a plot
+  --jobs       controllers analysed in parallel, default one per cpu
+  --config     zones (sensor addresses, pins) of the traces, luxtoppfd
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import glob
+import sqlite3
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+#our own modules
+import hydro_hal
+from hydro_logger import my_logger
+import hydro_config
+from hydro_trace import TraceReader, istrace, TRACEDTYPE, HEADERSIZE, CALIBRATION
+from hydro_trace import KIND_BME280, KIND_CALIBRATION, KIND_BH1750, KIND_GPIO, KIND_PUMP
+import bme280
+import bh1750
+
+__all__ = ['PeriodStats', 'historychunks', 'tracechunks', 'analyse', 'resample', 'REPORTFIELDS']
+
+CHUNK = 1 << 16 #rows or records per chunk
+DAY = 86400
+PERIODS = {'day': DAY, 'week': 7 * DAY}
+WEEKSHIFT = 3 * 86400 #unix time 0 was a thursday, weeks start on monday
+MAXGAP = 300.0
+#history metrics of a zone the report needs
+METRICS = ('air.temp', 'air.hum', 'air.vpd', 'light.lux', 'pump.on', 'tank.empty')
+#the tiers of hydro_history, coarsest first, and their bucket seconds
+TIERS = (('1h', 3600), ('1m', 60), ('raw', 0))
+
+REPORTFIELDS = ['source', 'zone', 'period', 'hours', 'temp_min', 'temp_mean', 'temp_max',
+                'hum_min', 'hum_mean', 'hum_max', 'hum_excursions', 'hum_excursion_hours', 'vpd_mean',
+                'dli', 'pump_duty', 'pump_starts', 'tank_empty_incidents', 'tank_empty_hours']
+
+
+def localoffsets(ts):
+    '''utc offset of the local time at every (sorted) timestamp, looked up once per hour'''
+    hours = (ts // 3600).astype(np.int64)
+    if not len(hours):
+        return np.zeros(0)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(hours)) + 1)) #ts are sorted
+    offsets = np.array([time.localtime(hour * 3600).tm_gmtoff for hour in hours[starts].tolist()], dtype=float)
+    return np.repeat(offsets, np.diff(np.append(starts, len(hours))))
+
+
+class PeriodStats():
+    """min, max, time weighted mean and the excursions below low or above
+    high of one metric per period. add() takes chunks in time order"""
+    def __init__(self, period, low=None, high=None, maxgap=MAXGAP, utc=False):
+        self.period = period
+        self.low = low
+        self.high = high
+        self.maxgap = maxgap
+        self.utc = utc
+        self.shift = WEEKSHIFT if period == PERIODS['week'] else 0
+        #period key: [min, max, weighted sum, seconds, count, value sum, excursions, excursion seconds]
+        self.periods = {}
+        self.last = None #(ts, value, low, high, maxgap), its weight is known with the next value
+        self.outside = False #the value before was an excursion
+
+
+    def add(self, ts, values, lows=None, highs=None, maxgap=None):
+        '''a chunk of numpy arrays, lows and highs for rollups (default values).
+        maxgap for this chunk, e.g. 3600 for hour buckets'''
+        if not len(ts):
+            return
+        if lows is None:
+            lows = highs = values
+        gap = max(maxgap or 0.0, self.maxgap)
+        gaps = np.full(len(ts), gap)
+        if self.last is not None:
+            ts, values, lows, highs, gaps = (np.concatenate(([held], array)) for held, array
+                                             in zip(self.last, (ts, values, lows, highs, gaps)))
+        self.last = (ts[-1], values[-1], lows[-1], highs[-1], gaps[-1])
+        ends = ts[:-1] + np.minimum(np.diff(ts), gaps[:-1])
+        self.accumulate(*self.split(ts[:-1], ends, values[:-1], lows[:-1], highs[:-1]))
+
+
+    def finish(self):
+        '''the last value, without weight'''
+        if self.last is not None:
+            ts = np.array([self.last[0]])
+            self.accumulate(self.keys(ts), *(np.array([held]) for held in self.last[1:4]), np.zeros(1), np.ones(1))
+            self.last = None
+
+
+    def split(self, ts, ends, values, lows, highs):
+        '''values held from ts to ends, cut at the period boundaries: the
+        parts after a boundary are extra samples that don't count as values.
+        Returns (keys, values, lows, highs, weights, counts)'''
+        shift = self.shift if self.utc else self.shift + localoffsets(ts)
+        first = np.floor((ts + shift) / self.period).astype(np.int64)
+        crossings = np.floor((np.maximum(ts, ends - 1e-3) + shift) / self.period).astype(np.int64) - first
+        if not crossings.any():
+            return first, values, lows, highs, ends - ts, np.ones(len(ts))
+        owner = np.repeat(np.arange(len(ts)), crossings)
+        keys = first[owner] + np.arange(len(owner)) - np.repeat(np.cumsum(crossings) - crossings, crossings) + 1
+        boundaries = keys * float(self.period) - (shift if self.utc else shift[owner])
+        order = np.argsort(np.concatenate((ts, boundaries)), kind='stable')
+        index = np.concatenate((np.arange(len(ts)), owner))[order]
+        times = np.concatenate((ts, boundaries))[order]
+        weights = np.minimum(np.append(times[1:], np.inf), ends[index]) - times
+        counts = np.concatenate((np.ones(len(ts)), np.zeros(len(owner))))[order]
+        return np.concatenate((first, keys))[order], values[index], lows[index], highs[index], weights, counts
+
+
+    def keys(self, ts):
+        shifted = ts + self.shift if self.utc else ts + self.shift + localoffsets(ts)
+        return np.floor(shifted / self.period).astype(np.int64)
+
+
+    def accumulate(self, keys, values, lows, highs, weights, counts):
+        if not len(keys):
+            return
+        bounds = np.concatenate(([0], np.flatnonzero(np.diff(keys)) + 1)) #keys are sorted
+        outside = np.zeros(len(keys), dtype=bool)
+        if self.low is not None:
+            outside |= values < self.low
+        if self.high is not None:
+            outside |= values > self.high
+        rises = outside & ~np.concatenate(([self.outside], outside[:-1]))
+        self.outside = bool(outside[-1])
+        columns = zip(keys[bounds].tolist(),
+                      np.minimum.reduceat(lows, bounds).tolist(),
+                      np.maximum.reduceat(highs, bounds).tolist(),
+                      np.add.reduceat(values * weights, bounds).tolist(),
+                      np.add.reduceat(weights, bounds).tolist(),
+                      np.add.reduceat(counts, bounds).astype(np.int64).tolist(),
+                      np.add.reduceat(values * counts, bounds).tolist(),
+                      np.add.reduceat(rises.astype(np.int64), bounds).tolist(),
+                      np.add.reduceat(np.where(outside, weights, 0.0), bounds).tolist())
+        for key, low, high, weighted, seconds, count, total, excursions, excursionseconds in columns:
+            agg = self.periods.get(key)
+            if agg is None:
+                self.periods[key] = [low, high, weighted, seconds, count, total, excursions, excursionseconds]
+            else:
+                agg[0] = min(agg[0], low)
+                agg[1] = max(agg[1], high)
+                agg[2] += weighted
+                agg[3] += seconds
+                agg[4] += count
+                agg[5] += total
+                agg[6] += excursions
+                agg[7] += excursionseconds
+
+
+    def label(self, key):
+        '''local date the period starts'''
+        return time.strftime('%Y-%m-%d', time.gmtime(key * self.period - self.shift))
+
+
+    def result(self, key):
+        agg = self.periods[key]
+        mean = agg[2] / agg[3] if agg[3] else agg[5] / max(agg[4], 1)
+        return {'min': agg[0], 'max': agg[1], 'mean': mean, 'seconds': agg[3], 'count': agg[4],
+                'integral': agg[2], 'excursions': agg[6], 'excursionseconds': agg[7]}
+
+
+    def pop(self, before):
+        '''(key, result) of the periods before key before, removed'''
+        for key in sorted(k for k in self.periods if k < before):
+            yield key, self.result(key)
+            del self.periods[key]
+
+
+def splitmetric(name):
+    '''zone and metric of a history metric name, None for metrics the report doesn't use'''
+    from hydro_zones import DEFAULTZONE
+    for metric in METRICS:
+        if name == metric:
+            return DEFAULTZONE, metric
+        if name.endswith('.' + metric):
+            return name[:-len(metric) - 1], metric
+    return None
+
+
+def historychunks(path, metrics=METRICS, chunk=CHUNK):
+    '''(zone, metric, ts, values, lows, highs, maxgap) chunks of a history
+    database in time order per metric. Older data comes from the rollups'''
+    db = sqlite3.connect('file:%s?mode=ro' % path, uri=True)
+    try:
+        for id, name in db.execute('SELECT id, name FROM metrics ORDER BY id').fetchall():
+            split = splitmetric(name)
+            if split is None or split[1] not in metrics:
+                continue
+            #where the finer tiers start, each tier is read up to there
+            starts = []
+            for tier, bucket in TIERS:
+                if bucket:
+                    start = db.execute('SELECT MIN(bucket) FROM rollup_%s WHERE metric = ?' % tier, (id,)).fetchone()[0]
+                else:
+                    start = db.execute('SELECT MIN(ts) FROM raw WHERE metric = ?', (id,)).fetchone()[0]
+                starts.append(float('inf') if start is None else start)
+            begin = float('-inf')
+            for i, (tier, bucket) in enumerate(TIERS):
+                #a coarse tier ends with the last bucket before the finer data
+                finer = min(starts[i + 1:], default=float('inf'))
+                end = finer // bucket * bucket if bucket and finer != float('inf') else float('inf')
+                if bucket:
+                    cursor = db.execute('SELECT bucket, sum / count, min, max FROM rollup_%s WHERE metric = ? AND bucket >= ? AND bucket < ? ORDER BY bucket' % tier,
+                                        (id, begin, end))
+                else:
+                    cursor = db.execute('SELECT ts, value, value, value FROM raw WHERE metric = ? AND ts >= ? AND ts < ? ORDER BY ts',
+                                        (id, begin, end))
+                while True:
+                    rows = cursor.fetchmany(chunk)
+                    if not rows:
+                        break
+                    array = np.array(rows, dtype=float)
+                    yield split + (array[:, 0], array[:, 1], array[:, 2], array[:, 3], float(bucket))
+                begin = max(begin, end)
+    finally:
+        db.close()
+
+
+def tracefiles(path):
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, 'trace-*.bin')))
+    return [path]
+
+
+def tracechunks(path, zones, chunk=CHUNK):
+    '''(zone, metric, ts, values, None, None, 0.0) chunks of a trace file,
+    the bme280 frames compensated in batches. zones map the addresses and pins'''
+    airzones = {zone.bme280: zone.name for zone in zones if zone.bme280 is not None}
+    lightzones = {zone.bh1750: zone.name for zone in zones if zone.bh1750 is not None}
+    pumpzones = {zone.pump: zone.name for zone in zones if zone.pump is not None}
+    tankzones = {zone.tanklevel: zone.name for zone in zones if zone.tanklevel is not None}
+    with TraceReader(path) as reader:
+        wallstart, count = reader.wallstart, len(reader)
+    if not count:
+        return
+    records = np.memmap(path, dtype=TRACEDTYPE, mode='r', offset=HEADERSIZE, shape=(count,))
+    kinds = records['kind']
+    calibrations = {}
+    blobrecords = -(-CALIBRATION.size // 8)
+    for i in np.flatnonzero(kinds == KIND_CALIBRATION).tolist():
+        blob = records['data'][i:i + blobrecords].tobytes()[:CALIBRATION.size]
+        if len(blob) == CALIBRATION.size:
+            calibrations.setdefault(int(records['addr'][i]), bme280.Calibration(*CALIBRATION.unpack(blob)))
+    for begin in range(0, count, chunk):
+        part = records[begin:begin + chunk]
+        ts = wallstart + part['ms'] / 1000.0
+        kind, addr = part['kind'], part['addr']
+        for sensor, zone in airzones.items():
+            select = (kind == KIND_BME280) & (addr == sensor)
+            if sensor in calibrations and select.any():
+                temps, _, hums = bme280.compensateBatch(calibrations[sensor], part['data'][select])
+                yield zone, 'air.temp', ts[select], temps, None, None, 0.0
+                yield zone, 'air.hum', ts[select], hums, None, None, 0.0
+        for sensor, zone in lightzones.items():
+            select = (kind == KIND_BH1750) & (addr == sensor)
+            if select.any():
+                data = part['data'][select].astype(np.int64)
+                lux = (data[:, 1] + 256 * data[:, 0]) / 1.2
+                double = np.isin(part['aux'][select], (bh1750.CONTINUOUS_HIGH_RES_MODE_2, bh1750.ONE_TIME_HIGH_RES_MODE_2))
+                yield zone, 'light.lux', ts[select], np.where(double, lux / 2, lux), None, None, 0.0
+        #switches, the state holds until the next one
+        for pins, recordkind, metric in ((pumpzones, KIND_PUMP, 'pump.on'), (tankzones, KIND_GPIO, 'tank.empty')):
+            for pin, zone in pins.items():
+                select = (kind == recordkind) & (addr == pin)
+                if select.any():
+                    yield zone, metric, ts[select], part['aux'][select].astype(float), None, None, float('inf')
+
+
+def sourcechunks(paths, zones):
+    for path in paths:
+        if istrace(path) or os.path.isdir(path):
+            for file in tracefiles(path):
+                yield from tracechunks(file, zones)
+        else:
+            yield from historychunks(path)
+
+
+def statsfor(metric, period, options):
+    if metric == 'air.hum':
+        return PeriodStats(period, options['humlow'], options['humhigh'], options['maxgap'], options['utc'])
+    if metric in ('pump.on', 'tank.empty'):
+        return PeriodStats(period, None, 0.5, options['maxgap'], options['utc'])
+    return PeriodStats(period, None, None, options['maxgap'], options['utc'])
+
+
+def zonesof(config):
+    '''zones of config. hydro_zones is imported only here, it imports
+    hydro_gpio and that needs the backend main() selected'''
+    from hydro_zones import makezones
+    return makezones(config.zones)
+
+
+def dayscovered(daily, key, series):
+    '''days with data of daily (PeriodStats of a day) in period key of series'''
+    return sum(1 for day, agg in daily.periods.items()
+               if agg[3] > 0 and (day * DAY + series.shift) // series.period == key)
+
+
+def analyse(name, paths, options):
+    '''report rows of one controller, a dict per zone and period'''
+    config = hydro_config.load(options['config'])
+    zones = zonesof(config)
+    period = PERIODS[options['period']]
+    stats = {}
+    lightdays = {} #zone: daily light stats, the days a weekly dli is averaged over
+    for zone, metric, ts, values, lows, highs, maxgap in sourcechunks(paths, zones):
+        key = (zone, metric)
+        if key not in stats:
+            stats[key] = statsfor(metric, period, options)
+        stats[key].add(ts, values, lows, highs, maxgap)
+        if metric == 'light.lux' and period != DAY:
+            if zone not in lightdays:
+                lightdays[zone] = statsfor(metric, DAY, options)
+            lightdays[zone].add(ts, values, lows, highs, maxgap)
+    for series in list(stats.values()) + list(lightdays.values()):
+        series.finish()
+
+    rows = []
+    for zone in sorted(set(zone for zone, _ in stats)):
+        periods = sorted(set(key for (z, _), series in stats.items() if z == zone for key in series.periods))
+        for key in periods:
+            results = {metric: series.result(key) for (z, metric), series in stats.items()
+                       if z == zone and key in series.periods}
+            seconds = max(result['seconds'] for result in results.values())
+            if not seconds:
+                continue #just the very last value
+            anyseries = next(series for (z, _), series in stats.items() if z == zone and key in series.periods)
+            row = dict.fromkeys(REPORTFIELDS)
+            row.update(source=name, zone=zone, period=anyseries.label(key), hours=round(seconds / 3600, 2))
+            temp, hum, vpd, lux = (results.get(metric) for metric in ('air.temp', 'air.hum', 'air.vpd', 'light.lux'))
+            pump, tank = results.get('pump.on'), results.get('tank.empty')
+            if temp:
+                row.update(temp_min=round(temp['min'], 2), temp_mean=round(temp['mean'], 2), temp_max=round(temp['max'], 2))
+            if hum:
+                row.update(hum_min=round(hum['min'], 1), hum_mean=round(hum['mean'], 1), hum_max=round(hum['max'], 1),
+                           hum_excursions=hum['excursions'], hum_excursion_hours=round(hum['excursionseconds'] / 3600, 2))
+            if vpd:
+                row.update(vpd_mean=round(vpd['mean'], 3))
+            if lux:
+                #lux * luxtoppfd is umol/m2/s, summed like hydro_filters.DailyLightIntegral:
+                #missing hours add nothing, a week is averaged over its days with data
+                days = dayscovered(lightdays[zone], key, anyseries) if zone in lightdays else 1
+                row.update(dli=round(lux['integral'] * config.filters.luxtoppfd / 1e6 / max(days, 1), 2))
+            if pump:
+                row.update(pump_duty=round(pump['excursionseconds'] / pump['seconds'], 4) if pump['seconds'] else None,
+                           pump_starts=pump['excursions'])
+            if tank:
+                row.update(tank_empty_incidents=tank['excursions'], tank_empty_hours=round(tank['excursionseconds'] / 3600, 2))
+            rows.append(row)
+    return rows
+
+
+def resample(name, paths, options, emit):
+    '''emit(row) min/mean/max of every metric every options['resample']
+    seconds, each bucket as soon as it is complete'''
+    config = hydro_config.load(options['config'])
+    zones = zonesof(config)
+    stats = {}
+    options = dict(options, utc=True)
+    def flush(key, series, before):
+        for bucket, result in series.pop(before):
+            emit({'source': name, 'zone': key[0], 'metric': key[1], 'time': int(bucket * series.period),
+                  'min': result['min'], 'mean': result['mean'], 'max': result['max'], 'count': result['count']})
+
+    for zone, metric, ts, values, lows, highs, maxgap in sourcechunks(paths, zones):
+        key = (zone, metric)
+        series = stats.get(key)
+        if series is None:
+            series = stats[key] = statsfor(metric, options['resample'], options)
+        series.add(ts, values, lows, highs, maxgap)
+        if series.last is not None:
+            flush(key, series, series.keys(np.array([series.last[0]]))[0])
+    for key, series in stats.items():
+        series.finish()
+        flush(key, series, float('inf'))
+
+
+def analysejob(args):
+    name, paths, options = args
+    start = time.perf_counter()
+    rows = analyse(name, paths, options)
+    my_logger.info('Analytics %s: %d rows in %.1f s', name, len(rows), time.perf_counter() - start)
+    return rows
+
+
+def sources(args):
+    '''{name: [paths]} of name=path arguments'''
+    named = {}
+    for arg in args:
+        name, _, path = arg.rpartition('=')
+        if not name:
+            path = path.rstrip('/')
+            base = os.path.dirname(os.path.abspath(path)) if os.path.basename(path) == 'history.db' else path
+            name = os.path.splitext(os.path.basename(base))[0]
+        named.setdefault(name, []).append(path)
+    return named
+
+
+def parseargs(argv=None):
+    parser = argparse.ArgumentParser(description='daily or weekly grow reports of history databases and raw data traces')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--period', choices=sorted(PERIODS), default='day', help='report period (default day)')
+    mode.add_argument('--resample', type=float, metavar='S',
+                      help='min/mean/max of every metric every S seconds instead of the report, e.g. 300 for a plot')
+    parser.add_argument('--json', action='store_true', help='json instead of csv')
+    parser.add_argument('--utc', action='store_true', help='utc days instead of local days')
+    parser.add_argument('--humlow', type=float, default=40.0, help='humidity excursions below (default 40)')
+    parser.add_argument('--humhigh', type=float, default=80.0, help='humidity excursions above (default 80)')
+    parser.add_argument('--maxgap', type=float, default=MAXGAP, help='seconds a value counts at most (default %(default)s)')
+    parser.add_argument('--jobs', type=int, help='controllers analysed in parallel, default one per cpu')
+    parser.add_argument('--config', help='zones (sensor addresses, pins) of the traces, luxtoppfd')
+    parser.add_argument('source', nargs='+', help='[name=]history.db, trace-*.bin or a trace directory. Sources with '
+                        'the same name are one controller, default name is the file (the directory for history.db)')
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parseargs()
+    options = {'period': args.period, 'resample': args.resample, 'humlow': args.humlow, 'humhigh': args.humhigh,
+               'maxgap': args.maxgap, 'utc': args.utc, 'config': args.config}
+    hydro_hal.select(hydro_hal.BACKEND_SIM) #offline, the zones only need the pin numbers
+    named = sources(args.source)
+    my_logger.setLevel('WARNING')
+    out = sys.stdout
+    start = time.perf_counter()
+
+    if options['resample']:
+        fields = ['source', 'zone', 'metric', 'time', 'min', 'mean', 'max', 'count']
+        writer = csv.DictWriter(out, fields, lineterminator='\n')
+        if args.json:
+            emit = lambda row: out.write(json.dumps(row) + '\n')
+        else:
+            writer.writeheader()
+            emit = writer.writerow
+        for name, paths in named.items():
+            resample(name, paths, options, emit)
+    else:
+        jobs = args.jobs or min(len(named), os.cpu_count() or 1)
+        work = [(name, paths, options) for name, paths in named.items()]
+        if jobs > 1:
+            with ProcessPoolExecutor(jobs, initializer=hydro_hal.select, initargs=(hydro_hal.BACKEND_SIM,)) as pool:
+                results = list(pool.map(analysejob, work))
+        else:
+            results = [analysejob(job) for job in work]
+        rows = [row for result in results for row in result]
+        if args.json:
+            json.dump(rows, out, indent=1)
+            out.write('\n')
+        else:
+            writer = csv.DictWriter(out, REPORTFIELDS, lineterminator='\n')
+            writer.writeheader()
+            writer.writerows(rows)
+    print("{} controllers in {:.2f} s".format(len(named), time.perf_counter() - start), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+mqtt commands: handlers are registered for topic filters with + and #
+wildcards and found in a topic trie, one walk down the topic levels per
+message however many commands there are. The parser of a command checks
+and converts the payload (text, integer(), boolean, choice(), jsondoc) and
+the handler runs in the command thread, never in paho's network thread,
+so a slow handler can't delay the keepalives.
+
+A handler gets a Request and may return a result. If the request has an
+MQTT v5 response topic the reply goes there, with the correlation data of
+the request, otherwise to the request topic + '/reply' if there is a result.
+The reply is json, {"ok": true, "result": ...} or {"ok": false, "error": "..."}.
+"""
+
+import json
+import time
+import queue
+import threading
+from collections import namedtuple
+
+#our own modules
+from hydro_logger import my_logger
+import hydro_metrics
+
+__all__ = ['CommandRouter', 'TopicTrie', 'Request', 'text', 'integer', 'boolean', 'choice', 'jsondoc']
+
+QUEUESIZE = 50 #commands waiting for the command thread, more are dropped
+
+COMMANDSECONDS = hydro_metrics.histogram('hydro_mqtt_command_seconds', 'mqtt command handler run time', ('command',))
+COMMANDERRORS = hydro_metrics.counter('hydro_mqtt_command_errors_total', 'mqtt commands not executed', ('reason',))
+
+#value: the parsed payload, args: the topic levels matched by the wildcards
+Request = namedtuple('Request', ['topic', 'value', 'args', 'responsetopic', 'correlation'])
+Command = namedtuple('Command', ['name', 'topicfilter', 'handler', 'parse'])
+
+
+def checkfilter(topicfilter):
+    '''raises ValueError if topicfilter is no valid subscription'''
+    if not topicfilter or '\0' in topicfilter or len(topicfilter.encode()) > 65535:
+        raise ValueError("invalid topic filter %r" % topicfilter)
+    levels = topicfilter.split('/')
+    for i, level in enumerate(levels):
+        if ('+' in level or '#' in level) and len(level) > 1:
+            raise ValueError("wildcards have to be a whole level in %r" % topicfilter)
+        if level == '#' and i != len(levels) - 1:
+            raise ValueError("# has to be the last level in %r" % topicfilter)
+
+
+class TopicTrie():
+    """values stored under topic filters, match() finds those of a topic"""
+    def __init__(self):
+        self.root = ({}, []) #(children by level, values)
+
+
+    def insert(self, topicfilter, value):
+        checkfilter(topicfilter)
+        node = self.root
+        for level in topicfilter.split('/'):
+            node = node[0].setdefault(level, ({}, []))
+        node[1].append(value)
+
+
+    def match(self, topic):
+        '''[(value, wildcard levels)] of all filters matching topic'''
+        levels = topic.split('/')
+        matches = []
+        stack = [(self.root, 0, ())]
+        while stack:
+            (children, values), i, args = stack.pop()
+            #wildcards at the first level don't match $SYS and the like
+            wild = i > 0 or not topic.startswith('$')
+            node = children.get('#') if wild else None
+            if node is not None:
+                matches.extend((value, args + ('/'.join(levels[i:]),)) for value in node[1])
+            if i == len(levels):
+                matches.extend((value, args) for value in values)
+                continue
+            node = children.get(levels[i])
+            if node is not None:
+                stack.append((node, i + 1, args))
+            node = children.get('+') if wild else None
+            if node is not None:
+                stack.append((node, i + 1, args + (levels[i],)))
+        return matches
+
+
+def text(payload):
+    try:
+        return payload.decode('utf-8').strip()
+    except UnicodeDecodeError:
+        raise ValueError("payload is not utf-8")
+
+
+def integer(minimum=None, maximum=None):
+    '''parser of whole numbers from minimum to maximum'''
+    def parse(payload):
+        value = text(payload)
+        try:
+            number = int(value)
+        except ValueError:
+            raise ValueError("%r is not a whole number" % value)
+        if (minimum is not None and number < minimum) or (maximum is not None and number > maximum):
+            raise ValueError("%d is out of range %s..%s" % (number, minimum, maximum))
+        return number
+    return parse
+
+
+BOOLEANS = {'1': True, 'on': True, 'true': True, '0': False, 'off': False, 'false': False}
+
+def boolean(payload):
+    value = text(payload).lower()
+    if value not in BOOLEANS:
+        raise ValueError("%r is not 1/0, on/off or true/false" % value)
+    return BOOLEANS[value]
+
+
+def choice(*choices):
+    '''parser of one of choices, case does not matter'''
+    def parse(payload):
+        value = text(payload)
+        for name in choices:
+            if value.lower() == name.lower():
+                return name
+        raise ValueError("%r is not one of %s" % (value, ', '.join(choices)))
+    return parse
+
+
+def jsondoc(payload):
+    '''a json object, {} for an empty payload'''
+    value = text(payload)
+    if not value:
+        return {}
+    try:
+        doc = json.loads(value)
+    except json.JSONDecodeError as e:
+        raise ValueError("invalid json: %s" % e)
+    if not isinstance(doc, dict):
+        raise ValueError("payload has to be a json object")
+    return doc
+
+
+class CommandRouter(threading.Thread):
+    """the mqtt commands, onmessage() is paho's on_message and only queues,
+    the thread (or runpending() without thread) executes them"""
+    def __init__(self, queuesize=QUEUESIZE):
+        super().__init__(name='commands', daemon=True)
+        self.trie = TopicTrie()
+        self.topicfilters = [] #in the order they were added, for subscribing
+        self.queue = queue.Queue(queuesize)
+
+
+    def add(self, name, topicfilter, handler, parse=text):
+        '''handler(request) for messages on topicfilter, name labels the metrics'''
+        self.trie.insert(topicfilter, Command(name, topicfilter, handler, parse))
+        if topicfilter not in self.topicfilters:
+            self.topicfilters.append(topicfilter)
+
+
+    def subscriptions(self, qos=0):
+        return [(topicfilter, qos) for topicfilter in self.topicfilters]
+
+
+    def onmessage(self, client, msg):
+        '''look up the commands of msg and queue them, runs in the network thread'''
+        commands = self.trie.match(msg.topic)
+        if not commands:
+            COMMANDERRORS.labels('unknown').inc()
+            return
+        #response topic and correlation data only come with MQTT v5
+        properties = getattr(msg, 'properties', None)
+        responsetopic = getattr(properties, 'ResponseTopic', None)
+        correlation = getattr(properties, 'CorrelationData', None)
+        for command, args in commands:
+            try:
+                self.queue.put_nowait((client, command, msg.topic, msg.payload, args, responsetopic, correlation))
+            except queue.Full:
+                COMMANDERRORS.labels('overload').inc()
+                my_logger.error('Command queue full, %s dropped', msg.topic)
+
+
+    def execute(self, client, command, topic, payload, args, responsetopic, correlation):
+        start = time.perf_counter()
+        result = None
+        try:
+            result = command.handler(Request(topic, command.parse(payload), args, responsetopic, correlation))
+            reply = {"ok": True, "result": result}
+        except ValueError as e:
+            COMMANDERRORS.labels('invalid').inc()
+            my_logger.error('Command %s %r: %s', topic, payload, e)
+            reply = {"ok": False, "error": str(e)}
+        except Exception as e:
+            COMMANDERRORS.labels('failed').inc()
+            my_logger.error('Command %s failed', topic, exc_info=True)
+            reply = {"ok": False, "error": "%s: %s" % (type(e).__name__, e)}
+        COMMANDSECONDS.labels(command.name).observe(time.perf_counter() - start)
+        if responsetopic:
+            self.reply(client, responsetopic, reply, correlation)
+        elif result is not None:
+            self.reply(client, topic + '/reply', reply)
+
+
+    def reply(self, client, topic, reply, correlation=None):
+        payload = json.dumps(reply, separators=(',', ':'), default=str)
+        if correlation is None:
+            client.publish(topic, payload)
+            return
+        #paho is imported by the controller only when it needs it
+        from paho.mqtt.properties import Properties
+        from paho.mqtt.packettypes import PacketTypes
+        properties = Properties(PacketTypes.PUBLISH)
+        properties.CorrelationData = correlation
+        client.publish(topic, payload, properties=properties)
+
+
+    def runpending(self):
+        '''execute the queued commands without the thread'''
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None:
+                self.execute(*item)
+
+
+    def stop(self):
+        self.queue.put(None)
+
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            self.execute(*item)
@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+"""
+controller configuration: hydro.toml next to the controller (or the file
+named by HYDRO_CONFIG), then environment variables HYDRO_<SECTION>_<KEY>,
+e.g. HYDRO_MQTT_SERVER=10.0.0.5, then the defaults below. The result is
+validated once and kept as an immutable Config of namedtuples, get()
+returns the active one. ConfigWatcher notices changes of the file (inotify,
+polling where that is not available) and hands the new Config to a callback,
+a broken file is logged and the old Config stays active.
+
+[mqtt]
+server = "192.168.168.112"
+
+[intervals]
+publish = 10
+
+[[zones]]
+name = "main"
+pump = 15
+...
+
+[[interlocks]]
+name = "leak"
+pin = 22
+triplevel = 0
+zones = ["main", "tray2"]
+
+The zone entries are those of hydro_zones, the interlocks those of
+hydro_interlock (each zone with level switches has dry run and overflow
+rules anyway).
+"""
+
+import os
+import time
+import select
+import ctypes
+import threading
+from collections import namedtuple
+
+try:
+    import tomllib
+except ImportError:
+    try:
+        import tomli as tomllib #python before 3.11
+    except ImportError:
+        tomllib = None
+
+#our own modules
+from hydro_logger import my_logger, LOGFILE, LOGLEVEL, FLUSHINTERVAL
+
+__all__ = ['Config', 'ZoneConfig', 'InterlockConfig', 'load', 'get', 'activate', 'reloadable', 'topicroot', 'ConfigWatcher', 'CONFIGFILE']
+
+CONFIGFILE = os.environ.get('HYDRO_CONFIG', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hydro.toml'))
+
+#section: {key: default}, the type of the default is the type of the setting
+DEFAULTS = {
+    "controller": {"serial": 'HydroponicPi-00001'},
+    "mqtt": {"server": "192.168.168.112", "port": 1883, "protocol": 3, #3.1.1 like before, 5 adds correlated replies and spool timestamps
+             "topicroot": "iot/Hydroponic"}, #"iot/Hydroponic/{serial}" keeps controllers on one broker apart
+    "log": {"file": LOGFILE, "level": LOGLEVEL, "flushinterval": FLUSHINTERVAL},
+    "pump": {"minon": 2, "minoff": 30}, #minutes, shortest phases settable by mqtt
+    "intervals": {"sample": 1.0, "publish": 10.0, "display": 10.0, "historyflush": 60.0, "metrics": 60.0},
+    "telemetry": {"mode": 'topics'}, #'json' or 'both' for one batched message per tick
+    "display": {"mode": 'values', "zone": ''}, #mode 'off' blanks it, zone '' is the first zone
+    "metrics": {"port": 9101}, #http /metrics for prometheus, 0 to switch it off
+    "interlock": {"holdoff": 60.0, "minoff": 120.0}, #seconds a level has to be ok again, a stopped pump stays off
+    "gateway": {"prefix": "iot/Hydroponic", "summarytopic": "iot/Hydroponic/fleet", "interval": 10.0, "stale": 120.0,
+                "maxdevices": 1000, "metrics": ["AirTemp", "AirRelHum", "VPD", "DLI", "Lux", "WaterPump"]}, #see hydro_gateway
+    "filters": {"median": 3, "smoothing": 0.0, "outliers": 4.0, "luxtoppfd": 0.0185}, #see hydro_filters, 0 switches a stage off
+    #see hydro_adaptive, seconds except the steps. slow 0 samples every intervals.sample
+    "sampling": {"slow": 30.0, "settle": 60.0, "pumpboost": 120.0, "lowpower": 5.0,
+                 "tempstep": 0.5, "humstep": 2.5, "luxstep": 1000.0},
+    "watchdog": {"deadline": 20.0, "mqttdeadline": 60.0, "attempts": 3}, #seconds, recoveries before systemd restarts us
+    "trace": {"maxmb": 0, "flushinterval": 30.0}, #raw data trace, see hydro_trace. Off, maxmb above 0 switches it on
+}
+
+#key: (type, default), name and pump are required
+ZONEFIELDS = {
+    "name": (str, None),
+    "pump": (int, None),
+    "tanklevel": (int, None),
+    "returnlevel": (int, None),
+    "bme280": (int, None), #i2c address, also as string like "0x76"
+    "bh1750": (int, None),
+    "wateron": (int, 5), #minutes
+    "wateroff": (int, 180),
+    "topic": (str, None), #mqtt namespace, default iot/Hydroponic/<name>
+}
+
+#further interlock sensors, key: (type, default), all but zones and holdoff are required
+INTERLOCKFIELDS = {
+    "name": (str, None),
+    "pin": (int, None),
+    "triplevel": (int, None), #pin level that stops the pumps
+    "zones": (list, []), #zone names, all zones if empty
+    "holdoff": (float, None), #default interlock.holdoff
+}
+
+#sections a running controller doesn't take over, a reload keeps their old values
+RESTARTSECTIONS = ('controller', 'mqtt', 'metrics', 'interlocks', 'filters', 'sampling', 'watchdog', 'trace')
+
+LOGLEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+TELEMETRYMODES = ('topics', 'json', 'both')
+DISPLAYMODES = ('values', 'off')
+
+_sections = {name: namedtuple(name.capitalize() + 'Config', list(keys)) for name, keys in DEFAULTS.items()}
+Config = namedtuple('Config', list(DEFAULTS) + ['zones', 'interlocks', 'path'])
+ZoneConfig = namedtuple('ZoneConfig', list(ZONEFIELDS))
+InterlockConfig = namedtuple('InterlockConfig', list(INTERLOCKFIELDS))
+
+
+def _convert(value, kind, where):
+    '''value as kind, ints are fine for floats, strings from the environment are parsed'''
+    if isinstance(value, str) and kind is list:
+        value = [item.strip() for item in value.split(',') if item.strip()]
+    if isinstance(value, str) and kind is not str:
+        try:
+            return kind(int(value, 0)) if kind is int else kind(value)
+        except ValueError:
+            raise ValueError("%s: %r is not of type %s" % (where, value, kind.__name__))
+    if kind is float and isinstance(value, int) and not isinstance(value, bool):
+        return float(value)
+    if kind is list and isinstance(value, list):
+        return tuple(_convert(item, str, where) for item in value) #immutable like the rest
+    if not isinstance(value, kind) or isinstance(value, bool):
+        raise ValueError("%s: %r is not of type %s" % (where, value, kind.__name__))
+    return value
+
+
+def _entry(entry, fields, required, entrytype, where):
+    '''one table of an array of tables like [[zones]]'''
+    if not isinstance(entry, dict):
+        raise ValueError(where + ": has to be a table")
+    unknown = set(entry) - set(fields)
+    if unknown:
+        raise ValueError("%s: unknown keys %s" % (where, ', '.join(sorted(unknown))))
+    values = {}
+    for key, (kind, default) in fields.items():
+        value = entry.get(key, default)
+        if value is None and key in required:
+            raise ValueError("%s: %s is missing" % (where, key))
+        values[key] = None if value is None else _convert(value, kind, where + '.' + key)
+    return entrytype(**values)
+
+
+def validate(config):
+    '''raises ValueError for values out of range'''
+    if config.log.level.upper() not in LOGLEVELS:
+        raise ValueError("log.level: unknown level " + config.log.level)
+    if config.telemetry.mode not in TELEMETRYMODES:
+        raise ValueError("telemetry.mode: one of " + ', '.join(TELEMETRYMODES))
+    if config.display.mode not in DISPLAYMODES:
+        raise ValueError("display.mode: one of " + ', '.join(DISPLAYMODES))
+    for key, value in config.intervals._asdict().items():
+        if value <= 0:
+            raise ValueError("intervals.%s: has to be positive" % key)
+    if config.log.flushinterval < 0 or config.pump.minon < 1 or config.pump.minoff < 1:
+        raise ValueError("log.flushinterval, pump.minon or pump.minoff out of range")
+    if config.mqtt.protocol not in (3, 5):
+        raise ValueError("mqtt.protocol: 3 or 5")
+    for key, topic in (('mqtt.topicroot', config.mqtt.topicroot), ('gateway.prefix', config.gateway.prefix),
+                       ('gateway.summarytopic', config.gateway.summarytopic)):
+        if not topic or '+' in topic or '#' in topic or topic.startswith('/') or topic.endswith('/'):
+            raise ValueError(key + ": a topic without wildcards and outer slashes")
+    if config.gateway.interval <= 0 or config.gateway.stale <= 0 or config.gateway.maxdevices < 1:
+        raise ValueError("gateway.interval, stale and maxdevices have to be positive")
+    for port in (config.mqtt.port, config.metrics.port):
+        if not 0 <= port < 65536:
+            raise ValueError("port %d out of range" % port)
+    for zone in config.zones:
+        if zone.wateron < config.pump.minon or zone.wateroff < config.pump.minoff:
+            raise ValueError("zone %s: watering cycle shorter than pump.minon/minoff" % zone.name)
+    zonenames = [zone.name for zone in config.zones] or ['main']
+    if config.display.zone and config.display.zone not in zonenames:
+        raise ValueError("display.zone: no zone " + config.display.zone)
+    if config.filters.median < 1 or config.filters.smoothing < 0 or config.filters.outliers < 0 or config.filters.luxtoppfd <= 0:
+        raise ValueError("filters: median from 1, smoothing and outliers from 0, luxtoppfd above 0")
+    sampling = config.sampling
+    if sampling.slow < 0 or sampling.settle <= 0 or sampling.pumpboost < 0 or sampling.lowpower <= 0:
+        raise ValueError("sampling: slow and pumpboost from 0, settle and lowpower above 0")
+    if min(sampling.tempstep, sampling.humstep, sampling.luxstep) <= 0:
+        raise ValueError("sampling: the steps have to be positive")
+    if config.watchdog.deadline <= 0 or config.watchdog.mqttdeadline <= 0 or config.watchdog.attempts < 1:
+        raise ValueError("watchdog: deadlines above 0, attempts from 1")
+    if config.trace.maxmb < 0 or config.trace.flushinterval <= 0:
+        raise ValueError("trace: maxmb from 0, flushinterval above 0")
+    if config.interlock.holdoff < 0 or config.interlock.minoff < 0:
+        raise ValueError("interlock.holdoff and minoff can't be negative")
+    for interlock in config.interlocks:
+        if interlock.triplevel not in (0, 1):
+            raise ValueError("interlock %s: triplevel is 0 or 1" % interlock.name)
+        for name in interlock.zones:
+            if name not in zonenames:
+                raise ValueError("interlock %s: no zone %s" % (interlock.name, name))
+
+
+def parse(document, environ=None, path=None):
+    '''Config of a parsed toml document (dict) and the HYDRO_* environment'''
+    environ = os.environ if environ is None else environ
+    document = dict(document)
+    sections = {}
+    for name, defaults in DEFAULTS.items():
+        table = document.pop(name, {})
+        if not isinstance(table, dict):
+            raise ValueError(name + ": has to be a table")
+        unknown = set(table) - set(defaults)
+        if unknown:
+            raise ValueError("%s: unknown keys %s" % (name, ', '.join(sorted(unknown))))
+        values = {}
+        for key, default in defaults.items():
+            where = name + '.' + key
+            value = environ.get('HYDRO_%s_%s' % (name.upper(), key.upper()), table.get(key, default))
+            values[key] = _convert(value, type(default), where)
+        sections[name] = _sections[name](**values)
+    zones = tuple(_entry(entry, ZONEFIELDS, ('name', 'pump'), ZoneConfig, "zones[%d]" % i)
+                  for i, entry in enumerate(document.pop("zones", [])))
+    interlocks = tuple(_entry(entry, INTERLOCKFIELDS, ('name', 'pin', 'triplevel'), InterlockConfig, "interlocks[%d]" % i)
+                       for i, entry in enumerate(document.pop("interlocks", [])))
+    if document:
+        raise ValueError("unknown sections " + ', '.join(sorted(document)))
+    config = Config(zones=zones, interlocks=interlocks, path=path, **sections)
+    validate(config)
+    return config
+
+
+def load(path=CONFIGFILE, environ=None):
+    '''Config of the file, just defaults and environment if path is None or missing'''
+    if path is None or not os.path.exists(path):
+        return parse({}, environ)
+    if tomllib is None:
+        raise RuntimeError("reading %s needs python 3.11 or the tomli package" % path)
+    with open(path, 'rb') as f:
+        try:
+            document = tomllib.load(f)
+        except tomllib.TOMLDecodeError as e:
+            raise ValueError("%s: %s" % (path, e))
+    return parse(document, environ, path)
+
+
+_active = None
+
+def get():
+    '''the active Config, the defaults until activate() was called'''
+    global _active
+    if _active is None:
+        _active = load(None)
+    return _active
+
+
+def activate(config):
+    global _active
+    _active = config
+
+
+def reloadable(old, new):
+    '''new with the settings of old that only take effect after a restart,
+    and the names of those that changed. Of the zones only the watering
+    cycles change live, of the interlock section only minoff'''
+    restart = [name for name in RESTARTSECTIONS if getattr(new, name) != getattr(old, name)]
+    keep = {name: getattr(old, name) for name in restart}
+    if new.interlock.holdoff != old.interlock.holdoff:
+        restart.append('interlock.holdoff')
+        keep['interlock'] = new.interlock._replace(holdoff=old.interlock.holdoff)
+    oldzones = {zone.name: zone for zone in old.zones}
+    newzones = {zone.name: zone for zone in new.zones}
+    if set(oldzones) != set(newzones) or any(oldzones[name]._replace(wateron=zone.wateron, wateroff=zone.wateroff) != zone
+                                             for name, zone in newzones.items()):
+        restart.append('zones')
+        keep['zones'] = tuple(zone._replace(wateron=newzones[zone.name].wateron, wateroff=newzones[zone.name].wateroff)
+                              if zone.name in newzones else zone for zone in old.zones)
+        zonenames = [zone.name for zone in old.zones] or ['main']
+        if new.display.zone and new.display.zone not in zonenames:
+            restart.append('display.zone')
+            keep['display'] = new.display._replace(zone=old.display.zone)
+    return new._replace(**keep), restart
+
+
+def topicroot(config=None):
+    '''mqtt topic of the controller, the zones are below it'''
+    config = config or get()
+    return config.mqtt.topicroot.replace('{serial}', config.controller.serial)
+
+
+#inotify, from <sys/inotify.h>
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+def _inotify(directory):
+    '''inotify file descriptor watching directory, None where there is no inotify'''
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return None
+        #the directory, editors write a new file and rename it over the old one
+        if libc.inotify_add_watch(fd, os.fsencode(directory), IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+            os.close(fd)
+            return None
+        return fd
+    except (OSError, AttributeError):
+        return None
+
+
+class ConfigWatcher(threading.Thread):
+    """reloads the config file when it changes and calls callback(old, new)
+    from this thread. Only valid configs that differ from the active one
+    are activated and passed on, with the old values of the settings that
+    need a restart (see reloadable())."""
+    def __init__(self, path, callback, pollinterval=2.0, settle=0.2):
+        super().__init__(name='configwatcher', daemon=True)
+        self.path = path
+        self.callback = callback
+        self.pollinterval = pollinterval
+        self.settle = settle #let the editor finish writing
+        self.stopped = threading.Event()
+        self.signature = self.filesignature()
+        self.fd = None
+
+
+    def filesignature(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size, st.st_ino)
+        except OSError:
+            return None
+
+
+    def stop(self):
+        self.stopped.set()
+
+
+    def waitforchange(self):
+        '''returns after something happened to the directory, or the poll interval'''
+        if self.fd is None:
+            self.stopped.wait(self.pollinterval)
+            return
+        readable, _, _ = select.select([self.fd], [], [], 1.0)
+        if readable:
+            try:
+                while os.read(self.fd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+
+
+    def reload(self):
+        '''load the file if it changed, returns the new config or None'''
+        signature = self.filesignature()
+        if signature == self.signature:
+            return None
+        self.signature = signature
+        try:
+            config = load(self.path)
+        except (OSError, ValueError, RuntimeError) as e:
+            my_logger.error('Config error, keeping the old one: %s', e)
+            return None
+        old = get()
+        config, restart = reloadable(old, config)
+        if restart:
+            my_logger.warning('Config changes of %s take effect after a restart', ', '.join(restart))
+        if config == old:
+            return None
+        activate(config)
+        my_logger.info('Config reloaded from %s', self.path)
+        try:
+            self.callback(old, config)
+        except Exception:
+            my_logger.error('Config apply error', exc_info=True)
+        return config
+
+
+    def run(self):
+        self.fd = _inotify(os.path.dirname(os.path.abspath(self.path)))
+        my_logger.debug('Config watch %s (%s)', self.path, 'inotify' if self.fd is not None else 'polling')
+        try:
+            while not self.stopped.is_set():
+                self.waitforchange()
+                if self.filesignature() != self.signature:
+                    time.sleep(self.settle)
+                    self.reload()
+        finally:
+            if self.fd is not None:
+                os.close(self.fd)
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+oled display output. Fonts are loaded once, frames are rendered in a worker
+thread and only the changed columns of changed pages go over the bus.
+If the text didn't change, nothing is rendered or sent at all.
+"""
+
+import time
+import threading
+from PIL import Image, ImageDraw, ImageFont
+
+#our own modules
+from hydro_logger import my_logger
+
+__all__ = ['Display', 'getfont', 'framepages']
+
+FONTFILE = 'FreeSans.ttf'
+
+#ssd1306 commands
+COLUMNADDR = 0x21
+PAGEADDR = 0x22
+
+#bit order of a byte reversed, for converting pil rows to display pages
+REVERSEBITS = bytes(int('{:08b}'.format(i)[::-1], 2) for i in range(256))
+
+_fonts = {}
+
+def getfont(size):
+    '''truetype font of size, parsed only on first use'''
+    font = _fonts.get(size)
+    if font is None:
+        try:
+            font = ImageFont.truetype(FONTFILE, size)
+        except Exception as e:
+            my_logger.error('Font error %s', e)
+            font = ImageFont.load_default()
+        _fonts[size] = font
+    return font
+
+
+def framepages(image, pages=8):
+    '''convert a 1 bit pil image into the page bytes of the ssd1306, in the
+    column order lib_oled96 uses (rightmost pixel column first)'''
+    width = image.size[0]
+    result = []
+    for page in range(pages):
+        #after rotating, each pixel row is one display column of 8 pixels
+        strip = image.crop((0, page * 8, width, page * 8 + 8)).transpose(Image.ROTATE_90)
+        result.append(strip.tobytes().translate(REVERSEBITS))
+    return result
+
+
+class Display():
+    """renders screens off the main loop. A screen is a tuple of
+    (x, y, text, fontsize) items, show() only hands it to the worker"""
+    def __init__(self, oled):
+        self.oled = oled
+        self.width = oled.width
+        self.pages = oled.pages
+        self.image = Image.new('1', (self.width, self.pages * 8))
+        self.draw = ImageDraw.Draw(self.image)
+        self.sentpages = None #what the display shows right now
+        self.screen = None #latest requested screen
+        self.renderedscreen = None
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = threading.Thread(target=self.run, name='display', daemon=True)
+        #statistics
+        self.frames = 0
+        self.skipped = 0
+        self.bytessent = 0
+        self.rendertime = 0.0
+
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+
+    def show(self, screen):
+        '''request a screen, returns immediately'''
+        screen = tuple(screen)
+        with self.condition:
+            if screen == self.screen:
+                self.skipped += 1
+                return
+            self.screen = screen
+            self.condition.notify()
+
+
+    def showinit(self):
+        self.show(((12, 10, "Hydroponic", 20), (20, 35, "Controller", 20)))
+
+
+    def showvalues(self, temp, humidity, info):
+        self.show(((5, 1, "Temp: {:.1f}°C".format(temp), 18),
+                   (5, 25, "Hum:  {:.0f} %".format(humidity), 18),
+                   (5, 50, info, 14)))
+
+
+    def showinfo(self, info):
+        self.show(((5, 1, info, 15),))
+
+
+    def render(self, screen):
+        '''draw screen and send the changed parts, returns bytes sent'''
+        start = time.perf_counter()
+        self.draw.rectangle((0, 0, self.width - 1, self.pages * 8 - 1), outline=0, fill=0)
+        for x, y, text, size in screen:
+            self.draw.text((x, y), text, font=getfont(size), fill=1)
+        pages = framepages(self.image, self.pages)
+
+        sent = 0
+        for page, data in enumerate(pages):
+            old = self.sentpages[page] if self.sentpages is not None else None
+            if old == data:
+                continue
+            first, last = 0, self.width - 1
+            if old is not None:
+                while data[first] == old[first]:
+                    first += 1
+                while data[last] == old[last]:
+                    last -= 1
+            self.oled._command(COLUMNADDR, first, last, PAGEADDR, page, page)
+            self.oled._data(data[first:last + 1])
+            sent += 6 + last + 1 - first
+        self.sentpages = pages
+        self.rendertime += time.perf_counter() - start
+        self.bytessent += sent
+        self.frames += 1
+        return sent
+
+
+    def runpending(self):
+        '''render the latest screen if it isn't shown yet, False after an error'''
+        with self.condition:
+            screen = self.screen
+        if screen == self.renderedscreen:
+            return True
+        try:
+            self.render(screen)
+            self.renderedscreen = screen
+            return True
+        except Exception as e:
+            #try again with the next request, resend everything
+            self.sentpages = None
+            self.renderedscreen = None
+            my_logger.error('Display error %s', e)
+            return False
+
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and self.screen == self.renderedscreen:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                screen = self.screen
+            if not self.runpending():
+                with self.condition:
+                    if self.screen == screen:
+                        self.condition.wait(10)
+
+
+    def stats(self):
+        return {"frames": self.frames, "skipped": self.skipped, "bytessent": self.bytessent,
+                "rendertime": self.rendertime}
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+sample filters: every field of a sampler source runs through a chain of
+stages (Range, Outliers, Median, Slew, Ema), a stage returns the new value
+or None to drop the whole sample, e.g. an i2c glitch. Derived fields are
+computed from the filtered values: dew point and vapour pressure deficit
+from temperature and humidity, the daily light integral from lux.
+Every stage keeps a fixed amount of state, a sample costs the same
+however long the controller runs.
+"""
+
+import math
+import time
+import bisect
+from collections import deque
+
+__all__ = ['SampleFilter', 'Chain', 'Range', 'Outliers', 'Median', 'Slew', 'Ema',
+           'DailyLightIntegral', 'dewpoint', 'vpd', 'airfilter', 'lightfilter']
+
+LUXTOPPFD = 0.0185 #umol/m2/s per lux of sunlight, white leds about 0.015, hps 0.0122
+
+
+class Range():
+    """drops values outside of what the sensor can measure"""
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+
+
+    def process(self, timestamp, value):
+        #nan fails both comparisons
+        return value if self.low <= value <= self.high else None
+
+
+class Outliers():
+    """drops values further than k times the usual deviation from the running
+    mean, both are exponentially weighted. Deviations up to floor always pass.
+    After maxrejects drops in a row the value counts as a real step and the
+    filter starts over from it"""
+    def __init__(self, k=4.0, floor=0.0, alpha=0.1, maxrejects=3):
+        self.k = k
+        self.floor = floor
+        self.alpha = alpha
+        self.maxrejects = maxrejects
+        self.mean = None
+        self.deviation = 0.0
+        self.rejects = 0
+
+
+    def process(self, timestamp, value):
+        if self.mean is None:
+            self.mean = value
+            return value
+        error = abs(value - self.mean)
+        if error > max(self.k * self.deviation, self.floor):
+            self.rejects += 1
+            if self.rejects <= self.maxrejects:
+                return None
+            self.mean, self.deviation = value, 0.0
+        else:
+            self.mean += self.alpha * (value - self.mean)
+            self.deviation += self.alpha * (error - self.deviation)
+        self.rejects = 0
+        return value
+
+
+class Median():
+    """median of the last window values, removes single spikes without
+    smearing steps"""
+    def __init__(self, window=3):
+        self.window = window
+        self.values = deque()
+        self.ordered = []
+
+
+    def process(self, timestamp, value):
+        if len(self.values) == self.window:
+            del self.ordered[bisect.bisect_left(self.ordered, self.values.popleft())]
+        self.values.append(value)
+        bisect.insort(self.ordered, value)
+        return self.ordered[len(self.ordered) // 2]
+
+
+class Slew():
+    """limits the change to maxrate per second"""
+    def __init__(self, maxrate):
+        self.maxrate = maxrate
+        self.value = None
+        self.last = None
+
+
+    def process(self, timestamp, value):
+        if self.value is not None:
+            step = self.maxrate * max(timestamp - self.last, 0.0)
+            value = min(max(value, self.value - step), self.value + step)
+        self.value = value
+        self.last = timestamp
+        return value
+
+
+class Ema():
+    """exponential moving average with a time constant of tau seconds, the
+    same smoothing whatever the sample interval is"""
+    def __init__(self, tau):
+        self.tau = tau
+        self.value = None
+        self.last = None
+
+
+    def process(self, timestamp, value):
+        if self.value is None:
+            self.value = value
+        else:
+            alpha = 1.0 - math.exp(-max(timestamp - self.last, 0.0) / self.tau)
+            self.value += alpha * (value - self.value)
+        self.last = timestamp
+        return self.value
+
+
+class Chain():
+    def __init__(self, *stages):
+        self.stages = stages
+
+
+    def process(self, timestamp, value):
+        for stage in self.stages:
+            value = stage.process(timestamp, value)
+            if value is None:
+                return None
+        return value
+
+
+def saturationpressure(temp):
+    '''kPa over water at temp (C), tetens formula'''
+    return 0.6108 * math.exp(17.27 * temp / (temp + 237.3))
+
+
+def dewpoint(temp, hum):
+    '''C, magnus formula'''
+    gamma = math.log(max(hum, 0.1) / 100.0) + 17.62 * temp / (243.12 + temp)
+    return 243.12 * gamma / (17.62 - gamma)
+
+
+def vpd(temp, hum):
+    '''vapour pressure deficit in kPa, leaves taken at air temperature'''
+    return saturationpressure(temp) * (1.0 - hum / 100.0)
+
+
+class DailyLightIntegral():
+    """mol/m2 of photosynthetic light since local midnight, integrated from
+    lux. factor converts lux to umol/m2/s and depends on the light source.
+    Gaps longer than maxgap only count maxgap seconds of the last value."""
+    def __init__(self, factor=LUXTOPPFD, maxgap=60.0):
+        self.factor = factor
+        self.maxgap = maxgap
+        self.total = 0.0
+        self.ppfd = 0.0
+        self.last = None
+        self.nextday = 0.0 #unix time of the next local midnight
+
+
+    def startday(self, timestamp):
+        day = time.localtime(timestamp)
+        self.nextday = time.mktime((day.tm_year, day.tm_mon, day.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+        self.total = 0.0
+        self.last = None
+
+
+    def resume(self, timestamp, total):
+        '''continue from total at timestamp, e.g. the last value in the history'''
+        if timestamp >= self.nextday:
+            self.startday(timestamp)
+        self.total = total
+
+
+    def process(self, timestamp, lux):
+        if timestamp >= self.nextday:
+            self.startday(timestamp)
+        if self.last is not None:
+            self.total += self.ppfd * min(max(timestamp - self.last, 0.0), self.maxgap) * 1e-6
+        self.ppfd = lux * self.factor
+        self.last = timestamp
+        return self.total
+
+
+class SampleFilter():
+    """filter chains of the fields of a sampler source plus derived fields,
+    func(timestamp, values) of the filtered values. fields are the input
+    fields followed by the derived ones"""
+    def __init__(self, inputs, chains, derived=()):
+        self.inputs = tuple(inputs)
+        self.chains = [chains.get(field) for field in self.inputs]
+        self.derived = list(derived) #(field, func)
+        self.fields = self.inputs + tuple(field for field, _ in self.derived)
+
+
+    def process(self, timestamp, values):
+        '''the filtered and derived values, None if the sample is dropped'''
+        result = []
+        for chain, value in zip(self.chains, values):
+            if chain is not None:
+                value = chain.process(timestamp, value)
+                if value is None:
+                    return None
+            result.append(value)
+        for _, func in self.derived:
+            result.append(func(timestamp, result))
+        return tuple(result)
+
+
+def fieldchain(settings, low, high, floor, maxrate=None):
+    '''range check and the stages the filters config section switches on'''
+    stages = [Range(low, high)]
+    if settings.outliers:
+        stages.append(Outliers(settings.outliers, floor))
+    if settings.median > 1:
+        stages.append(Median(settings.median))
+    if maxrate is not None:
+        stages.append(Slew(maxrate))
+    if settings.smoothing:
+        stages.append(Ema(settings.smoothing))
+    return Chain(*stages)
+
+
+def airfilter(settings):
+    '''temp, press, hum of a bme280 (its measuring range) plus dew point and vpd'''
+    return SampleFilter(('temp', 'press', 'hum'), {
+        'temp': fieldchain(settings, -40.0, 85.0, 2.0, maxrate=0.5),
+        'press': fieldchain(settings, 300.0, 1100.0, 5.0, maxrate=1.0),
+        'hum': fieldchain(settings, 0.0, 100.0, 10.0, maxrate=2.0),
+    }, [('dewpoint', lambda timestamp, values: dewpoint(values[0], values[2])),
+        ('vpd', lambda timestamp, values: vpd(values[0], values[2]))])
+
+
+def lightfilter(settings, dli=None):
+    '''lux of a bh1750 plus the daily light integral. Light switches on and
+    off in one step, so only glitches are dropped, no outlier rejection'''
+    if dli is None:
+        dli = DailyLightIntegral(settings.luxtoppfd)
+    stages = [Range(0.0, 100000.0)]
+    if settings.median > 1:
+        stages.append(Median(settings.median))
+    return SampleFilter(('lux',), {'lux': Chain(*stages)},
+                        [('dli', lambda timestamp, values: dli.process(timestamp, values[0]))])
@@ -0,0 +1,277 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+fleet gateway: one process that follows many controllers on one broker.
+The controllers publish below <prefix>/<serial>/ (mqtt.topicroot =
+"iot/Hydroponic/{serial}" in their config), the gateway keeps the latest
+values of every controller in a table and publishes a compact fleet
+summary every interval seconds: how many controllers are online, which
+are offline or have an alarm, and min/mean/max of the configured metrics
+over all zones.
+
+A message costs a split of its topic, a float conversion and two dict
+updates. Memory is bounded: at most maxdevices controllers (the one that
+was silent longest goes first) with at most maxvalues values each.
+
+Run it with hydroponic_controller.py --gateway. Without broker it can be
+tried on simulated controllers and the broker stand in of hydro_sim:
+
+usage: hydro_gateway.py --simulate n [--rate r] [--seconds s]
+  --simulate  number of controllers
+  --rate      messages per second of every controller (default 4)
+  --seconds   simulated seconds (default 60)
+"""
+
+import time
+import json
+import random
+import argparse
+import threading
+from collections import OrderedDict
+
+#our own modules
+from hydro_logger import my_logger
+import hydro_globals
+import hydro_metrics
+from hydro_watchdog import SystemdNotifier
+
+__all__ = ['Gateway', 'DeviceState', 'rungateway']
+
+MAXVALUES = 64 #values kept per controller
+MAXTEXT = 64 #characters kept of a text value
+MAXLISTED = 50 #serials listed per offline or alarm entry of the summary
+
+GATEWAYMESSAGES = hydro_metrics.counter('hydro_gateway_messages_total', 'controller messages taken by the gateway')
+GATEWAYEVICTIONS = hydro_metrics.counter('hydro_gateway_evictions_total', 'controllers dropped from the full table')
+GATEWAYDEVICES = hydro_metrics.gauge('hydro_gateway_devices', 'controllers in the table')
+
+
+class DeviceState():
+    """latest values of one controller, name: float or text. Names are the
+    topics below the controller, e.g. AirTemp, tray2/Lux, Alarm/dryrun"""
+    __slots__ = ('serial', 'lastseen', 'messages', 'values')
+
+    def __init__(self, serial):
+        self.serial = serial
+        self.lastseen = 0.0 #unix time of the last live (not retained) message
+        self.messages = 0
+        self.values = {}
+
+
+class Gateway():
+    """state table of the controllers below prefix, summary() rolls it up"""
+    def __init__(self, prefix, summarytopic, metrics, stale=120.0, maxdevices=1000, maxvalues=MAXVALUES):
+        self.prefix = prefix + '/'
+        self.summarytopic = summarytopic
+        self.metrics = frozenset(metrics)
+        self.stale = stale #seconds of silence until a controller counts as offline
+        self.maxdevices = maxdevices
+        self.maxvalues = maxvalues
+        self.devices = OrderedDict() #serial: DeviceState, the longest silent first
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.dropped = 0 #values not stored, the controller had maxvalues already
+        GATEWAYDEVICES.setfunction(lambda: len(self.devices))
+
+
+    def subscriptions(self, qos=0):
+        return [(self.prefix + '+/#', qos)]
+
+
+    def attach(self, client):
+        '''subscribe with the paho client after every connect and take its messages'''
+        def on_connect(client, userdata, flags, rc, properties=None):
+            my_logger.info('Gateway connected with result code %s', rc)
+            client.subscribe(self.subscriptions())
+        client.on_connect = on_connect
+        client.on_message = lambda client, userdata, msg: self.onmessage(msg.topic, msg.payload, msg.retain)
+
+
+    def onmessage(self, topic, payload, retain=False, now=None):
+        '''take the value of a controller topic, returns False for other topics'''
+        if not topic.startswith(self.prefix) or topic == self.summarytopic or topic.startswith(self.summarytopic + '/'):
+            return False
+        serial, _, name = topic[len(self.prefix):].partition('/')
+        if not serial or not name or name.endswith('/reply'):
+            return False
+        try:
+            text = payload.decode('utf-8')
+        except UnicodeDecodeError:
+            return False
+        batch = None
+        if name == 'Telemetry' or name.endswith('/Telemetry'):
+            try:
+                batch = json.loads(text)
+            except ValueError:
+                return False
+            if not isinstance(batch, dict):
+                return False
+        if now is None:
+            now = time.time()
+        GATEWAYMESSAGES.inc()
+        with self.lock:
+            self.messages += 1
+            device = self.devices.get(serial)
+            if device is None:
+                device = self.devices[serial] = DeviceState(serial)
+                if len(self.devices) > self.maxdevices:
+                    self.devices.popitem(last=False)
+                    GATEWAYEVICTIONS.inc()
+            #retained messages may be from a controller that is long gone
+            if not retain:
+                device.lastseen = now
+                self.devices.move_to_end(serial)
+            device.messages += 1
+            if batch is None:
+                self.store(device, name, text)
+            else:
+                zone = name[:-len('Telemetry')]
+                for key, value in batch.items():
+                    if key != 'ts':
+                        self.store(device, zone + key, value)
+        return True
+
+
+    def store(self, device, name, value):
+        '''lock must be held'''
+        if isinstance(value, str):
+            try:
+                value = float(value)
+            except ValueError:
+                value = value[:MAXTEXT]
+        elif isinstance(value, (int, float)):
+            value = float(value)
+        else:
+            return
+        if name not in device.values and len(device.values) >= self.maxvalues:
+            self.dropped += 1
+            return
+        device.values[name] = value
+
+
+    def summary(self, now=None):
+        '''fleet rollup of the table, one pass over all values'''
+        if now is None:
+            now = time.time()
+        stats = {} #metric: [count, sum, min, max]
+        alarms = {} #alarm: set of serials
+        offline = []
+        with self.lock:
+            for device in self.devices.values():
+                if now - device.lastseen > self.stale:
+                    offline.append(device.serial)
+                    continue
+                for name, value in device.values.items():
+                    parts = name.rsplit('/', 2)
+                    if len(parts) > 1 and parts[-2] == 'Alarm':
+                        if value == 1.0:
+                            alarms.setdefault(parts[-1], set()).add(device.serial)
+                    elif parts[-1] in self.metrics and isinstance(value, float):
+                        entry = stats.get(parts[-1])
+                        if entry is None:
+                            stats[parts[-1]] = [1, value, value, value]
+                        else:
+                            entry[0] += 1
+                            entry[1] += value
+                            entry[2] = min(entry[2], value)
+                            entry[3] = max(entry[3], value)
+            devices = len(self.devices)
+            messages = self.messages
+        return {
+            "ts": int(now),
+            "devices": devices,
+            "online": devices - len(offline),
+            "offline": sorted(offline)[:MAXLISTED],
+            "alarms": {alarm: sorted(serials)[:MAXLISTED] for alarm, serials in alarms.items()},
+            "metrics": {name: {"n": count, "min": round(low, 2), "mean": round(total / count, 2), "max": round(high, 2)}
+                        for name, (count, total, low, high) in stats.items()},
+            "messages": messages,
+        }
+
+
+    def publish(self, client):
+        client.publish(self.summarytopic, json.dumps(self.summary(), separators=(',', ':')), retain=True)
+
+
+def rungateway(config):
+    '''the gateway mode of hydroponic_controller, returns when keep_running is cleared'''
+    import paho.mqtt.client as mqtt
+    settings = config.gateway
+    gateway = Gateway(settings.prefix, settings.summarytopic, settings.metrics, settings.stale, settings.maxdevices)
+    client = mqtt.Client(config.controller.serial + '-gateway', transport="tcp")
+    gateway.attach(client)
+    client.enable_logger()
+    client.reconnect_delay_set(min_delay=1, max_delay=120)
+    client.connect_async(config.mqtt.server, config.mqtt.port)
+    client.loop_start()
+    my_logger.info('Gateway for %s+ on %s:%d', gateway.prefix, config.mqtt.server, config.mqtt.port)
+    #hydro.service is Type=notify with WatchdogSec, the gateway runs under it too
+    notifier = SystemdNotifier()
+    notifier.notify('READY=1', 'STATUS=gateway')
+    tick = min(settings.interval, notifier.pinginterval or settings.interval)
+    due = time.monotonic() + settings.interval
+    try:
+        while hydro_globals.keep_running:
+            time.sleep(tick)
+            if notifier.pinginterval:
+                notifier.notify('WATCHDOG=1')
+            if time.monotonic() >= due:
+                due += settings.interval
+                if client.is_connected():
+                    gateway.publish(client)
+    finally:
+        notifier.notify('STOPPING=1')
+        client.disconnect()
+        client.loop_stop()
+
+
+def simulate(count, rate, seconds, seed=1):
+    '''count controllers sending rate messages per second each through the
+    broker stand in, as fast as it goes. Every 50th controller only left
+    retained values behind. Returns the gateway and the seconds it took'''
+    from hydro_sim import SimBroker
+    broker = SimBroker()
+    gateway = Gateway('iot/Hydroponic', 'iot/Hydroponic/fleet', ('AirTemp', 'AirRelHum', 'VPD', 'Lux', 'WaterPump'))
+    rnd = random.Random(seed)
+    names = ('AirTemp', 'AirRelHum', 'AirPress', 'VPD', 'DewPoint', 'Lux', 'WaterPump', 'TankEmpty')
+    controllers = [('HydroponicPi-%05d' % i, broker.client()) for i in range(count)]
+    for i, (serial, controller) in enumerate(controllers):
+        if i % 50 == 0:
+            controller.publish('iot/Hydroponic/%s/AirTemp' % serial, '20.0', retain=True)
+    #the gateway comes later and gets the retained values flagged as such
+    client = broker.client()
+    gateway.attach(client)
+    client.subscribe(gateway.subscriptions())
+    start = time.perf_counter()
+    for tick in range(int(seconds * rate)):
+        for i, (serial, controller) in enumerate(controllers):
+            if i % 50 == 0:
+                continue
+            name = names[(tick + i) % len(names)]
+            value = 0.0 if name in ('WaterPump', 'TankEmpty') else round(rnd.uniform(10.0, 30.0), 2)
+            if i % 97 == 0 and name == 'TankEmpty':
+                value = 1
+                controller.publish('iot/Hydroponic/%s/Alarm/dryrun' % serial, '1', retain=True)
+            controller.publish('iot/Hydroponic/%s/%s' % (serial, name), value)
+    return gateway, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='the fleet gateway on simulated controllers, without broker')
+    parser.add_argument('--simulate', type=int, default=300, metavar='N', help='number of controllers (default 300)')
+    parser.add_argument('--rate', type=float, default=4.0, help='messages per second of every controller (default 4)')
+    parser.add_argument('--seconds', type=float, default=60.0, help='simulated seconds (default 60)')
+    args = parser.parse_args()
+    count = args.simulate
+    my_logger.setLevel('WARNING')
+    gateway, elapsed = simulate(count, args.rate, args.seconds)
+    start = time.perf_counter()
+    summary = json.dumps(gateway.summary(), separators=(',', ':'))
+    summarytime = time.perf_counter() - start
+    print("{} controllers, {} messages in {:.2f} s: {:.1f} us per message ({:.0f} messages/s), broker included".format(
+        count, gateway.messages, elapsed, elapsed / max(gateway.messages, 1) * 1e6, gateway.messages / elapsed))
+    print("summary {:.1f} ms, {} bytes: {}".format(summarytime * 1000, len(summary), summary[:400]))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,8 +5,7 @@ Created on Fri Jul  1 22:10:18 2016
 @author: bernd
 """
 
-SERIAL = 'HydroponicPi-00001'
-MQTTSERVER = "192.168.168.112"
+#serial and mqtt server are in hydro_config
 
 global keep_running
 keep_running = True #to flag program exit to the threads
@@ -7,13 +7,40 @@ Created on Sat Mai  1 11:35:42 2021
 """
 
 import time
-import RPi.GPIO as GPIO
+import queue
+import threading
+from collections import namedtuple
 
 #our own modules
 from hydro_logger import my_logger
 import hydro_globals
-
-__all__ = ['GpioInterface']
+import hydro_hal
+import hydro_metrics
+
+GPIO = hydro_hal.getgpio() #RPi.GPIO or the simulated pins
+
+GPIOOPS = hydro_metrics.counter('hydro_gpio_ops_total', 'pin reads and writes that reach RPi.GPIO', ('op',))
+GPIOREADS = GPIOOPS.labels('input')
+GPIOWRITES = GPIOOPS.labels('output')
+GPIOEDGES = hydro_metrics.counter('hydro_gpio_edges_total', 'raw edges of the watched inputs, bounces included')
+GPIOEVENTS = hydro_metrics.counter('hydro_gpio_events_total', 'debounced input changes', ('kind',))
+PUMPSWITCHES = hydro_metrics.counter('hydro_pump_switches_total', 'water pump switch commands', ('zone', 'state'))
+PUMPON = hydro_metrics.gauge('hydro_pump_on', '1 while the water pump is switched on', ('zone',))
+
+__all__ = ['GpioInterface', 'GpioEventEngine', 'GpioEvent']
+
+#event kinds
+EVENT_SHUTDOWN = 'shutdown'
+EVENT_TANKLEVEL = 'tanklevel'
+EVENT_RETURNLEVEL = 'returnlevel'
+EVENT_BUTTONUP = 'buttonup'
+EVENT_BUTTONDOWN = 'buttondown'
+EVENT_BUTTONOK = 'buttonok'
+EVENT_BUTTONCANCEL = 'buttoncancel'
+EVENT_SENSOR = 'sensor' #inputs added with watchinput()
+
+#state is the logical state: button pressed or water level ok
+GpioEvent = namedtuple('GpioEvent', ['kind', 'pin', 'state', 'timestamp'])
 
 class GpioInterface():
     """interfaces digital i/o and spi"""
@@ -31,7 +58,18 @@ class GpioInterface():
 
 
 
-    def __init__(self):
+    def __init__(self, zones=()):
+        '''zones: pump and level pins of further grow trays, see hydro_zones'''
+        self.pumps = {GpioInterface.WATERPUMPOUTPUT: 'main'} #pin: zone name
+        self.levelinputs = {} #pin: (event kind, pin level of the active state) of further inputs
+        self.interlock = None #hydro_interlock.Interlock guarding the pumps
+        self.pumplisteners = []
+        for zone in zones:
+            self.pumps[zone.pump] = zone.name
+            if zone.tanklevel is not None and zone.tanklevel != GpioInterface.WATERTANKLEVELINPUT:
+                self.levelinputs[zone.tanklevel] = (EVENT_TANKLEVEL, GPIO.LOW)
+            if zone.returnlevel is not None and zone.returnlevel != GpioInterface.WATERLEVELRETURNINPUT:
+                self.levelinputs[zone.returnlevel] = (EVENT_RETURNLEVEL, GPIO.HIGH)
         try:
             GPIO.setwarnings(False)
             GPIO.setmode(GPIO.BOARD)
@@ -47,19 +85,34 @@ class GpioInterface():
             GPIO.setup(GpioInterface.BUTTONOK, GPIO.IN)
             GPIO.setup(GpioInterface.BUTTONCANCEL, GPIO.IN)
 
-            GPIO.output(GpioInterface.WATERPUMPOUTPUT, GPIO.LOW)
+            for pin in self.pumps:
+                GPIO.setup(pin, GPIO.OUT)
+                GPIO.output(pin, GPIO.LOW)
+            for pin in self.levelinputs:
+                GPIO.setup(pin, GPIO.IN)
             #GPIO.output(GpioInterface.STATUS1LED, GPIO.LOW)
             #GPIO.output(GpioInterface.STATUS2LED, GPIO.LOW)
 
         except Exception as e:
-            my_logger.critical("gpio init error " + str(e))
+            my_logger.critical("gpio init error %s", e)
             exit(1)
 
+        self.pincache = {} #filled by GpioEventEngine
+
+
+    def input(self, pin):
+        '''pin level, from the event engine cache if it watches the pin'''
+        level = self.pincache.get(pin)
+        if level is None:
+            GPIOREADS.inc()
+            return GPIO.input(pin)
+        return level
+
 
     def isshutdownpressed(self):
         '''poll shutdown pin'''
         try:
-            if GPIO.input(GpioInterface.SHUTDOWNBUTTON):
+            if self.input(GpioInterface.SHUTDOWNBUTTON):
                 return False
             else:
                 return True
@@ -70,6 +123,7 @@ class GpioInterface():
     def setheartbeatled(self, state):
         '''set heartbeat led pin'''
         try:
+            GPIOWRITES.inc()
             GPIO.output(GpioInterface.HEARTBEATLED, GPIO.LOW if state else GPIO.HIGH)
         except Exception:
             pass
@@ -78,6 +132,7 @@ class GpioInterface():
     def getheartbeatled(self):
         '''get heartbeat led pin, usefull for pin toggling'''
         try:
+            GPIOREADS.inc()
             return not GPIO.input(GpioInterface.HEARTBEATLED)
         except Exception:
             pass
@@ -101,28 +156,75 @@ class GpioInterface():
 
     def setwaterpump(self, state):
         '''set water pump relais pin'''
+        self.setpump(GpioInterface.WATERPUMPOUTPUT, state)
+
+
+    def getwaterpump(self):
         try:
+            GPIOREADS.inc()
+            return GPIO.input(GpioInterface.WATERPUMPOUTPUT)
+        except Exception:
+            return false
+
+
+    def watchinput(self, pin, kind, active=GPIO.LOW):
+        '''one more input for the GpioEventEngine, e.g. a leak sensor. Call
+        before the engine is created'''
+        if pin in GpioEventEngine.INPUTS or pin in self.levelinputs:
+            return
+        GPIO.setup(pin, GPIO.IN)
+        self.levelinputs[pin] = (kind, active)
+
+
+    def setpump(self, pin, state):
+        '''set the pump relais pin of a zone, if the interlock allows it'''
+        if self.interlock is not None:
+            self.interlock.request(pin, state, self.outputpump)
+        else:
+            self.outputpump(pin, state)
+
+
+    def outputpump(self, pin, state):
+        '''set the pump relais pin, no questions asked'''
+        zone = self.pumps.get(pin, str(pin))
+        try:
+            GPIOWRITES.inc()
+            PUMPSWITCHES.labels(zone, 'on' if state else 'off').inc()
             if state:
-                my_logger.debug(time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime()) + ' Water on')
-                GPIO.output(GpioInterface.WATERPUMPOUTPUT, GPIO.HIGH)
+                my_logger.debug('Water on %s', zone)
+                GPIO.output(pin, GPIO.HIGH)
             else:
-                my_logger.debug(time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime()) + ' Water off')
-                GPIO.output(GpioInterface.WATERPUMPOUTPUT, GPIO.LOW)
+                my_logger.debug('Water off %s', zone)
+                GPIO.output(pin, GPIO.LOW)
+            PUMPON.labels(zone).set(1 if state else 0)
         except Exception:
-            my_logger.error(time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime()) + ' Water switching error')
+            my_logger.error('Water switching error %s', zone)
+            return
+        #a failing listener must not keep the interlock from switching the next pump
+        for listener in self.pumplisteners:
+            try:
+                listener(pin, state)
+            except Exception:
+                my_logger.error('Pump listener error %s', zone, exc_info=True)
 
 
-    def getwaterpump(self):
+    def addpumplistener(self, func):
+        '''func(pin, state) is called after every pump switch, from the switching thread'''
+        self.pumplisteners.append(func)
+
+
+    def getpump(self, pin):
         try:
-            return GPIO.input(GpioInterface.WATERPUMPOUTPUT)
+            GPIOREADS.inc()
+            return GPIO.input(pin)
         except Exception:
-            return false
+            return False
 
 
     def isshutdownpressed(self):
         '''poll shutdown pin'''
         try:
-            if GPIO.input(GpioInterface.SHUTDOWNBUTTON):
+            if self.input(GpioInterface.SHUTDOWNBUTTON):
                 return False
             else:
                 return True
@@ -130,10 +232,10 @@ class GpioInterface():
             return False
 
 
-    def iswatertanklevelok(self):
+    def iswatertanklevelok(self, pin=WATERTANKLEVELINPUT):
         #pin high means level sensor is not asserted
         try:
-            if GPIO.input(GpioInterface.WATERTANKLEVELINPUT):
+            if self.input(pin):
                 return False
             else:
                 return True
@@ -141,10 +243,10 @@ class GpioInterface():
             return False
 
 
-    def iswaterreturnlevelok(self):
+    def iswaterreturnlevelok(self, pin=WATERLEVELRETURNINPUT):
         #water level is ok if no water is detected, so pin is high
         try:
-            if GPIO.input(GpioInterface.WATERLEVELRETURNINPUT):
+            if self.input(pin):
                 return True
             else:
                 return False
@@ -152,6 +254,137 @@ class GpioInterface():
             return True
 
 
+class GpioEventEngine():
+    """edge detection for the inputs of GpioInterface. Edges are debounced in
+    software, changes are put on a queue as GpioEvent and the pin levels are
+    cached in the GpioInterface, so its getters don't touch the hardware"""
+    #pin: (event kind, pin level of the active state)
+    INPUTS = {
+        GpioInterface.SHUTDOWNBUTTON: (EVENT_SHUTDOWN, GPIO.LOW),
+        GpioInterface.WATERTANKLEVELINPUT: (EVENT_TANKLEVEL, GPIO.LOW),
+        GpioInterface.WATERLEVELRETURNINPUT: (EVENT_RETURNLEVEL, GPIO.HIGH),
+        GpioInterface.BUTTONUP: (EVENT_BUTTONUP, GPIO.LOW),
+        GpioInterface.BUTTONDOWN: (EVENT_BUTTONDOWN, GPIO.LOW),
+        GpioInterface.BUTTONOK: (EVENT_BUTTONOK, GPIO.LOW),
+        GpioInterface.BUTTONCANCEL: (EVENT_BUTTONCANCEL, GPIO.LOW),
+    }
+
+    def __init__(self, gpio, debounce=0.02, events=None):
+        self.gpio = gpio
+        self.inputs = dict(GpioEventEngine.INPUTS)
+        self.inputs.update(gpio.levelinputs)
+        self.debounce = debounce
+        self.events = events if events is not None else queue.Queue()
+        self.listeners = []
+        self.pending = {} #pin: time when the level is considered stable
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name='gpioevents', daemon=True)
+        self.heartbeat = None #func(nextin) called every round, see hydro_watchdog
+        self.generation = 0 #restart() starts a new thread, the old one ends
+
+
+    def addlistener(self, func):
+        '''func(event) is called from the debounce thread for every event,
+        before the event is queued. Keep it short.'''
+        self.listeners.append(func)
+
+
+    def start(self, threaded=True):
+        '''watch the inputs. Without thread, runpending() has to be called'''
+        for pin in self.inputs:
+            self.gpio.pincache[pin] = GPIO.input(pin)
+            GPIO.add_event_detect(pin, GPIO.BOTH, callback=self.onedge)
+        if threaded:
+            self.thread.start()
+
+
+    def stop(self):
+        for pin in self.inputs:
+            try:
+                GPIO.remove_event_detect(pin)
+            except Exception:
+                pass
+            self.gpio.pincache.pop(pin, None)
+        with self.condition:
+            self.pending = None
+            self.condition.notify()
+
+
+    def restart(self):
+        '''re-arm the edge detection, check every input for changes that were
+        missed and start a new debounce thread, the old one may hang'''
+        for pin in self.inputs:
+            try:
+                GPIO.remove_event_detect(pin)
+            except Exception:
+                pass
+            GPIO.add_event_detect(pin, GPIO.BOTH, callback=self.onedge)
+            self.onedge(pin)
+        self.generation += 1
+        self.thread = threading.Thread(target=self.run, args=(self.generation,), name='gpioevents', daemon=True)
+        self.thread.start()
+
+
+    def onedge(self, pin):
+        '''RPi.GPIO callback, (re)starts the debounce period of the pin'''
+        GPIOEDGES.inc()
+        with self.condition:
+            if self.pending is not None:
+                self.pending[pin] = time.monotonic() + self.debounce
+                self.condition.notify()
+
+
+    def runpending(self):
+        '''update the pins that are stable now, returns seconds until the next
+        pin settles (None if none is bouncing)'''
+        with self.condition:
+            if not self.pending:
+                return None
+            now = time.monotonic()
+            stable = [pin for pin, due in self.pending.items() if due <= now]
+            for pin in stable:
+                del self.pending[pin]
+            wait = min(self.pending.values()) - now if self.pending else None
+        for pin in stable:
+            self.update(pin)
+        return wait
+
+
+    def run(self, generation=0):
+        while hydro_globals.keep_running and generation == self.generation:
+            if self.heartbeat is not None:
+                self.heartbeat(1.0)
+            with self.condition:
+                if self.pending is None:
+                    return
+                now = time.monotonic()
+                if not any(due <= now for due in self.pending.values()):
+                    self.condition.wait(min(self.pending.values()) - now if self.pending else 1.0)
+                    continue
+            self.runpending()
+
+
+    def update(self, pin):
+        try:
+            GPIOREADS.inc()
+            level = GPIO.input(pin)
+        except Exception as e:
+            my_logger.error('gpio read error %s', e)
+            return
+        if level == self.gpio.pincache.get(pin):
+            return #bounced back
+        self.gpio.pincache[pin] = level
+        kind, active = self.inputs[pin]
+        event = GpioEvent(kind, pin, level == active, time.time())
+        GPIOEVENTS.labels(kind).inc()
+        for listener in self.listeners:
+            try:
+                listener(event)
+            except Exception as e:
+                my_logger.error('gpio listener error %s', e)
+        self.events.put(event)
+
+
 def main():
     gpio = GpioInterface()
 
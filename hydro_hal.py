@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+hardware abstraction: the one place that decides whether the i2c bus, the
+gpio pins and the oled are the real ones or simulated (hydro_sim).
+The backend is taken from the environment variable HYDRO_BACKEND
+('hardware' or 'sim') and can be changed with select() before the device
+modules are imported. Nothing touches the hardware at import time.
+With the sim backend, HYDRO_TRACE may name a trace file (see hydro_sim)
+for the weather and the level switch events.
+"""
+
+import os
+
+__all__ = ['select', 'backend', 'simulation', 'getsmbus', 'getgpio', 'getoled']
+
+BACKEND_HARDWARE = 'hardware'
+BACKEND_SIM = 'sim'
+
+_backend = os.environ.get('HYDRO_BACKEND', BACKEND_HARDWARE)
+_simulation = None
+
+
+def select(name):
+    '''choose the backend, call before hydro_gpio is imported'''
+    global _backend
+    if name not in (BACKEND_HARDWARE, BACKEND_SIM):
+        raise ValueError("unknown backend " + str(name))
+    _backend = name
+
+
+def backend():
+    return _backend
+
+
+def simulation():
+    '''the simulated devices, created on first use'''
+    global _simulation
+    if _simulation is None:
+        import hydro_sim
+        _simulation = hydro_sim.Simulation()
+        trace = os.environ.get('HYDRO_TRACE')
+        if trace:
+            _simulation.loadtrace(trace)
+            _simulation.start()
+    return _simulation
+
+
+def getsmbus(busnumber):
+    '''smbus2 compatible bus object'''
+    if _backend == BACKEND_SIM:
+        return simulation().bus
+    import smbus2
+    return smbus2.SMBus(busnumber)
+
+
+def getgpio():
+    '''RPi.GPIO or a module like stand in'''
+    if _backend == BACKEND_SIM:
+        return simulation().gpio
+    import RPi.GPIO
+    return RPi.GPIO
+
+
+def getoled(i2cbus):
+    '''ssd1306 driver object on i2cbus'''
+    if _backend == BACKEND_SIM:
+        import hydro_sim
+        return hydro_sim.SimOled(i2cbus)
+    from lib_oled96 import ssd1306
+    return ssd1306(i2cbus)
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+local history of all sensor samples in sqlite (WAL mode).
+Samples are buffered in memory and written in batches to spare the sd card.
+Raw samples are rolled up into 1 minute and 1 hour min/max/mean tiers,
+every tier has its own retention.
+"""
+
+import time
+import sqlite3
+import threading
+
+#our own modules
+from hydro_logger import my_logger
+
+__all__ = ['HistoryStore']
+
+#tier name: (bucket seconds, retention seconds)
+TIERS = {
+    'raw': (0, 2 * 24 * 3600),
+    '1m': (60, 30 * 24 * 3600),
+    '1h': (3600, 2 * 365 * 24 * 3600),
+}
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS metrics (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS raw (metric INTEGER NOT NULL, ts REAL NOT NULL, value REAL NOT NULL,
+    PRIMARY KEY (metric, ts)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rollup_1m (metric INTEGER NOT NULL, bucket INTEGER NOT NULL,
+    min REAL, max REAL, sum REAL, count INTEGER, PRIMARY KEY (metric, bucket)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rollup_1h (metric INTEGER NOT NULL, bucket INTEGER NOT NULL,
+    min REAL, max REAL, sum REAL, count INTEGER, PRIMARY KEY (metric, bucket)) WITHOUT ROWID;
+'''
+
+MAXPENDING = 100000 #samples kept for the next try while flushing fails
+
+UPSERT = '''INSERT INTO rollup_{tier} (metric, bucket, min, max, sum, count) VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (metric, bucket) DO UPDATE SET min = MIN(min, excluded.min), max = MAX(max, excluded.max),
+    sum = sum + excluded.sum, count = count + excluded.count'''
+
+
+class HistoryStore():
+    """time series store, record() is cheap and thread safe, flush() writes a batch"""
+    def __init__(self, path, flushinterval=60.0, tiers=TIERS):
+        self.path = path
+        self.flushinterval = flushinterval
+        self.tiers = tiers
+        self.lock = threading.Lock() #pending samples
+        self.dblock = threading.Lock() #the connection is shared between threads
+        self.pending = [] #(metric name, ts, value)
+        self.lastflush = time.monotonic()
+        self.lastprune = 0.0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        self.metricids = dict((name, id) for id, name in self.db.execute('SELECT id, name FROM metrics'))
+
+
+    def metricid(self, name, new):
+        '''id of metric name, new ones are inserted and collected in new
+        {name: id}, they are cached only when the transaction committed'''
+        id = self.metricids.get(name) or new.get(name)
+        if id is None:
+            id = new[name] = self.db.execute('INSERT INTO metrics (name) VALUES (?)', (name,)).lastrowid
+        return id
+
+
+    def record(self, name, ts, value):
+        with self.lock:
+            self.pending.append((name, ts, value))
+
+
+    def recordsample(self, source, fields, sample):
+        '''record a hydro_sampler sample as metrics source.field'''
+        with self.lock:
+            for field, value in zip(fields, sample.values):
+                self.pending.append((source + '.' + field, sample.timestamp, value))
+
+
+    def isdue(self):
+        return time.monotonic() - self.lastflush >= self.flushinterval
+
+
+    def flush(self):
+        '''write the buffered samples and update the rollups in one transaction.
+        If that fails the samples stay pending (the newest MAXPENDING) and
+        the error is raised'''
+        with self.lock:
+            batch, self.pending = self.pending, []
+        self.lastflush = time.monotonic()
+        if not batch:
+            return 0
+
+        try:
+            count, new = self.write(batch)
+        except Exception:
+            with self.lock:
+                self.pending = (batch + self.pending)[-MAXPENDING:]
+            raise
+        self.metricids.update(new)
+
+        if time.monotonic() - self.lastprune > 3600:
+            self.prune()
+        return count
+
+
+    def write(self, batch):
+        '''one transaction, returns the number of samples and the new metrics'''
+        rows = []
+        rollups = {tier: {} for tier, (bucket, _) in self.tiers.items() if bucket}
+        new = {}
+        with self.dblock, self.db:
+            for name, ts, value in batch:
+                metric = self.metricid(name, new)
+                rows.append((metric, ts, value))
+                for tier, aggregates in rollups.items():
+                    key = (metric, int(ts // self.tiers[tier][0] * self.tiers[tier][0]))
+                    agg = aggregates.get(key)
+                    if agg is None:
+                        aggregates[key] = [value, value, value, 1]
+                    else:
+                        agg[0] = min(agg[0], value)
+                        agg[1] = max(agg[1], value)
+                        agg[2] += value
+                        agg[3] += 1
+            self.db.executemany('INSERT OR REPLACE INTO raw (metric, ts, value) VALUES (?, ?, ?)', rows)
+            for tier, aggregates in rollups.items():
+                self.db.executemany(UPSERT.format(tier=tier),
+                                    [key + tuple(agg) for key, agg in aggregates.items()])
+        return len(rows), new
+
+
+    def prune(self, now=None):
+        '''delete what is older than the retention of its tier'''
+        if now is None:
+            now = time.time()
+        self.lastprune = time.monotonic()
+        with self.dblock, self.db:
+            for tier, (bucket, retention) in self.tiers.items():
+                if bucket:
+                    self.db.execute('DELETE FROM rollup_%s WHERE bucket < ?' % tier, (now - retention,))
+                else:
+                    self.db.execute('DELETE FROM raw WHERE ts < ?', (now - retention,))
+
+
+    def tierfor(self, span):
+        '''finest tier that keeps the number of points reasonable'''
+        if span <= 6 * 3600:
+            return 'raw'
+        if span <= 7 * 24 * 3600:
+            return '1m'
+        return '1h'
+
+
+    def query(self, name, start, end=None, tier=None):
+        '''points of metric name between start and end (unix time). raw gives
+        (ts, value), the rollup tiers give (bucket, min, max, mean)'''
+        if end is None:
+            end = time.time()
+        if tier is None:
+            tier = self.tierfor(end - start)
+        id = self.metricids.get(name)
+        if id is None:
+            return []
+        with self.dblock:
+            if tier == 'raw':
+                return self.db.execute('SELECT ts, value FROM raw WHERE metric = ? AND ts >= ? AND ts <= ? ORDER BY ts',
+                                       (id, start, end)).fetchall()
+            return self.db.execute('SELECT bucket, min, max, sum / count FROM rollup_%s WHERE metric = ? AND bucket >= ? AND bucket <= ? ORDER BY bucket' % tier,
+                                   (id, start - self.tiers[tier][0], end)).fetchall()
+
+
+    def last(self, name):
+        '''newest flushed raw point (ts, value) of metric name, None if there is none'''
+        id = self.metricids.get(name)
+        if id is None:
+            return None
+        with self.dblock:
+            return self.db.execute('SELECT ts, value FROM raw WHERE metric = ? ORDER BY ts DESC LIMIT 1', (id,)).fetchone()
+
+
+    def close(self):
+        try:
+            self.flush()
+        except Exception as e:
+            my_logger.error('History flush error %s', e)
+        self.db.close()
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+one shared i2c bus for all devices (bme280, bh1750, oled)
+"""
+
+import time
+import threading
+import smbus2
+
+#our own modules
+import hydro_hal
+import hydro_metrics
+
+I2CSECONDS = hydro_metrics.histogram('hydro_i2c_transaction_seconds', 'i2c transaction latency', ('addr',))
+I2CERRORS = hydro_metrics.counter('hydro_i2c_errors_total', 'failed i2c transactions', ('addr',))
+I2CRESETS = hydro_metrics.counter('hydro_i2c_resets_total', 'bus resets after a hung transaction')
+
+__all__ = ['I2CBus', 'bus']
+
+
+class DeviceStats():
+    """transaction counters of one i2c address"""
+    def __init__(self, addr):
+        self.latency = I2CSECONDS.labels('0x%02X' % addr)
+        self.failures = I2CERRORS.labels('0x%02X' % addr)
+        self.transactions = 0
+        self.errors = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.maxseconds = 0.0
+
+
+    def asdict(self):
+        return {"transactions": self.transactions, "errors": self.errors, "bytes": self.bytes,
+                "seconds": self.seconds, "maxseconds": self.maxseconds}
+
+
+class I2CBus():
+    """owns the one smbus2 file descriptor, serializes transactions with a lock
+    and records count and latency per device. Has the smbus2 methods used by
+    our modules, so it is a drop in replacement for smbus2.SMBus"""
+    def __init__(self, busnumber=1):
+        self.busnumber = busnumber
+        self.smbus = None
+        self.lock = threading.RLock()
+        self.devicestats = {}
+
+
+    def open(self):
+        with self.lock:
+            if self.smbus is None:
+                self.smbus = hydro_hal.getsmbus(self.busnumber)
+            return self.smbus
+
+
+    def close(self):
+        with self.lock:
+            if self.smbus is not None:
+                try:
+                    self.smbus.close()
+                finally:
+                    self.smbus = None
+
+
+    def reopen(self):
+        '''close and open the file descriptor, e.g. after a bus hang'''
+        with self.lock:
+            self.close()
+            return self.open()
+
+
+    def reset(self):
+        '''new lock and file descriptor after a transaction hung. Doesn't wait
+        for the lock, the hung thread keeps the old one and its transaction
+        fails or returns whenever the driver lets it'''
+        I2CRESETS.inc()
+        smbus, self.smbus = self.smbus, None
+        self.lock = threading.RLock()
+        if smbus is not None:
+            try:
+                smbus.close()
+            except Exception:
+                pass
+        return self.open()
+
+
+    def transfer(self, addr, nbytes, func):
+        '''run func(smbus) as one transaction with addr while holding the lock'''
+        with self.lock:
+            smbus = self.smbus or self.open()
+            stats = self.devicestats.get(addr)
+            if stats is None:
+                stats = self.devicestats[addr] = DeviceStats(addr)
+            start = time.perf_counter()
+            try:
+                return func(smbus)
+            except Exception:
+                stats.errors += 1
+                stats.failures.inc()
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                stats.latency.observe(elapsed)
+                stats.transactions += 1
+                stats.bytes += nbytes
+                stats.seconds += elapsed
+                if elapsed > stats.maxseconds:
+                    stats.maxseconds = elapsed
+
+
+    def read_byte(self, addr):
+        return self.transfer(addr, 1, lambda smbus: smbus.read_byte(addr))
+
+
+    def write_byte(self, addr, value):
+        return self.transfer(addr, 1, lambda smbus: smbus.write_byte(addr, value))
+
+
+    def read_byte_data(self, addr, register):
+        return self.transfer(addr, 1, lambda smbus: smbus.read_byte_data(addr, register))
+
+
+    def write_byte_data(self, addr, register, value):
+        return self.transfer(addr, 1, lambda smbus: smbus.write_byte_data(addr, register, value))
+
+
+    def read_i2c_block_data(self, addr, register, length):
+        return self.transfer(addr, length, lambda smbus: smbus.read_i2c_block_data(addr, register, length))
+
+
+    def write_i2c_block_data(self, addr, register, data):
+        return self.transfer(addr, len(data), lambda smbus: smbus.write_i2c_block_data(addr, register, data))
+
+
+    def i2c_rdwr(self, *msgs):
+        '''combined transaction, counted for the address of the first message'''
+        return self.transfer(msgs[0].addr, sum(msg.len for msg in msgs), lambda smbus: smbus.i2c_rdwr(*msgs))
+
+
+    def readblocks(self, addr, blocks):
+        '''read several register blocks [(register, length), ...] of one device
+        in a single combined transaction (repeated start between the blocks)'''
+        msgs = []
+        for register, length in blocks:
+            msgs.append(smbus2.i2c_msg.write(addr, [register]))
+            msgs.append(smbus2.i2c_msg.read(addr, length))
+        self.i2c_rdwr(*msgs)
+        return [list(msg) for msg in msgs[1::2]]
+
+
+    def stats(self):
+        '''copy of the per device statistics, keyed by address'''
+        with self.lock:
+            return {addr: stats.asdict() for addr, stats in self.devicestats.items()}
+
+
+    def resetstats(self):
+        with self.lock:
+            self.devicestats = {}
+
+
+    def summary(self):
+        return ", ".join("0x{:02X}: {} trans {} err {:.1f} ms".format(
+            addr, s["transactions"], s["errors"], s["seconds"] * 1000) for addr, s in sorted(self.stats().items()))
+
+
+# Rev 2 Pi, Pi 2 & Pi 3 uses bus 1, Rev 1 Pi uses bus 0.
+# The file descriptor is opened on the first transaction.
+bus = I2CBus(1)
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+pump interlocks: a rule trips when its input pin is at the trip level
+(empty tank, full return, a leak or flow switch) and keeps the pumps it
+guards off. It is evaluated on every debounced level change, in the gpio
+event thread, so a running pump is stopped a few ms after the debounce.
+A tripped rule is released when its input is back for holdoff seconds and
+the pump has been off for at least minoff seconds, then the pumps go back
+to what the scheduler (or mqtt) asked for.
+
+The rules are compiled into a table pin: [(trip level, rule bit)] and one
+bit mask per pump, so an event costs a dict lookup and some bit operations,
+however many sensors there are.
+"""
+
+import time
+import threading
+from collections import namedtuple
+
+#our own modules
+from hydro_logger import my_logger
+import hydro_metrics
+
+__all__ = ['Interlock', 'Rule', 'zonerules', 'configrules']
+
+INTERLOCKTRIPS = hydro_metrics.counter('hydro_interlock_trips_total', 'interlock rules tripped', ('rule',))
+INTERLOCKACTIVE = hydro_metrics.gauge('hydro_interlock_active', '1 while the interlock rule holds its pumps off', ('rule',))
+PUMPINHIBITS = hydro_metrics.counter('hydro_pump_inhibits_total', 'pump on requests refused by an interlock')
+
+#name: unique, alarm: topic below the zone, pumps: pump pins the rule stops
+Rule = namedtuple('Rule', ['name', 'alarm', 'pin', 'triplevel', 'pumps', 'holdoff'])
+
+
+def zonerules(zone, holdoff):
+    '''dry run and overflow protection of a zone with level switches'''
+    rules = []
+    if zone.tanklevel is not None:
+        #tank switch reads high when the water is below it
+        rules.append(Rule(zone.key('dryrun'), 'dryrun', zone.tanklevel, 1, (zone.pump,), holdoff))
+    if zone.returnlevel is not None:
+        #return switch reads low when the water reaches it
+        rules.append(Rule(zone.key('overflow'), 'overflow', zone.returnlevel, 0, (zone.pump,), holdoff))
+    return rules
+
+
+class Interlock():
+    """guards the pump outputs of a GpioInterface. Attach it with
+    gpio.interlock = interlock, then every GpioInterface.setpump() goes
+    through request() and the rules are checked with the output change
+    under one lock."""
+    def __init__(self, gpio, rules, minoff=0.0):
+        self.gpio = gpio
+        self.minoff = minoff
+        self.lock = threading.RLock()
+        self.listeners = []
+        self.compile(rules)
+
+
+    def compile(self, rules):
+        '''evaluation table of the rules, starts from the current pin levels'''
+        with self.lock:
+            self.rules = list(rules)
+            if len(set(rule.name for rule in self.rules)) != len(self.rules):
+                raise ValueError("interlock rule names have to be unique")
+            self.table = {} #pin: [(trip level, bit)]
+            self.masks = {} #pump pin: bits of the rules that guard it
+            for i, rule in enumerate(self.rules):
+                self.table.setdefault(rule.pin, []).append((rule.triplevel, 1 << i))
+                for pump in rule.pumps:
+                    self.masks[pump] = self.masks.get(pump, 0) | (1 << i)
+            self.tripped = 0 #bits of the rules whose input is at the trip level
+            self.latched = 0 #tripped, or not released yet
+            self.releases = {} #bit: monotonic time of the release
+            self.stoptimes = {} #pump pin: monotonic time of the last forced stop
+            self.requested = {} #pump pin: state the scheduler or mqtt wants
+        for pin in self.table:
+            self.evaluate(pin, self.gpio.input(pin))
+
+
+    def addlistener(self, func):
+        '''func(rule, active) is called when a rule starts or stops holding its
+        pumps off, from the thread that noticed it'''
+        self.listeners.append(func)
+
+
+    def allows(self, pump):
+        return not (self.latched & self.masks.get(pump, 0))
+
+
+    def active(self):
+        '''rules holding their pumps off'''
+        return [rule for i, rule in enumerate(self.rules) if self.latched & (1 << i)]
+
+
+    def request(self, pump, state, switch):
+        '''switch(pump, state) unless a rule forbids switching on'''
+        with self.lock:
+            self.requested[pump] = state
+            if state and not self.allows(pump):
+                PUMPINHIBITS.inc()
+                my_logger.warning('Pump %d inhibited by %s', pump,
+                                  ', '.join(rule.name for rule in self.active() if pump in rule.pumps))
+                switch(pump, False)
+                return False
+            switch(pump, state)
+            return state
+
+
+    def onevent(self, event):
+        '''GpioEventEngine listener'''
+        if event.pin in self.table:
+            self.evaluate(event.pin, self.gpio.input(event.pin))
+
+
+    def evaluate(self, pin, level):
+        '''new level of an input pin'''
+        changes = []
+        with self.lock:
+            now = time.monotonic()
+            for triplevel, bit in self.table.get(pin, ()):
+                if level == triplevel:
+                    if self.tripped & bit:
+                        continue
+                    self.tripped |= bit
+                    self.releases.pop(bit, None)
+                    if not self.latched & bit:
+                        self.latched |= bit
+                        changes.append((bit, True))
+                elif self.tripped & bit:
+                    self.tripped &= ~bit
+                    self.releases[bit] = now + self.rules[bit.bit_length() - 1].holdoff
+            if changes:
+                self.stoppumps(changes, now)
+        self.notify(changes)
+        return self.nextrelease()
+
+
+    def stoppumps(self, changes, now):
+        '''force the pumps of newly tripped rules off, lock must be held'''
+        for bit, _ in changes:
+            rule = self.rules[bit.bit_length() - 1]
+            INTERLOCKTRIPS.labels(rule.name).inc()
+            my_logger.warning('Interlock %s tripped', rule.name)
+            for pump in rule.pumps:
+                if self.gpio.getpump(pump):
+                    self.gpio.outputpump(pump, False)
+                    self.stoptimes[pump] = now
+
+
+    def runpending(self):
+        '''release the rules whose holdoff and minimum off time passed, returns
+        seconds until the next release (None if none is pending)'''
+        changes = []
+        with self.lock:
+            now = time.monotonic()
+            for bit, due in list(self.releases.items()):
+                rule = self.rules[bit.bit_length() - 1]
+                due = max([due] + [self.stoptimes.get(pump, -self.minoff) + self.minoff for pump in rule.pumps])
+                if due > now:
+                    self.releases[bit] = due
+                    continue
+                del self.releases[bit]
+                self.latched &= ~bit
+                changes.append((bit, False))
+                my_logger.warning('Interlock %s released', rule.name)
+                for pump in rule.pumps:
+                    if self.requested.get(pump) and self.allows(pump):
+                        self.gpio.outputpump(pump, True)
+        self.notify(changes)
+        return self.nextrelease()
+
+
+    def nextrelease(self):
+        with self.lock:
+            if not self.releases:
+                return None
+            return max(0.0, min(self.releases.values()) - time.monotonic())
+
+
+    def notify(self, changes):
+        for bit, active in changes:
+            rule = self.rules[bit.bit_length() - 1]
+            INTERLOCKACTIVE.labels(rule.name).set(1 if active else 0)
+            for listener in self.listeners:
+                try:
+                    listener(rule, active)
+                except Exception as e:
+                    my_logger.error('interlock listener error %s', e)
+
+
+def configrules(config, zones):
+    '''the rules of all zones and of the [[interlocks]] in the config'''
+    rules = []
+    for zone in zones:
+        rules.extend(zonerules(zone, config.interlock.holdoff))
+    for entry in config.interlocks:
+        pumps = tuple(zone.pump for zone in zones if not entry.zones or zone.name in entry.zones)
+        holdoff = entry.holdoff if entry.holdoff is not None else config.interlock.holdoff
+        rules.append(Rule(entry.name, entry.name, entry.pin, entry.triplevel, pumps, holdoff))
+    return rules
@@ -3,23 +3,155 @@
 Created on Fri Jul  1 21:50:14 2016
 
 @author: bernd
+
+logging pipeline: my_logger only puts records on a queue, a listener
+thread formats them (timestamp included) and writes the log file in
+batches, every FLUSHINTERVAL seconds or right away for errors.
+Call sites use lazy %-style arguments, my_logger.debug("Water %s", state),
+so filtered messages cost nothing but the level check.
+The level can be changed at runtime with setlevel(), e.g. from mqtt.
 """
 
+import os
+import time
+import queue
+import atexit
 import logging
 import logging.handlers
 
-__all__ = ['my_logger']
+__all__ = ['my_logger', 'setlevel', 'setflushinterval', 'setlogfile', 'listener']
+
+LOGFILE = '/home/pi/work/hydroponic/hydro.log'
+LOGLEVEL = os.environ.get('HYDRO_LOGLEVEL', 'DEBUG')
+FLUSHINTERVAL = float(os.environ.get('HYDRO_LOGFLUSH', 5.0)) #seconds between writes of the log file
+TIMEFORMAT = "%a, %d %b %Y %H:%M:%S +0000"
+
+
+class BatchingFileHandler(logging.handlers.RotatingFileHandler):
+    """rotating log file that hands its buffer to the os only every
+    flushinterval seconds or for records of flushlevel and above, so the
+    sd card sees few large writes instead of one per line"""
+    def __init__(self, filename, flushinterval=FLUSHINTERVAL, flushlevel=logging.ERROR, **kwargs):
+        self.flushinterval = flushinterval
+        self.flushlevel = flushlevel
+        self.lastflush = time.monotonic()
+        self.urgent = False
+        super().__init__(filename, **kwargs)
+
+
+    def emit(self, record):
+        self.urgent = record.levelno >= self.flushlevel
+        super().emit(record)
+
+
+    def flush(self):
+        '''called after every record, only writes when due'''
+        if self.urgent or time.monotonic() - self.lastflush >= self.flushinterval:
+            self.flushnow()
+
+
+    def flushnow(self):
+        self.acquire()
+        try:
+            if self.stream is not None:
+                self.stream.flush()
+            self.lastflush = time.monotonic()
+            self.urgent = False
+        finally:
+            self.release()
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """puts the record on the queue with its message merged (getMessage(),
+    msg % args) in the calling thread, so later changes of the argument
+    objects don't show up in the log. The record is not formatted there,
+    time, level and traceback text are added by the formatter of the
+    listener thread."""
+    def prepare(self, record):
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+class LogListener(logging.handlers.QueueListener):
+    """writes the queued records, wakes up at least every flushinterval
+    to write out what the batching handlers hold back"""
+    TICK = object() #dequeue() result when nothing came in (None is the stop sentinel)
+
+    def __init__(self, logqueue, *handlers, flushinterval=FLUSHINTERVAL):
+        super().__init__(logqueue, *handlers, respect_handler_level=True)
+        self.flushinterval = flushinterval
+
+
+    def dequeue(self, block):
+        try:
+            return self.queue.get(block, self.flushinterval)
+        except queue.Empty:
+            return LogListener.TICK
+
+
+    def handle(self, record):
+        if record is LogListener.TICK:
+            for handler in self.handlers:
+                if isinstance(handler, BatchingFileHandler):
+                    handler.flush()
+            return
+        super().handle(record)
+
+
+def setlevel(level):
+    '''change the level at runtime, level is a name like 'INFO' or a number'''
+    if isinstance(level, str):
+        level = level.strip().upper()
+        if not isinstance(logging.getLevelName(level), int):
+            raise ValueError("unknown log level " + level)
+    my_logger.setLevel(level)
+
+
+def setflushinterval(seconds):
+    listener.flushinterval = seconds
+    for handler in listener.handlers:
+        if isinstance(handler, BatchingFileHandler):
+            handler.flushinterval = seconds
+
+
+def openhandler(path):
+    try:
+        handler = BatchingFileHandler(path, mode='a', maxBytes=300000, backupCount=2, encoding=None, delay=0)
+    except Exception:
+        #in case we run unit tests whíle the application is running
+        handler = logging.StreamHandler()
+    handler.setFormatter(formatter)
+    return handler
+
+
+def setlogfile(path):
+    '''write the log to path from now on'''
+    global handler
+    if isinstance(handler, BatchingFileHandler) and handler.baseFilename == os.path.abspath(path):
+        return
+    old, handler = handler, openhandler(path)
+    listener.handlers = (handler,)
+    old.close()
+
+
+formatter = logging.Formatter('%(asctime)s %(message)s', TIMEFORMAT)
+formatter.converter = time.gmtime
+handler = openhandler(LOGFILE)
+
+logqueue = queue.SimpleQueue()
+listener = LogListener(logqueue, handler)
+listener.start()
 
 my_logger = logging.getLogger('MyLogger')
-#my_logger.setLevel(logging.INFO)
-my_logger.setLevel(logging.DEBUG)
-
-#handler = logging.handlers.WatchedFileHandler('/var/log/syslog')
-try:
-    handler = logging.handlers.RotatingFileHandler('/home/pi/work/hydroponic/hydro.log', mode='a', maxBytes=300000, backupCount=2, encoding=None, delay=0)
-    my_logger.addHandler(handler)
-except Exception:
-    #in case we run unit tests whíle the application is running
-    handler = logging.StreamHandler()
-    my_logger.addHandler(handler)
+setlevel(LOGLEVEL)
+my_logger.addHandler(LazyQueueHandler(logqueue))
+
 
+@atexit.register
+def _stoplistener():
+    '''write what is still queued or buffered'''
+    listener.stop()
+    if isinstance(handler, BatchingFileHandler):
+        handler.flushnow()
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+instrumentation: counters, gauges and histograms in one registry.
+Updating a metric costs a lock and an addition. The registry is rendered
+in the prometheus text format (served on /metrics by MetricsServer) and as
+a dict for the mqtt self-metrics.
+Modules create their metrics at import with counter(), gauge() and
+histogram(). For labeled metrics keep the labels() child in hot paths.
+"""
+
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+#our own modules
+from hydro_logger import my_logger
+
+__all__ = ['Counter', 'Gauge', 'Histogram', 'Registry', 'MetricsServer', 'registry',
+           'counter', 'gauge', 'histogram']
+
+#seconds, from a single i2c transaction up to a slow task
+TIMEBUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+               0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _CounterValue():
+    __slots__ = ('lock', 'value')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class _GaugeValue():
+    __slots__ = ('lock', 'value', 'func')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+        self.func = None
+
+
+    def set(self, value):
+        self.value = value
+
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+    def setfunction(self, func):
+        '''read the value from func() when exported, e.g. a queue length'''
+        self.func = func
+
+
+    def get(self):
+        if self.func is not None:
+            try:
+                return self.func()
+            except Exception:
+                return float('nan')
+        return self.value
+
+
+class _HistogramValue():
+    __slots__ = ('lock', 'bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.lock = threading.Lock()
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) #per bucket, the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+
+    def quantile(self, q):
+        '''upper bound of the bucket that holds quantile q, None if empty'''
+        with self.lock:
+            counts, count = list(self.counts), self.count
+        if count == 0:
+            return None
+        rank = q * count
+        total = 0
+        for bound, n in zip(self.bounds + (float('inf'),), counts):
+            total += n
+            if total >= rank:
+                return bound
+        return float('inf')
+
+
+class _Metric():
+    """common part: name, help text and one child value per label values"""
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.children = {}
+        if not self.labelnames:
+            self.children[()] = self.newchild()
+
+
+    def newchild(self):
+        raise NotImplementedError
+
+
+    def labels(self, *values):
+        '''the child for these label values'''
+        values = tuple(str(value) for value in values)
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(self.name + " needs labels " + str(self.labelnames))
+            with self.lock:
+                child = self.children.setdefault(values, self.newchild())
+        return child
+
+
+    def items(self):
+        with self.lock:
+            return list(self.children.items())
+
+
+    def labelstring(self, values, extra=''):
+        pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(self.labelnames, values)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def newchild(self):
+        return _CounterValue()
+
+
+    def inc(self, amount=1):
+        self.children[()].inc(amount)
+
+
+    def expose(self):
+        return ['%s%s %s' % (self.name, self.labelstring(values), _number(child.value)) for values, child in self.items()]
+
+
+    def snapshot(self, child):
+        return child.value
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def newchild(self):
+        return _GaugeValue()
+
+
+    def set(self, value):
+        self.children[()].set(value)
+
+
+    def inc(self, amount=1):
+        self.children[()].inc(amount)
+
+
+    def dec(self, amount=1):
+        self.children[()].dec(amount)
+
+
+    def setfunction(self, func):
+        self.children[()].setfunction(func)
+
+
+    def expose(self):
+        return ['%s%s %s' % (self.name, self.labelstring(values), _number(child.get())) for values, child in self.items()]
+
+
+    def snapshot(self, child):
+        return child.get()
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=TIMEBUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames)
+
+
+    def newchild(self):
+        return _HistogramValue(self.buckets)
+
+
+    def observe(self, value):
+        self.children[()].observe(value)
+
+
+    def expose(self):
+        lines = []
+        for values, child in self.items():
+            with child.lock:
+                counts, total, count = list(child.counts), child.sum, child.count
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                lines.append('%s_bucket%s %d' % (self.name, self.labelstring(values, 'le="%s"' % _number(bound)), cumulative))
+            lines.append('%s_sum%s %s' % (self.name, self.labelstring(values), _number(total)))
+            lines.append('%s_count%s %d' % (self.name, self.labelstring(values), count))
+        return lines
+
+
+    def snapshot(self, child):
+        return {"count": child.count, "sum": child.sum, "p50": child.quantile(0.5), "p95": child.quantile(0.95)}
+
+
+class Registry():
+    """all metrics of the process by name"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+
+    def register(self, metric):
+        '''add metric, or return the one registered before under its name'''
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                if existing.kind != metric.kind:
+                    raise ValueError(metric.name + " is already a " + existing.kind)
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+
+    def exposition(self):
+        '''prometheus text format'''
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+    def snapshot(self):
+        '''{name: value} for unlabeled metrics, {name: {"label,values": value}} otherwise'''
+        with self.lock:
+            metrics = list(self.metrics.values())
+        result = {}
+        for metric in metrics:
+            if metric.labelnames:
+                result[metric.name] = {','.join(values): metric.snapshot(child) for values, child in metric.items()}
+            else:
+                result[metric.name] = metric.snapshot(metric.children[()])
+        return result
+
+
+registry = Registry()
+
+
+def counter(name, help, labelnames=()):
+    return registry.register(Counter(name, help, labelnames))
+
+
+def gauge(name, help, labelnames=()):
+    return registry.register(Gauge(name, help, labelnames))
+
+
+def histogram(name, help, labelnames=(), buckets=TIMEBUCKETS):
+    return registry.register(Histogram(name, help, labelnames, buckets))
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.exposition().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        pass #scrapes every few seconds would flood the log
+
+
+class MetricsServer():
+    """serves GET /metrics from a daemon thread"""
+    def __init__(self, port=9101, address='', registry=registry):
+        self.port = port
+        self.address = address
+        self.registry = registry
+        self.server = None
+        self.thread = None
+
+
+    def start(self):
+        self.server = ThreadingHTTPServer((self.address, self.port), _MetricsHandler)
+        self.server.daemon_threads = True
+        self.server.registry = self.registry
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True)
+        self.thread.start()
+        my_logger.info('Metrics on port %d', self.server.server_address[1])
+
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
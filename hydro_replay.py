@@ -0,0 +1,264 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+replay harness: runs the controller on the simulated devices of hydro_sim
+with a virtual clock, as fast as the cpu allows. Sampler, gpio debouncing,
+pump scheduler, telemetry, history and display are stepped from one loop,
+the clock jumps to whatever is due next. Sensors follow a weather curve or
+a recorded trace, the level switch events come from the trace.
+
+usage: hydro_replay.py [--days d] [--trace file.jsonl|trace.bin | --history history.db]
+                       [--sampleinterval s] [--seed n] [--nodisplay] [--config hydro.toml]
+  --trace           trace file, see hydro_sim.readtrace, or a raw data trace of hydro_trace
+  --history         replay what the controller recorded (1 minute tier)
+  --sampleinterval  e.g. 10 for a quick soak test of a week, default is the
+                    controller's 1 s
+  --nodisplay       skip the oled, font rendering is most of the run time
+  --config          controller config, for the zones and intervals
+"""
+
+import time
+import queue
+import argparse
+
+#our own modules
+import hydro_hal
+hydro_hal.select('sim') #before the device modules are imported
+from hydro_logger import my_logger
+from hydro_gpio import GpioInterface, GpioEventEngine, EVENT_SHUTDOWN
+from hydro_i2c import bus as i2cbus
+from hydro_scheduler import Scheduler
+from hydro_history import HistoryStore
+from hydro_display import Display
+from hydro_zones import makezones
+import hydro_config
+from hydro_sim import SimMqttClient, WeatherCurve, TraceWeather
+import hydroponic_controller as controller
+
+__all__ = ['VirtualClock', 'Replay', 'historytrace']
+
+
+class VirtualClock():
+    """replaces time.time, time.monotonic and time.sleep while it is active.
+    Only for single threaded use, other threads would see the jumps too."""
+    def __init__(self, start=None):
+        self.wall = time.time() if start is None else start
+        self.mono = 1000.0
+        self.saved = None
+
+
+    def time(self):
+        return self.wall
+
+
+    def monotonic(self):
+        return self.mono
+
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+
+    def advance(self, seconds):
+        if seconds > 0:
+            self.wall += seconds
+            self.mono += seconds
+
+
+    def __enter__(self):
+        self.saved = (time.time, time.monotonic, time.sleep)
+        time.time, time.monotonic, time.sleep = self.time, self.monotonic, self.sleep
+        return self
+
+
+    def __exit__(self, *args):
+        time.time, time.monotonic, time.sleep = self.saved
+
+
+def historytrace(path, start=None, end=None):
+    '''weather points and level events from a history database, shifted so
+    that the recording starts at time 0. Returns (points, events, seconds)'''
+    history = HistoryStore(path)
+    try:
+        if start is None:
+            rows = history.db.execute('SELECT MIN(bucket), MAX(bucket) FROM rollup_1m').fetchone()
+            if rows[0] is None:
+                raise ValueError("no data in " + path)
+            start, end = rows[0], rows[1] + 60
+        points = {}
+        for field, metric in (('temp', 'air.temp'), ('press', 'air.press'), ('hum', 'air.hum'), ('lux', 'light.lux')):
+            points[field] = [(bucket - start, mean) for bucket, _, _, mean in history.query(metric, start, end, '1m')]
+        events = []
+        for metric, pin, activelevel in (('tank.empty', GpioInterface.WATERTANKLEVELINPUT, 1),
+                                         ('return.full', GpioInterface.WATERLEVELRETURNINPUT, 0)):
+            last = None
+            for ts, value in history.query(metric, start, end, 'raw'):
+                if value != last:
+                    events.append((ts - start, pin, activelevel if value else 1 - activelevel))
+                    last = value
+        return points, events, end - start
+    finally:
+        history.close()
+
+
+class Replay():
+    """the controller wired up like hydroponic_controller.main(), with the
+    periodic tasks of runcontroller() stepped on the virtual clock"""
+    def __init__(self, clock, sampleinterval=None, display=True):
+        self.clock = clock
+        self.sim = hydro_hal.simulation()
+        config = hydro_config.get()
+        self.zones = makezones(config.zones, hydro_config.topicroot(config))
+        #level switches of further zones start with the water where it should be
+        for zone in self.zones:
+            for pin, level in ((zone.tanklevel, 0), (zone.returnlevel, 1)):
+                if pin is not None:
+                    self.sim.gpio.levels.setdefault(pin, level)
+        self.gpio = GpioInterface(self.zones)
+        self.interlock = controller.initinterlock(config, self.zones, self.gpio)
+        self.gpioevents = GpioEventEngine(self.gpio, events=queue.Queue())
+        self.gpioevents.addlistener(self.interlock.onevent)
+        self.gpioevents.start(threaded=False)
+        self.scheduler = Scheduler(None)
+        controller.addpumpschedules(self.scheduler, self.zones, self.gpio)
+        self.display = Display(hydro_hal.getoled(i2cbus)) if display else None
+        if self.display is not None:
+            self.display.showinit()
+        self.history = HistoryStore(':memory:', config.intervals.historyflush)
+        self.sampler = controller.initsampler(self.history, self.zones, sampleinterval)
+        controller.boostsampling(self.gpio, self.sampler, self.zones)
+        self.mqttclient = SimMqttClient()
+        self.telemetries = {zone.name: controller.inittelemetry(self.mqttclient, zone, self.interlock) for zone in self.zones}
+        self.trips = {} #rule name: count
+        self.interlock.addlistener(self.onalarm)
+        self.readings = {}
+        self.gpiocount = 0
+        self.shutdown = False
+        now = time.monotonic()
+        #[due, interval, func] like the runner.every() calls of runcontroller.
+        #No heartbeat led, it would make the clock step every second
+        self.jobs = [
+            [now, config.intervals.publish, lambda: controller.publishzones(self.zones, self.telemetries, self.gpio, self.sampler,
+                                                       self.scheduler, self.history, self.readings)],
+            [now + config.intervals.historyflush, config.intervals.historyflush, self.history.flush],
+        ]
+        if self.display is not None:
+            self.jobs.append([now + 0.2, config.intervals.display, lambda: controller.refreshdisplay(self.display, self.readings, self.zones)])
+
+
+    def onalarm(self, rule, active):
+        if active:
+            self.trips[rule.name] = self.trips.get(rule.name, 0) + 1
+        controller.publishalarm(rule, active, self.zones, self.telemetries)
+
+
+    def handleevents(self):
+        while True:
+            try:
+                event = self.gpioevents.events.get_nowait()
+            except queue.Empty:
+                return
+            self.gpiocount += 1
+            if event.kind == EVENT_SHUTDOWN and event.state:
+                self.shutdown = True #the real handler would power off the pi
+            else:
+                controller.handlegpioevent(event, self.gpio, self.mqttclient, self.zones, self.telemetries)
+
+
+    def step(self):
+        '''run everything that is due, returns seconds until the next thing is'''
+        self.sim.gpio.advance(time.time())
+        waits = [self.gpioevents.runpending()]
+        self.handleevents()
+        waits.append(self.interlock.runpending())
+        waits.append(self.sampler.runpending())
+        waits.append(self.scheduler.runpending())
+        now = time.monotonic()
+        for job in self.jobs:
+            if job[0] <= now:
+                job[2]()
+                job[0] += job[1]
+            waits.append(job[0] - now)
+        if self.display is not None:
+            self.display.runpending()
+        script = self.sim.gpio.nextevent()
+        if script is not None:
+            waits.append(script - time.time())
+        return max(0.0, min(wait for wait in waits if wait is not None))
+
+
+    def run(self, seconds):
+        end = time.monotonic() + seconds
+        while not self.shutdown:
+            wait = self.step()
+            if time.monotonic() + wait > end:
+                break
+            self.clock.advance(wait)
+        self.history.flush()
+
+
+    def report(self, seconds, elapsed):
+        lines = ["simulated {:.2f} days in {:.1f} s ({:.0f}x real time)".format(seconds / 86400, elapsed, seconds / elapsed)]
+        for name, source in self.sampler.sources.items():
+            lines.append("samples {}: {} ({} errors)".format(name, source.buffer.count, source.errors))
+        for zone in self.zones:
+            lines.append("pump switches {}: {}".format(zone.name, self.sim.gpio.switches.get(zone.pump, 0)))
+        lines.append("gpio events: {}".format(self.gpiocount))
+        for name, count in self.trips.items():
+            lines.append("interlock {}: {} trips".format(name, count))
+        lines.append("mqtt: {} messages, {} bytes".format(self.mqttclient.messages, self.mqttclient.bytes))
+        if self.display is not None:
+            stats = self.display.stats()
+            lines.append("display: {} frames, {} bytes, {:.1f} ms render".format(stats["frames"], stats["bytessent"], stats["rendertime"] * 1000))
+        lines.append("i2c: " + i2cbus.summary())
+        count = self.history.db.execute('SELECT COUNT(*) FROM raw').fetchone()[0]
+        lines.append("history: {} raw rows".format(count))
+        return "\n".join(lines)
+
+
+def parseargs(argv=None):
+    parser = argparse.ArgumentParser(description='run the controller on simulated devices with a virtual clock')
+    parser.add_argument('--days', type=float, help='simulated days (default 7, or the length of --history)')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--trace', help='trace file, see hydro_sim.readtrace, or a raw data trace of hydro_trace')
+    source.add_argument('--history', help='replay what the controller recorded (1 minute tier)')
+    parser.add_argument('--sampleinterval', type=float,
+                        help="e.g. 10 for a quick soak test of a week, default is the controller's 1 s")
+    parser.add_argument('--seed', type=int, default=1, help='seed of the weather curve (default 1)')
+    parser.add_argument('--nodisplay', action='store_true', help='skip the oled, font rendering is most of the run time')
+    parser.add_argument('--config', help='controller config, for the zones and intervals')
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parseargs()
+    days = args.days if args.days is not None else 7.0
+    if args.config:
+        hydro_config.activate(hydro_config.load(args.config))
+    my_logger.setLevel('WARNING') #the debug log of a week would dominate the run time
+
+    #start at midnight (utc) of a fixed day, so runs are repeatable
+    with VirtualClock(1767225600.0) as clock:
+        sim = hydro_hal.simulation()
+        sim.origin = clock.time() #the simulation was created at import, on the real clock
+        sim.setweather(WeatherCurve(seed=args.seed))
+        seconds = days * 86400
+        if args.trace:
+            sim.loadtrace(args.trace)
+        elif args.history:
+            points, events, seconds = historytrace(args.history)
+            if args.days is not None:
+                seconds = days * 86400
+            sim.setweather(TraceWeather({field: [(sim.origin + t, v) for t, v in series]
+                                         for field, series in points.items()}))
+            sim.gpio.addscript([(sim.origin + t, pin, level) for t, pin, level in events])
+
+        start = time.perf_counter()
+        replay = Replay(clock, args.sampleinterval, not args.nodisplay)
+        replay.run(seconds)
+        elapsed = time.perf_counter() - start
+    print(replay.report(seconds, elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+background sampling of the i2c sensors into fixed size ring buffers,
+so the main loop never has to wait for the bus. A source can have a
+hydro_filters.SampleFilter, then the buffer holds the filtered and derived
+values and dropped samples are only counted. A source with a
+hydro_adaptive.AdaptiveRate gets its interval from it after every sample.
+"""
+
+import time
+import threading
+from array import array
+from collections import namedtuple
+
+#our own modules
+from hydro_logger import my_logger
+import hydro_metrics
+
+__all__ = ['Sample', 'RingBuffer', 'Sampler']
+
+Sample = namedtuple('Sample', ['timestamp', 'values'])
+
+READSECONDS = hydro_metrics.histogram('hydro_sensor_read_seconds', 'sensor read latency', ('source',))
+READERRORS = hydro_metrics.counter('hydro_sensor_errors_total', 'failed sensor reads', ('source',))
+READREJECTS = hydro_metrics.counter('hydro_sensor_rejects_total', 'samples dropped by the filters', ('source',))
+SAMPLEINTERVAL = hydro_metrics.gauge('hydro_sensor_interval_seconds', 'current sampling interval', ('source',))
+
+
+class RingBuffer():
+    """fixed size ring buffer of timestamped samples, backed by arrays of doubles"""
+    def __init__(self, capacity, fields):
+        self.capacity = capacity
+        self.fields = tuple(fields)
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.columns = [array('d', bytes(8 * capacity)) for _ in self.fields]
+        self.count = 0 #total number of appended samples
+        self.lock = threading.Lock()
+
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+
+    def append(self, timestamp, values):
+        with self.lock:
+            index = self.count % self.capacity
+            self.timestamps[index] = timestamp
+            for column, value in zip(self.columns, values):
+                column[index] = value
+            self.count += 1
+
+
+    def latest(self):
+        '''newest sample or None if empty'''
+        with self.lock:
+            if self.count == 0:
+                return None
+            index = (self.count - 1) % self.capacity
+            return Sample(self.timestamps[index], tuple(column[index] for column in self.columns))
+
+
+    def window(self, seconds=None, count=None, now=None):
+        '''samples of the last seconds and/or the last count samples, oldest first'''
+        if now is None:
+            now = time.time()
+        with self.lock:
+            n = min(self.count, self.capacity)
+            if count is not None:
+                n = min(n, count)
+            samples = []
+            for i in range(self.count - n, self.count):
+                index = i % self.capacity
+                if seconds is not None and self.timestamps[index] < now - seconds:
+                    continue
+                samples.append(Sample(self.timestamps[index], tuple(column[index] for column in self.columns)))
+            return samples
+
+
+class _Source():
+    def __init__(self, name, readfunc, interval, fields, capacity, setup, pipeline, policy):
+        self.name = name
+        self.readfunc = readfunc
+        self.interval = interval
+        self.pipeline = pipeline
+        self.buffer = RingBuffer(capacity, fields if pipeline is None else pipeline.fields)
+        self.policy = policy
+        if policy is not None:
+            policy.bind(self.buffer.fields)
+            self.interval = policy.interval
+        self.setup = setup
+        self.needsetup = setup is not None
+        self.errors = 0
+        self.rejects = 0
+        self.due = 0.0
+        self.latency = READSECONDS.labels(name)
+        self.failures = READERRORS.labels(name)
+        self.rejected = READREJECTS.labels(name)
+        self.intervalgauge = SAMPLEINTERVAL.labels(name)
+        self.intervalgauge.set(self.interval)
+
+
+class Sampler(threading.Thread):
+    """polls sensors from a background thread, every source has its own
+    interval and ring buffer"""
+    def __init__(self, capacity=600):
+        super().__init__(name='sampler', daemon=True)
+        self.capacity = capacity
+        self.sources = {}
+        self.listeners = []
+        self.stopped = threading.Event()
+        self.wakeup = threading.Event()
+        self.heartbeat = None #func(nextin) called every round, see hydro_watchdog
+        self.generation = 0 #revive() starts a new one, the old thread ends
+
+
+    def addsource(self, name, readfunc, interval, fields, capacity=None, setup=None, pipeline=None, policy=None):
+        '''readfunc returns one value or a tuple of values matching fields.
+        setup is called before the first read and again after a read error.
+        pipeline is a SampleFilter of fields, its fields are the source's then.
+        policy is an AdaptiveRate, then interval is only the starting value'''
+        self.sources[name] = _Source(name, readfunc, interval, fields, capacity or self.capacity, setup, pipeline, policy)
+
+
+    def setinterval(self, interval, name=None):
+        '''new sampling interval of source name or of all sources, the
+        fast one of adaptive sources'''
+        for source in self.sources.values():
+            if name is None or source.name == name:
+                if source.policy is not None:
+                    source.policy.fast = interval
+                    source.policy.slow = max(source.policy.slow, interval)
+                    source.policy.interval = max(source.policy.interval, interval)
+                    interval = source.policy.interval
+                source.interval = interval
+                source.intervalgauge.set(interval)
+
+
+    def boost(self, seconds, names=None):
+        '''adaptive sources (all or those in names) sample fast for seconds,
+        starting right now. Any thread may call it'''
+        until = time.time() + seconds
+        now = time.monotonic()
+        for source in self.sources.values():
+            if source.policy is not None and (names is None or source.name in names):
+                source.policy.boost(until)
+                source.interval = source.policy.interval
+                source.due = min(source.due, now)
+        self.wakeup.set()
+
+
+    def addlistener(self, func):
+        '''func(name, fields, sample) is called from the sampler thread for every new sample'''
+        self.listeners.append(func)
+
+
+    def buffer(self, name):
+        return self.sources[name].buffer
+
+
+    def latest(self, name, maxage=None):
+        '''newest sample of source name, None if there is none or it is older
+        than maxage plus the current interval of the source'''
+        source = self.sources[name]
+        sample = source.buffer.latest()
+        if sample is None or (maxage is not None and time.time() - sample.timestamp > maxage + source.interval):
+            return None
+        return sample
+
+
+    def window(self, name, seconds=None, count=None):
+        return self.sources[name].buffer.window(seconds, count)
+
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+
+
+    def revive(self):
+        '''new sampler thread after the old one hung in a read, the sensors
+        are set up again. The old thread ends when its read returns'''
+        self.generation += 1
+        for source in self.sources.values():
+            source.needsetup = source.setup is not None
+        threading.Thread(target=self.run, args=(self.generation,), name='sampler', daemon=True).start()
+
+
+    def stale(self, generation):
+        '''True in a thread that revive() has replaced'''
+        return generation is not None and generation != self.generation
+
+
+    def sample(self, source, generation=None):
+        '''generation of the calling thread, None without thread'''
+        try:
+            if source.needsetup:
+                source.setup()
+                source.needsetup = False
+            start = time.perf_counter()
+            values = source.readfunc()
+            if self.stale(generation):
+                return #the read hung, the new thread owns the source now
+            source.latency.observe(time.perf_counter() - start)
+            if not isinstance(values, tuple):
+                values = (values,)
+            timestamp = time.time()
+            if source.pipeline is not None:
+                values = source.pipeline.process(timestamp, values)
+                if values is None:
+                    source.rejects += 1
+                    source.rejected.inc()
+                    my_logger.debug("Sampler %s sample dropped", source.name)
+                    return
+            source.buffer.append(timestamp, values)
+            if self.listeners:
+                sample = Sample(timestamp, values)
+                for listener in self.listeners:
+                    listener(source.name, source.buffer.fields, sample)
+            if source.policy is not None:
+                interval = source.policy.update(timestamp, values)
+                if interval != source.interval:
+                    my_logger.debug("Sampler %s every %.1f s", source.name, interval)
+                    source.interval = interval
+                    source.intervalgauge.set(interval)
+        except Exception as e:
+            if self.stale(generation):
+                return
+            source.errors += 1
+            source.failures.inc()
+            source.needsetup = source.setup is not None
+            my_logger.debug("Sampler %s err: %s", source.name, e)
+
+
+    def runpending(self, generation=None):
+        '''sample every source that is due, returns seconds until the next one'''
+        if not self.sources:
+            return 1.0
+        now = time.monotonic()
+        for source in self.sources.values():
+            if source.due <= now:
+                self.sample(source, generation)
+                if self.stale(generation):
+                    break #revived while this thread hung in the read
+                #keep the cadence, after a stall one interval from now, no catching up
+                source.due += source.interval
+                if source.due <= now:
+                    source.due = now + source.interval
+        return max(0.0, min(s.due for s in self.sources.values()) - time.monotonic())
+
+
+    def run(self, generation=0):
+        while not self.stopped.is_set() and generation == self.generation:
+            wait = self.runpending(generation)
+            if self.stale(generation):
+                return #no heartbeat for the new thread
+            if self.heartbeat is not None:
+                self.heartbeat(wait)
+            self.wakeup.wait(wait)
+            self.wakeup.clear()
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+on/off cycle scheduler for the pump (and later lights, fans, ...).
+One long lived thread waits for the earliest deadline of all schedules on
+the monotonic clock. The phase of every schedule is saved to a state file,
+so a restart resumes the cycle instead of starting over.
+"""
+
+import os
+import json
+import time
+import heapq
+import threading
+
+#our own modules
+from hydro_logger import my_logger
+
+__all__ = ['Scheduler', 'Schedule']
+
+
+class Schedule():
+    """on/off cycle of one output, durations in seconds"""
+    def __init__(self, name, onseconds, offseconds, switchfunc):
+        self.name = name
+        self.onseconds = onseconds
+        self.offseconds = offseconds
+        self.switchfunc = switchfunc
+        self.ison = False
+        self.phasestart = 0.0 #monotonic time of the last switch
+        self.generation = 0 #invalidates old heap entries
+
+
+    def duration(self):
+        return self.onseconds if self.ison else self.offseconds
+
+
+    def deadline(self):
+        return self.phasestart + self.duration()
+
+
+class Scheduler(threading.Thread):
+    """runs all schedules from one thread with a heap of deadlines"""
+    def __init__(self, statefile=None):
+        super().__init__(name='scheduler', daemon=True)
+        self.statefile = statefile
+        self.schedules = {}
+        self.heap = []
+        self.seq = 0
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.changed = False
+        self.savedstate = self.loadstate()
+
+
+    def loadstate(self):
+        if self.statefile is None or not os.path.exists(self.statefile):
+            return {}
+        try:
+            with open(self.statefile) as f:
+                return json.load(f)
+        except Exception as e:
+            my_logger.error('Scheduler state file error %s', e)
+            return {}
+
+
+    def savestate(self):
+        '''write the phases to the state file, wall clock based to survive a reboot'''
+        if self.statefile is None:
+            return
+        now = time.monotonic()
+        wallnow = time.time()
+        with self.condition:
+            state = {name: {"ison": s.ison, "phaseend": wallnow + s.deadline() - now}
+                     for name, s in self.schedules.items()}
+        try:
+            tmpfile = self.statefile + '.tmp'
+            with open(tmpfile, 'w') as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmpfile, self.statefile)
+        except Exception as e:
+            my_logger.error('Scheduler state save error %s', e)
+
+
+    def push(self, schedule):
+        '''(re)arm the deadline of schedule, lock must be held'''
+        schedule.generation += 1
+        self.seq += 1
+        heapq.heappush(self.heap, (schedule.deadline(), self.seq, schedule.name, schedule.generation))
+        self.changed = True
+        self.condition.notify()
+
+
+    def add(self, name, onseconds, offseconds, switchfunc, startison=True):
+        '''add a schedule and switch its output. A saved phase is resumed,
+        otherwise the cycle starts with startison. The durations are always
+        the ones given here, a saved phase is cut to them'''
+        schedule = Schedule(name, onseconds, offseconds, switchfunc)
+        now = time.monotonic()
+        schedule.ison = startison
+        schedule.phasestart = now
+
+        saved = self.savedstate.get(name)
+        if saved is not None:
+            schedule.ison = saved["ison"]
+            remaining = saved["phaseend"] - time.time()
+            period = schedule.onseconds + schedule.offseconds
+            if remaining < 0 and period > 0:
+                #skip the phases that passed while we were down
+                overdue = -remaining % period
+                nextduration = schedule.offseconds if schedule.ison else schedule.onseconds
+                if overdue < nextduration:
+                    schedule.ison = not schedule.ison
+                    remaining = nextduration - overdue
+                else:
+                    remaining = period - overdue
+            remaining = max(0.0, min(remaining, schedule.duration()))
+            schedule.phasestart = now - (schedule.duration() - remaining)
+            my_logger.info('Scheduler resumes %s %s for %d s', name, 'on' if schedule.ison else 'off', remaining)
+
+        with self.condition:
+            self.schedules[name] = schedule
+            self.push(schedule)
+        switchfunc(schedule.ison)
+        self.savestate()
+        return schedule
+
+
+    def setdurations(self, name, onseconds=None, offseconds=None):
+        '''change the cycle, the running phase is shortened or extended right away'''
+        with self.condition:
+            schedule = self.schedules[name]
+            if onseconds is not None:
+                schedule.onseconds = onseconds
+            if offseconds is not None:
+                schedule.offseconds = offseconds
+            self.push(schedule)
+        self.savestate()
+
+
+    def ison(self, name):
+        return self.schedules[name].ison
+
+
+    def remaining(self, name):
+        '''seconds until the next switch of schedule name'''
+        with self.condition:
+            return max(0.0, self.schedules[name].deadline() - time.monotonic())
+
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+
+    def runpending(self):
+        '''switch the schedules whose deadline passed, returns seconds until
+        the next deadline or None if there is none'''
+        while True:
+            with self.condition:
+                self.changed = False
+                now = time.monotonic()
+                if not self.heap:
+                    return None
+                deadline, _, name, generation = self.heap[0]
+                schedule = self.schedules[name]
+                if generation != schedule.generation:
+                    heapq.heappop(self.heap) #outdated entry
+                    continue
+                if deadline > now:
+                    return deadline - now
+                heapq.heappop(self.heap)
+                schedule.ison = not schedule.ison
+                #next phase starts at the deadline, so cycles don't drift
+                schedule.phasestart = deadline if now - deadline < schedule.duration() else now
+                self.push(schedule)
+                switchfunc, ison = schedule.switchfunc, schedule.ison
+
+            try:
+                switchfunc(ison)
+            except Exception as e:
+                my_logger.error('Scheduler switch error %s %s', name, e)
+            self.savestate()
+
+
+    def run(self):
+        while True:
+            wait = self.runpending()
+            with self.condition:
+                if self.stopped:
+                    return
+                if not self.changed: #no new deadline since runpending looked
+                    self.condition.wait(wait)
@@ -0,0 +1,704 @@
+# -*- coding: utf-8 -*-
+"""
+simulated hardware for running the controller off the pi (see hydro_hal):
+ - bme280 and bh1750 on register level, the raw adc values follow a weather
+   curve or a recorded trace, so the real drivers and compensation are used
+ - ssd1306 framebuffer plus a driver with the lib_oled96 interface
+ - RPi.GPIO stand in, inputs are switched by a script of level events
+ - mqtt client that counts what is published, and a broker that passes
+   the messages of such clients on to their subscribers
+All devices read the time with time.time() on every access, so the replay
+harness can run them on a virtual clock.
+"""
+
+import time
+import math
+import json
+import bisect
+import ctypes
+import random
+import struct
+import threading
+from collections import namedtuple
+from PIL import Image, ImageDraw
+
+#our own modules
+from hydro_logger import my_logger
+from hydro_display import framepages
+from hydro_commands import TopicTrie, checkfilter
+from hydro_trace import istrace, tracepoints
+import bme280
+import bh1750
+
+__all__ = ['WeatherCurve', 'TraceWeather', 'SimBus', 'SimBME280', 'SimBH1750', 'SimSSD1306',
+           'SimOled', 'SimGPIO', 'SimMqttClient', 'SimBroker', 'Simulation', 'readtrace']
+
+OLEDADDR = 0x3C
+BME280ADDR2 = 0x77 #SDO pulled high
+BH1750ADDR2 = 0x5C #ADDR pulled high
+I2C_M_RD = 0x0001 #read flag of an i2c_msg
+
+#board pin: level at start. Shutdown button released, tank and return level ok
+INPUTLEVELS = {36: 1, 16: 0, 18: 1}
+
+
+def rawframe(temp_raw, pres_raw, hum_raw):
+    '''8 byte bme280 data frame of the raw adc values'''
+    return bytes([(pres_raw >> 12) & 0xFF, (pres_raw >> 4) & 0xFF, (pres_raw << 4) & 0xF0,
+                  (temp_raw >> 12) & 0xFF, (temp_raw >> 4) & 0xFF, (temp_raw << 4) & 0xF0,
+                  (hum_raw >> 8) & 0xFF, hum_raw & 0xFF])
+
+
+def calibrationregisters():
+    '''bme280 calibration registers with the typical data sheet values'''
+    cal1 = struct.pack('<HhhHhhhhhhhh', 27504, 26435, -1000,
+                       36477, -10685, 3024, 2855, 140, -7, 15500, -14600, 6000)
+    h4, h5 = 313, 50
+    cal3 = struct.pack('<hBbBbb', 362, 0, h4 >> 4, (h4 & 0x0F) | ((h5 & 0x0F) << 4), h5 >> 4, 30)
+    registers = {}
+    registers.update({0x88 + i: b & 0xFF for i, b in enumerate(cal1)})
+    registers[0xA1] = 75
+    registers.update({0xE1 + i: b & 0xFF for i, b in enumerate(cal3)})
+    return registers
+
+
+class WeatherCurve():
+    """synthetic grow room climate: temperature and humidity follow the day
+    (humidity drops when it gets warm), pressure drifts over several days and
+    the grow light is switched by the clock. The noise is seeded per minute,
+    so a run gives the same values no matter how it is stepped."""
+    def __init__(self, temp=22.0, tempswing=3.0, hum=60.0, humswing=10.0, press=1013.0, pressswing=8.0,
+                 lux=12000.0, lightson=6, lightsoff=22, noise=0.2, seed=1):
+        self.temp = temp
+        self.tempswing = tempswing
+        self.hum = hum
+        self.humswing = humswing
+        self.press = press
+        self.pressswing = pressswing
+        self.lux = lux
+        self.lightson = lightson
+        self.lightsoff = lightsoff
+        self.noise = noise
+        self.seed = seed
+        self.cache = (None, None)
+
+
+    def jitter(self, t):
+        minute = int(t // 60)
+        if self.cache[0] != minute:
+            rnd = random.Random(self.seed * 1000003 + minute)
+            self.cache = (minute, tuple(rnd.gauss(0.0, self.noise) for _ in range(4)))
+        return self.cache[1]
+
+
+    def values(self, t):
+        '''(degC, hPa, %rH, lux) at unix time t'''
+        hour = (t % 86400) / 3600.0
+        daily = math.cos(2 * math.pi * (hour - 15.0) / 24.0) #warmest at 15:00
+        jt, jp, jh, jl = self.jitter(t)
+        temp = self.temp + self.tempswing * daily + jt
+        hum = min(100.0, max(0.0, self.hum - self.humswing * daily + 5 * jh))
+        press = self.press + self.pressswing * math.sin(2 * math.pi * t / (5 * 86400)) + jp
+        lux = max(0.0, self.lux * (1.0 + 0.05 * jl)) if self.lightson <= hour < self.lightsoff else 0.0
+        return temp, press, hum, lux
+
+
+class TraceWeather():
+    """weather from recorded points, linear between them. points is
+    {field: [(unix time, value), ...]} for the fields temp, press, hum, lux"""
+    FIELDS = ('temp', 'press', 'hum', 'lux')
+    DEFAULTS = (22.0, 1013.0, 60.0, 0.0)
+
+    def __init__(self, points):
+        self.series = []
+        for field, default in zip(TraceWeather.FIELDS, TraceWeather.DEFAULTS):
+            series = sorted(points.get(field, ())) or [(0.0, default)]
+            self.series.append(([t for t, _ in series], [v for _, v in series]))
+
+
+    def values(self, t):
+        result = []
+        for times, values in self.series:
+            i = bisect.bisect_right(times, t)
+            if i == 0:
+                result.append(values[0])
+            elif i == len(times):
+                result.append(values[-1])
+            else:
+                t0, t1 = times[i - 1], times[i]
+                result.append(values[i - 1] + (values[i] - values[i - 1]) * (t - t0) / (t1 - t0))
+        return tuple(result)
+
+
+def readtrace(path, origin):
+    '''read a trace file, one json object per line with t in seconds from the
+    start and any of temp, press, hum, lux or a level event pin, level.
+    Returns (points for TraceWeather, [(unix time, pin, level), ...])'''
+    points = {}
+    events = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            record = json.loads(line)
+            t = origin + float(record["t"])
+            if "pin" in record:
+                events.append((t, int(record["pin"]), int(record["level"])))
+            for field in TraceWeather.FIELDS:
+                if field in record:
+                    points.setdefault(field, []).append((t, float(record[field])))
+    return points, events
+
+
+class SimBME280():
+    """bme280 registers: id, calibration, control and the data frame. A write
+    to ctrl_meas in forced mode measures once, in normal mode every read of
+    the data registers sees the weather of that moment."""
+    def __init__(self, weather):
+        self.weather = weather
+        self.registers = bytearray(256)
+        self.reset()
+        cal = calibrationregisters()
+        self.calibration = bme280.decodeCalibration([cal[0x88 + i] for i in range(24)], [cal[0xA1]],
+                                                    [cal[0xE1 + i] for i in range(7)])
+        self.pointer = 0
+        self.measurements = 0
+        self.lastvalues = None
+        self.lastframe = None
+        #raw values of a typical reading and how much the results change per raw count
+        self.lastraw = (519888, 415148, 30000)
+        base = bme280.compensate(self.calibration, rawframe(*self.lastraw))
+        self.slopes = tuple((bme280.compensate(self.calibration, rawframe(*[r + (1000 if i == j else 0)
+                             for j, r in enumerate(self.lastraw)]))[i] - base[i]) / 1000.0 for i in range(3))
+
+
+    def reset(self):
+        self.registers[:] = bytes(256)
+        for register, value in calibrationregisters().items():
+            self.registers[register] = value
+        self.registers[bme280.REG_ID] = 0x60
+        self.registers[bme280.REG_DATA:bme280.REG_DATA + 8] = rawframe(0x80000, 0x80000, 0x8000)
+
+
+    def encode(self, temp, press, hum):
+        '''raw frame that compensates to the given values. Newton steps with
+        fixed slopes, starting from the last frame, usually converge in 2 or 3'''
+        key = (round(temp, 2), round(press, 2), round(hum, 2))
+        if key == self.lastvalues:
+            return self.lastframe
+        targets = (temp, press, min(100.0, max(0.0, hum)))
+        raw = self.lastraw
+        for _ in range(8):
+            values = bme280.compensate(self.calibration, rawframe(*raw))
+            errors = [target - value for target, value in zip(targets, values)]
+            if all(abs(error) < 0.01 for error in errors):
+                break
+            raw = tuple(min(limit, max(0, int(round(r + error / slope))))
+                        for r, error, slope, limit in zip(raw, errors, self.slopes, (0xFFFFF, 0xFFFFF, 0xFFFF)))
+        self.lastraw = raw
+        self.lastvalues = key
+        self.lastframe = rawframe(*raw)
+        return self.lastframe
+
+
+    def measure(self):
+        temp, press, hum, _ = self.weather.values(time.time())
+        self.registers[bme280.REG_DATA:bme280.REG_DATA + 8] = self.encode(temp, press, hum)
+        self.measurements += 1
+
+
+    def write(self, data):
+        '''register address, then register/value pairs like the chip expects'''
+        self.pointer = data[0]
+        for register, value in zip(data[0::2], data[1::2]):
+            if register == 0xE0 and value == 0xB6:
+                self.reset()
+                continue
+            if register == bme280.REG_CONTROL and (value & 0x03) in (bme280.MODE_FORCED, 2):
+                self.measure()
+                value &= 0xFC #back to sleep after the measurement
+            self.registers[register] = value
+
+
+    def read(self, length):
+        if self.pointer == bme280.REG_DATA and self.registers[bme280.REG_CONTROL] & 0x03 == bme280.MODE_NORMAL:
+            self.measure()
+        data = bytes(self.registers[self.pointer:self.pointer + length])
+        self.pointer = (self.pointer + length) & 0xFF
+        return data
+
+
+class SimBH1750():
+    """bh1750 command set, the result register holds lux * 1.2 (* 2 in the
+    high resolution 2 modes) of the weather"""
+    CONTINUOUS = (bh1750.CONTINUOUS_HIGH_RES_MODE_1, bh1750.CONTINUOUS_HIGH_RES_MODE_2,
+                  bh1750.CONTINUOUS_LOW_RES_MODE)
+    ONETIME = (bh1750.ONE_TIME_HIGH_RES_MODE_1, bh1750.ONE_TIME_HIGH_RES_MODE_2,
+               bh1750.ONE_TIME_LOW_RES_MODE)
+
+    def __init__(self, weather):
+        self.weather = weather
+        self.powered = False
+        self.mode = None
+        self.counts = 0
+        self.measurements = 0
+
+
+    def measure(self):
+        lux = self.weather.values(time.time())[3]
+        factor = 2.4 if self.mode in (bh1750.CONTINUOUS_HIGH_RES_MODE_2, bh1750.ONE_TIME_HIGH_RES_MODE_2) else 1.2
+        self.counts = min(0xFFFF, int(round(lux * factor)))
+        self.measurements += 1
+
+
+    def write(self, data):
+        for command in data:
+            if command == bh1750.POWER_DOWN:
+                self.powered = False
+            elif command == bh1750.POWER_ON:
+                self.powered = True
+            elif command == bh1750.RESET:
+                self.counts = 0
+            elif command in SimBH1750.CONTINUOUS or command in SimBH1750.ONETIME:
+                self.mode = command
+                self.powered = True
+                self.measure()
+                if command in SimBH1750.ONETIME:
+                    self.powered = False
+
+
+    def read(self, length):
+        if self.powered and self.mode in SimBH1750.CONTINUOUS:
+            self.measure()
+        return self.counts.to_bytes(2, 'big')[:length]
+
+
+class SimSSD1306():
+    """ssd1306 in horizontal addressing mode, keeps the display ram"""
+    #commands with their number of argument bytes, all others have none
+    ARGUMENTS = {0x21: 2, 0x22: 2, 0x20: 1, 0x81: 1, 0x8D: 1, 0xA8: 1, 0xD3: 1, 0xD5: 1,
+                 0xD9: 1, 0xDA: 1, 0xDB: 1}
+
+    def __init__(self, width=128, pages=8):
+        self.width = width
+        self.pages = pages
+        self.ram = bytearray(width * pages)
+        self.columns = (0, width - 1)
+        self.pagerange = (0, pages - 1)
+        self.column = 0
+        self.page = 0
+        self.on = False
+        self.commands = 0
+        self.databytes = 0
+
+
+    def command(self, data):
+        i = 0
+        while i < len(data):
+            cmd = data[i]
+            args = data[i + 1:i + 1 + SimSSD1306.ARGUMENTS.get(cmd, 0)]
+            i += 1 + len(args)
+            self.commands += 1
+            if cmd == 0x21:
+                self.columns = (args[0], args[1])
+                self.column = args[0]
+            elif cmd == 0x22:
+                self.pagerange = (args[0], args[1])
+                self.page = args[0]
+            elif cmd == 0xAF:
+                self.on = True
+            elif cmd == 0xAE:
+                self.on = False
+
+
+    def write(self, data):
+        '''control byte 0x00 for commands, 0x40 for display data'''
+        if data[0] & 0x40 == 0:
+            self.command(data[1:])
+            return
+        for value in data[1:]:
+            self.ram[self.page * self.width + self.column] = value
+            self.databytes += 1
+            self.column += 1
+            if self.column > self.columns[1]:
+                self.column = self.columns[0]
+                self.page = self.page + 1 if self.page < self.pagerange[1] else self.pagerange[0]
+
+
+    def read(self, length):
+        return bytes(length) #status byte, not used
+
+
+    def pixel(self, x, y):
+        '''pixel of the picture, the ram columns are in lib_oled96 order (rightmost first)'''
+        return (self.ram[(y // 8) * self.width + self.width - 1 - x] >> (y % 8)) & 1
+
+
+    def image(self):
+        '''display content as pil image, e.g. for saving a screenshot'''
+        image = Image.new('1', (self.width, self.pages * 8))
+        image.putdata([self.pixel(x, y) for y in range(self.pages * 8) for x in range(self.width)])
+        return image
+
+
+class SimBus():
+    """smbus2.SMBus stand in, the transfers go to the simulated devices by address"""
+    def __init__(self):
+        self.devices = {}
+
+
+    def attach(self, addr, device):
+        self.devices[addr] = device
+
+
+    def device(self, addr):
+        device = self.devices.get(addr)
+        if device is None:
+            raise OSError(121, 'Remote I/O error') #what the kernel says if nobody acks
+        return device
+
+
+    def close(self):
+        pass
+
+
+    def read_byte(self, addr):
+        return self.device(addr).read(1)[0]
+
+
+    def write_byte(self, addr, value):
+        self.device(addr).write(bytes([value]))
+
+
+    def read_byte_data(self, addr, register):
+        device = self.device(addr)
+        device.write(bytes([register]))
+        return device.read(1)[0]
+
+
+    def write_byte_data(self, addr, register, value):
+        self.device(addr).write(bytes([register, value]))
+
+
+    def read_i2c_block_data(self, addr, register, length):
+        device = self.device(addr)
+        device.write(bytes([register]))
+        return list(device.read(length))
+
+
+    def write_i2c_block_data(self, addr, register, data):
+        self.device(addr).write(bytes([register]) + bytes(data))
+
+
+    def i2c_rdwr(self, *msgs):
+        for msg in msgs:
+            device = self.device(msg.addr)
+            if msg.flags & I2C_M_RD:
+                ctypes.memmove(msg.buf, device.read(msg.len), msg.len)
+            else:
+                device.write(bytes(msg))
+
+
+class SimOled():
+    """the parts of lib_oled96.ssd1306 the controller uses, on any smbus2 like bus"""
+    def __init__(self, bus, address=OLEDADDR):
+        self.cmd_mode = 0x00
+        self.data_mode = 0x40
+        self.bus = bus
+        self.addr = address
+        self.width = 128
+        self.height = 64
+        self.pages = self.height // 8
+        self.image = Image.new('1', (self.width, self.height))
+        self.canvas = ImageDraw.Draw(self.image)
+        self._command(0xAE, 0xD5, 0x80, 0xA8, 0x3F, 0xD3, 0x00, 0x40, 0x8D, 0x14, 0x20, 0x00,
+                      0xA1, 0xC8, 0xDA, 0x12, 0x81, 0xCF, 0xD9, 0xF1, 0xDB, 0x40, 0xA4, 0xA6, 0xAF)
+
+
+    def _command(self, *cmd):
+        self.bus.write_i2c_block_data(self.addr, self.cmd_mode, list(cmd))
+
+
+    def _data(self, data):
+        for i in range(0, len(data), 31):
+            self.bus.write_i2c_block_data(self.addr, self.data_mode, list(data[i:i + 31]))
+
+
+    def display(self):
+        self._command(0x21, 0x00, self.width - 1, 0x22, 0x00, self.pages - 1)
+        self._data(b''.join(framepages(self.image, self.pages)))
+
+
+    def cls(self):
+        self.canvas.rectangle((0, 0, self.width - 1, self.height - 1), outline=0, fill=0)
+        self.display()
+
+
+class SimGPIO():
+    """stand in for the RPi.GPIO module. Inputs are driven with set() or by
+    scripted (unix time, pin, level) events, outputs count their switches"""
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self, levels=None):
+        self.lock = threading.RLock()
+        self.initial = dict(levels or {})
+        self.levels = dict(self.initial)
+        self.directions = {}
+        self.detect = {} #pin: (edge, callback)
+        self.switches = {} #pin: number of output changes
+        self.script = [] #(unix time, pin, level), sorted
+        self.mode = None
+
+
+    def setwarnings(self, flag):
+        pass
+
+
+    def setmode(self, mode):
+        self.mode = mode
+
+
+    def setup(self, pin, direction, pull_up_down=PUD_OFF, initial=-1):
+        with self.lock:
+            self.directions[pin] = direction
+            if direction == SimGPIO.OUT:
+                self.levels[pin] = initial if initial in (SimGPIO.LOW, SimGPIO.HIGH) else SimGPIO.LOW
+            elif pin not in self.levels:
+                self.levels[pin] = SimGPIO.LOW if pull_up_down == SimGPIO.PUD_DOWN else SimGPIO.HIGH
+
+
+    def output(self, pin, value):
+        with self.lock:
+            if self.directions.get(pin) != SimGPIO.OUT:
+                raise RuntimeError("The GPIO channel has not been set up as an OUTPUT")
+            value = SimGPIO.HIGH if value else SimGPIO.LOW
+            if self.levels.get(pin) != value:
+                self.switches[pin] = self.switches.get(pin, 0) + 1
+            self.levels[pin] = value
+
+
+    def input(self, pin):
+        with self.lock:
+            if pin not in self.directions:
+                raise RuntimeError("You must setup() the GPIO channel first")
+            return self.levels[pin]
+
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        with self.lock:
+            if pin in self.detect:
+                raise RuntimeError("Conflicting edge detection already enabled for this GPIO channel")
+            self.detect[pin] = (edge, callback)
+
+
+    def remove_event_detect(self, pin):
+        with self.lock:
+            self.detect.pop(pin, None)
+
+
+    def cleanup(self):
+        with self.lock:
+            self.levels = dict(self.initial)
+            self.directions = {}
+            self.detect = {}
+
+
+    def set(self, pin, level):
+        '''drive an input from the outside, calls the edge callback like the hardware'''
+        level = SimGPIO.HIGH if level else SimGPIO.LOW
+        with self.lock:
+            old = self.levels.get(pin)
+            self.levels[pin] = level
+            edge, callback = self.detect.get(pin, (None, None))
+        if callback is not None and old != level and \
+                edge in (SimGPIO.BOTH, SimGPIO.RISING if level else SimGPIO.FALLING):
+            callback(pin)
+
+
+    def addscript(self, events):
+        with self.lock:
+            self.script = sorted(self.script + list(events))
+
+
+    def nextevent(self):
+        '''time of the next scripted event or None'''
+        with self.lock:
+            return self.script[0][0] if self.script else None
+
+
+    def advance(self, now):
+        '''apply the scripted events up to unix time now, returns how many'''
+        count = 0
+        while True:
+            with self.lock:
+                if not self.script or self.script[0][0] > now:
+                    return count
+                _, pin, level = self.script.pop(0)
+            self.set(pin, level)
+            count += 1
+
+
+class _PublishResult():
+    def __init__(self, mid):
+        self.rc = 0
+        self.mid = mid
+
+
+    def is_published(self):
+        return True
+
+
+    def wait_for_publish(self, timeout=None):
+        pass
+
+
+SimMessage = namedtuple('SimMessage', ['topic', 'payload', 'qos', 'retain'])
+
+
+class SimMqttClient():
+    """paho client stand in that is always connected and keeps statistics
+    and the last payload of every topic. With a SimBroker the messages go
+    to the subscribers and on_message gets those of the subscriptions"""
+    def __init__(self, broker=None):
+        self.messages = 0
+        self.bytes = 0
+        self.topics = {} #topic: number of messages
+        self.last = {} #topic: last payload
+        self.connected = True
+        self.broker = broker
+        self.on_message = None
+
+
+    def is_connected(self):
+        return self.connected
+
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        if payload is None:
+            payload = b''
+        elif not isinstance(payload, (bytes, bytearray)):
+            payload = str(payload).encode()
+        self.messages += 1
+        self.bytes += len(topic) + len(payload)
+        self.topics[topic] = self.topics.get(topic, 0) + 1
+        self.last[topic] = payload
+        if self.broker is not None:
+            self.broker.publish(topic, payload, retain)
+        return _PublishResult(self.messages)
+
+
+    def subscribe(self, topic, qos=0):
+        '''topic filter or list of (filter, qos) like paho'''
+        if self.broker is not None:
+            for topicfilter in ([topic] if isinstance(topic, str) else [item[0] for item in topic]):
+                self.broker.subscribe(self, topicfilter)
+        return (0, self.messages)
+
+
+    def deliver(self, topic, payload, retain):
+        if self.on_message is not None:
+            self.on_message(self, None, SimMessage(topic, payload, 0, retain))
+
+
+class SimBroker():
+    """in process broker: a publish is delivered right away to every client
+    with a matching subscription, retained messages when subscribing"""
+    def __init__(self):
+        self.subscriptions = TopicTrie()
+        self.subscribed = set() #(client id, filter)
+        self.retained = {} #topic: payload
+        self.delivered = 0
+
+
+    def client(self):
+        return SimMqttClient(self)
+
+
+    def subscribe(self, client, topicfilter):
+        checkfilter(topicfilter)
+        if (id(client), topicfilter) in self.subscribed:
+            return
+        self.subscribed.add((id(client), topicfilter))
+        self.subscriptions.insert(topicfilter, client)
+        single = TopicTrie()
+        single.insert(topicfilter, client)
+        for topic, payload in list(self.retained.items()):
+            if single.match(topic):
+                self.delivered += 1
+                client.deliver(topic, payload, True)
+
+
+    def publish(self, topic, payload, retain=False):
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        for client, _ in self.subscriptions.match(topic):
+            self.delivered += 1
+            client.deliver(topic, payload, False)
+
+
+class Simulation():
+    """all simulated devices: one bus with bme280, bh1750 and oled, the gpio
+    pins and the weather they measure"""
+    def __init__(self, weather=None, levels=INPUTLEVELS):
+        self.origin = time.time()
+        self.weather = weather or WeatherCurve()
+        self.bme280 = SimBME280(self.weather)
+        self.bh1750 = SimBH1750(self.weather)
+        self.oled = SimSSD1306()
+        self.bus = SimBus()
+        self.bus.attach(bme280.DEVICE, self.bme280)
+        self.bus.attach(bh1750.DEVICE, self.bh1750)
+        self.bus.attach(OLEDADDR, self.oled)
+        #second sensors on the alternative addresses, for a second grow zone
+        self.bme280b = SimBME280(self.weather)
+        self.bh1750b = SimBH1750(self.weather)
+        self.bus.attach(BME280ADDR2, self.bme280b)
+        self.bus.attach(BH1750ADDR2, self.bh1750b)
+        self.gpio = SimGPIO(levels)
+        self.thread = None
+
+
+    def setweather(self, weather):
+        self.weather = weather
+        for device in (self.bme280, self.bh1750, self.bme280b, self.bh1750b):
+            device.weather = weather
+
+
+    def loadtrace(self, path):
+        '''weather and level events of a trace file, times relative to the start of the simulation.
+        Binary traces of hydro_trace are compensated like the controller does'''
+        points, events = tracepoints(path, self.origin) if istrace(path) else readtrace(path, self.origin)
+        if points:
+            self.setweather(TraceWeather(points))
+        self.gpio.addscript(events)
+        my_logger.info('Simulation trace %s %d events', path, len(events))
+
+
+    def start(self):
+        '''play the scripted gpio events in real time, for running the real controller'''
+        self.thread = threading.Thread(target=self.run, name='simulation', daemon=True)
+        self.thread.start()
+
+
+    def run(self):
+        while True:
+            self.gpio.advance(time.time())
+            due = self.gpio.nextevent()
+            if due is None:
+                return
+            time.sleep(max(0.0, min(1.0, due - time.time())))
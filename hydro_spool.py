@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""
+store and forward queue for mqtt messages. While the broker is not
+reachable, messages are appended to segment files on the sd card and sent
+later at a limited rate. Writes are sequential and fsync'ed in batches,
+memory use doesn't depend on the backlog size.
+"""
+
+import os
+import time
+import struct
+import threading
+
+#our own modules
+from hydro_logger import my_logger
+import hydro_metrics
+
+__all__ = ['Spool', 'StoreAndForward']
+
+#record header: timestamp, topic length, payload length, retain flag
+HEADER = struct.Struct('<dHIB')
+
+DROP_OLDEST = 'oldest' #delete the oldest segment when full
+DROP_NEWEST = 'newest' #refuse new messages when full
+
+PUBLISHED = hydro_metrics.counter('hydro_mqtt_published_total', 'messages handed to the mqtt client')
+PUBLISHFAILURES = hydro_metrics.counter('hydro_mqtt_publish_failures_total', 'publishes the mqtt client refused')
+SPOOLED = hydro_metrics.counter('hydro_mqtt_spooled_total', 'messages written to the spool')
+DRAINED = hydro_metrics.counter('hydro_mqtt_drained_total', 'spooled messages sent after a reconnect')
+STALE = hydro_metrics.counter('hydro_mqtt_stale_dropped_total', 'spooled messages too old to be sent')
+SPOOLBYTES = hydro_metrics.gauge('hydro_spool_bytes', 'size of the spool segment files')
+
+
+class Spool():
+    """append only queue of mqtt messages in segment files"""
+    def __init__(self, directory, segmentbytes=256 * 1024, maxbytes=16 * 1024 * 1024,
+                 syncevery=50, syncinterval=30.0, policy=DROP_OLDEST):
+        self.directory = directory
+        self.segmentbytes = segmentbytes
+        self.maxbytes = maxbytes
+        self.syncevery = syncevery
+        self.syncinterval = syncinterval
+        self.policy = policy
+        self.lock = threading.RLock()
+        self.dropped = 0 #messages lost because the spool was full
+        self.evictedsegments = 0
+        os.makedirs(directory, exist_ok=True)
+
+        self.segments = sorted(int(name[6:14]) for name in os.listdir(directory)
+                               if name.startswith('spool-') and name.endswith('.log'))
+        self.sizes = {seq: os.path.getsize(self.segmentpath(seq)) for seq in self.segments}
+
+        #writer always starts a new segment
+        self.writeseq = (self.segments[-1] + 1) if self.segments else 0
+        self.writer = None
+        self.unsynced = 0
+        self.lastsync = time.monotonic()
+
+        self.readseq, self.readoffset = self.loadcursor()
+        self.reader = None
+
+
+    def segmentpath(self, seq):
+        return os.path.join(self.directory, 'spool-%08d.log' % seq)
+
+
+    def cursorpath(self):
+        return os.path.join(self.directory, 'cursor')
+
+
+    def loadcursor(self):
+        try:
+            with open(self.cursorpath()) as f:
+                seq, offset = (int(x) for x in f.read().split())
+            if seq in self.sizes:
+                return seq, offset
+        except Exception:
+            pass
+        return (self.segments[0] if self.segments else self.writeseq), 0
+
+
+    def savecursor(self):
+        tmpfile = self.cursorpath() + '.tmp'
+        with open(tmpfile, 'w') as f:
+            f.write('%d %d' % (self.readseq, self.readoffset))
+        os.replace(tmpfile, self.cursorpath())
+
+
+    def totalbytes(self):
+        with self.lock: #also called from the metrics thread
+            return sum(self.sizes.values())
+
+
+    def isempty(self):
+        with self.lock:
+            return not self.segments or (self.readseq == self.writeseq and self.readoffset >= self.sizes.get(self.writeseq, 0))
+
+
+    def append(self, topic, payload, retain=False, timestamp=None):
+        '''queue one message, returns False if it was dropped'''
+        topic = topic.encode('utf-8')
+        if payload is None:
+            payload = b''
+        elif isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        elif not isinstance(payload, (bytes, bytearray)):
+            payload = str(payload).encode('utf-8')
+        record = HEADER.pack(timestamp or time.time(), len(topic), len(payload), 1 if retain else 0) + topic + payload
+
+        with self.lock:
+            if self.totalbytes() + len(record) > self.maxbytes and not self.evict():
+                self.dropped += 1
+                return False
+
+            if self.writer is None or self.sizes[self.writeseq] + len(record) > self.segmentbytes:
+                self.rollover()
+            self.writer.write(record)
+            self.writer.flush() #visible for the reader, not yet on the card
+            self.sizes[self.writeseq] += len(record)
+            self.unsynced += 1
+            if self.unsynced >= self.syncevery or time.monotonic() - self.lastsync > self.syncinterval:
+                self.sync()
+            return True
+
+
+    def rollover(self):
+        if self.writer is not None:
+            self.sync()
+            self.writer.close()
+            self.writeseq += 1
+        self.writer = open(self.segmentpath(self.writeseq), 'ab')
+        self.segments.append(self.writeseq)
+        self.sizes[self.writeseq] = 0
+
+
+    def evict(self):
+        '''make room according to the policy, True if there is room now'''
+        if self.policy != DROP_OLDEST or len(self.segments) < 2:
+            return False
+        oldest = self.segments[0]
+        self.removesegment(oldest)
+        self.evictedsegments += 1
+        my_logger.warning('Spool full, dropped segment %d', oldest)
+        return self.totalbytes() < self.maxbytes
+
+
+    def removesegment(self, seq):
+        if seq == self.readseq:
+            if self.reader is not None:
+                self.reader.close()
+                self.reader = None
+            later = [s for s in self.segments if s > seq]
+            self.readseq = later[0] if later else self.writeseq
+            self.readoffset = 0
+        self.segments.remove(seq)
+        del self.sizes[seq]
+        try:
+            os.remove(self.segmentpath(seq))
+        except OSError:
+            pass
+
+
+    def sync(self):
+        '''fsync pending writes, called in batches to spare the sd card'''
+        with self.lock:
+            if self.writer is not None and self.unsynced:
+                self.writer.flush()
+                os.fsync(self.writer.fileno())
+            self.unsynced = 0
+            self.lastsync = time.monotonic()
+
+
+    def peek(self, maxrecords):
+        '''up to maxrecords of the oldest messages as (timestamp, topic, payload, retain, nextposition)'''
+        records = []
+        with self.lock:
+            seq, offset = self.readseq, self.readoffset
+            while len(records) < maxrecords and seq in self.sizes:
+                if offset >= self.sizes[seq]:
+                    later = [s for s in self.segments if s > seq]
+                    if not later:
+                        break
+                    seq, offset = later[0], 0
+                    continue
+                if self.reader is None or self.reader.name != self.segmentpath(seq):
+                    if self.reader is not None:
+                        self.reader.close()
+                    self.reader = open(self.segmentpath(seq), 'rb')
+                self.reader.seek(offset)
+                header = self.reader.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+                timestamp, topiclen, payloadlen, retain = HEADER.unpack(header)
+                body = self.reader.read(topiclen + payloadlen)
+                if len(body) < topiclen + payloadlen:
+                    break #torn record at the end of a crashed segment
+                offset += HEADER.size + topiclen + payloadlen
+                records.append((timestamp, body[:topiclen].decode('utf-8'), body[topiclen:], bool(retain), (seq, offset)))
+        return records
+
+
+    def commit(self, position):
+        '''mark everything before position (from peek) as sent'''
+        seq, offset = position
+        with self.lock:
+            for old in [s for s in self.segments if s < seq]:
+                if old != self.writeseq:
+                    self.removesegment(old)
+            self.readseq, self.readoffset = seq, offset
+            if seq != self.writeseq and offset >= self.sizes.get(seq, 0):
+                self.removesegment(seq)
+            self.savecursor()
+
+
+    def close(self):
+        with self.lock:
+            self.sync()
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+            if self.reader is not None:
+                self.reader.close()
+                self.reader = None
+
+
+class StoreAndForward():
+    """publishes through the mqtt client while connected, spools otherwise.
+    As long as there is a backlog, new messages are spooled too, so the
+    order (and the retained values) stay right.
+    Spooled messages must not look current when they are sent: with
+    timestamps (mqtt v5) they carry the time they were made as user
+    property ts, otherwise the ones older than maxage seconds are dropped,
+    except retained ones, they are the latest value of their topic."""
+    def __init__(self, mqttclient, spool, drainrate=20, timestamps=False, maxage=None):
+        self.mqttclient = mqttclient
+        self.spool = spool
+        self.drainrate = drainrate #messages per drain() call
+        self.timestamps = timestamps
+        self.maxage = maxage
+        SPOOLBYTES.setfunction(spool.totalbytes)
+
+
+    def publish(self, topic, payload=None, retain=False):
+        if self.mqttclient.is_connected() and self.spool.isempty():
+            info = self.mqttclient.publish(topic, payload, retain=retain)
+            if info.rc == 0:
+                PUBLISHED.inc()
+                return info
+            PUBLISHFAILURES.inc()
+        self.spool.append(topic, payload, retain)
+        SPOOLED.inc()
+        return None
+
+
+    def drain(self):
+        '''send up to drainrate spooled messages, returns the number sent'''
+        if not self.mqttclient.is_connected() or self.spool.isempty():
+            return 0
+        sent = 0
+        position = None
+        now = time.time()
+        for timestamp, topic, payload, retain, nextposition in self.spool.peek(self.drainrate):
+            if self.timestamps:
+                info = self.mqttclient.publish(topic, payload, retain=retain, properties=self.properties(timestamp))
+            elif self.maxage is not None and not retain and now - timestamp > self.maxage:
+                STALE.inc()
+                position = nextposition
+                continue
+            else:
+                info = self.mqttclient.publish(topic, payload, retain=retain)
+            if info.rc != 0:
+                PUBLISHFAILURES.inc()
+                break
+            position = nextposition
+            sent += 1
+        if position is not None:
+            self.spool.commit(position)
+        PUBLISHED.inc(sent)
+        DRAINED.inc(sent)
+        return sent
+
+
+    def properties(self, timestamp):
+        #paho is imported by the controller only when it needs it
+        from paho.mqtt.properties import Properties
+        from paho.mqtt.packettypes import PacketTypes
+        properties = Properties(PacketTypes.PUBLISH)
+        properties.UserProperty = ('ts', '%.3f' % timestamp)
+        return properties
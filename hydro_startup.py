@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+startup phase timing: seconds from the start of the process (interpreter
+start included, where /proc tells) to the end of every phase, e.g. imports,
+pump running, first sample, broker reachable, first publish. Each phase is
+recorded once, the breakdown goes to the log, the metrics and mqtt.
+"""
+
+import os
+import time
+import threading
+
+#our own modules
+from hydro_logger import my_logger
+import hydro_metrics
+
+__all__ = ['StartupTimer', 'processage', 'startup']
+
+STARTUPSECONDS = hydro_metrics.gauge('hydro_startup_seconds', 'seconds from process start to the end of a startup phase', ('phase',))
+
+
+def processage():
+    '''seconds since this process was started, None if /proc is not there'''
+    try:
+        with open('/proc/self/stat') as f:
+            #the command name may contain spaces, the fields after it don't
+            fields = f.read().rsplit(')', 1)[1].split()
+        starttime = int(fields[19]) / os.sysconf('SC_CLK_TCK') #clock ticks after boot
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - starttime
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class StartupTimer():
+    """first time marks of the startup phases, on the monotonic clock"""
+    def __init__(self):
+        age = processage()
+        self.origin = time.monotonic() - (age if age is not None else 0.0)
+        self.lock = threading.Lock()
+        self.phases = {} #name: seconds after origin, in the order they happened
+
+
+    def mark(self, phase):
+        '''end of phase, returns False if it was marked before'''
+        with self.lock:
+            if phase in self.phases:
+                return False
+            self.phases[phase] = time.monotonic() - self.origin
+        STARTUPSECONDS.labels(phase).set(round(self.phases[phase], 3))
+        my_logger.debug('Startup %s after %.2f s', phase, self.phases[phase])
+        return True
+
+
+    def asdict(self):
+        with self.lock:
+            return dict(self.phases)
+
+
+    def summary(self):
+        '''phases with their own duration and the time since start'''
+        parts = []
+        last = 0.0
+        for phase, at in self.asdict().items():
+            parts.append("{} +{:.2f} s ({:.2f} s)".format(phase, at - last, at))
+            last = at
+        return ", ".join(parts)
+
+
+#the controller's timer, created when the first module imports this one
+startup = StartupTimer()
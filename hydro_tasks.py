@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio task runner for the controller. Periodic jobs are scheduled on the
+monotonic clock and keep timing statistics, blocking jobs run in a worker
+thread so they can't stall the other tasks
+"""
+
+import time
+import asyncio
+
+#our own modules
+from hydro_logger import my_logger
+import hydro_globals
+import hydro_metrics
+
+__all__ = ['TaskRunner', 'TaskStats', 'ThreadsafeQueue']
+
+TASKSECONDS = hydro_metrics.histogram('hydro_task_seconds', 'run time of the periodic tasks', ('task',))
+TASKDRIFT = hydro_metrics.histogram('hydro_task_drift_seconds', 'start delay of the periodic tasks', ('task',))
+TASKOVERRUNS = hydro_metrics.counter('hydro_task_overruns_total', 'task runs longer than their interval', ('task',))
+TASKERRORS = hydro_metrics.counter('hydro_task_errors_total', 'task runs that raised', ('task',))
+
+
+class TaskStats():
+    """run time and scheduling drift of one periodic task, in seconds"""
+    def __init__(self, name=None):
+        self.durations = TASKSECONDS.labels(name) if name else None
+        self.drifts = TASKDRIFT.labels(name) if name else None
+        self.overrunmetric = TASKOVERRUNS.labels(name) if name else None
+        self.errormetric = TASKERRORS.labels(name) if name else None
+        self.runs = 0
+        self.errors = 0
+        self.overruns = 0 #runs that took longer than the interval
+        self.lastduration = 0.0
+        self.maxduration = 0.0
+        self.totalduration = 0.0
+        self.maxdrift = 0.0
+        self.totaldrift = 0.0
+
+
+    def record(self, drift, duration, interval):
+        self.runs += 1
+        self.lastduration = duration
+        self.totalduration += duration
+        self.maxduration = max(self.maxduration, duration)
+        self.totaldrift += drift
+        self.maxdrift = max(self.maxdrift, drift)
+        if duration > interval:
+            self.overruns += 1
+        if self.durations is not None:
+            self.durations.observe(duration)
+            self.drifts.observe(drift)
+            if duration > interval:
+                self.overrunmetric.inc()
+
+
+    def recorderror(self):
+        self.errors += 1
+        if self.errormetric is not None:
+            self.errormetric.inc()
+
+
+    def asdict(self):
+        runs = self.runs or 1
+        return {"runs": self.runs, "errors": self.errors, "overruns": self.overruns,
+                "lastduration": self.lastduration, "maxduration": self.maxduration,
+                "meanduration": self.totalduration / runs,
+                "maxdrift": self.maxdrift, "meandrift": self.totaldrift / runs}
+
+
+class ThreadsafeQueue():
+    """asyncio queue that other threads can put() into"""
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue()
+
+
+    def put(self, item):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class TaskRunner():
+    """runs the controller jobs as independent asyncio tasks"""
+    def __init__(self):
+        self.jobs = []
+        self.oneshots = []
+        self.stats = {}
+        self.intervals = {}
+
+
+    def every(self, name, interval, func, blocking=False, offset=0.0):
+        '''call func every interval seconds, the first time after offset seconds.
+        Blocking functions run in the default executor.'''
+        self.stats[name] = TaskStats(name)
+        self.intervals[name] = interval
+        self.jobs.append((name, self.periodic(name, func, blocking, offset)))
+
+
+    def setinterval(self, name, interval):
+        '''change the interval of a periodic task, counts from its next run'''
+        self.intervals[name] = interval
+
+
+    def spawn(self, name, coro):
+        '''run a coroutine as task, e.g. an event consumer'''
+        self.jobs.append((name, coro))
+
+
+    def once(self, name, coro):
+        '''run a coroutine that may finish, e.g. a startup step'''
+        self.oneshots.append((name, coro))
+
+
+    async def periodic(self, name, func, blocking, offset):
+        loop = asyncio.get_running_loop()
+        stats = self.stats[name]
+        due = time.monotonic() + offset
+        while hydro_globals.keep_running:
+            await asyncio.sleep(max(0.0, due - time.monotonic()))
+            start = time.monotonic()
+            try:
+                if blocking:
+                    await loop.run_in_executor(None, func)
+                else:
+                    func()
+            except Exception:
+                stats.recorderror()
+                my_logger.error('Task %s error', name, exc_info=True)
+            interval = self.intervals[name]
+            stats.record(start - due, time.monotonic() - start, interval)
+            #next slot on the fixed grid, skip the slots we missed
+            due += interval
+            if due < time.monotonic():
+                due += ((time.monotonic() - due) // interval + 1) * interval
+
+
+    async def watchstop(self):
+        while hydro_globals.keep_running:
+            await asyncio.sleep(1)
+
+
+    async def run(self):
+        '''run all jobs until one of them ends or keep_running is cleared'''
+        tasks = [asyncio.create_task(coro, name=name) for name, coro in self.jobs]
+        tasks.append(asyncio.create_task(self.watchstop(), name='watchstop'))
+        oneshots = [asyncio.create_task(self.runonce(name, coro), name=name) for name, coro in self.oneshots]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result() #raise errors of the finished task
+        finally:
+            for task in tasks + oneshots:
+                task.cancel()
+            await asyncio.gather(*tasks, *oneshots, return_exceptions=True)
+
+
+    async def runonce(self, name, coro):
+        try:
+            await coro
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            my_logger.error('Task %s error', name, exc_info=True)
+
+
+    def statsdict(self):
+        return {name: stats.asdict() for name, stats in self.stats.items()}
+
+
+    def summary(self):
+        return ", ".join("{} {:.1f}/{:.1f} ms drift {:.1f} ms".format(
+            name, s["meanduration"] * 1000, s["maxduration"] * 1000, s["maxdrift"] * 1000)
+            for name, s in self.statsdict().items())
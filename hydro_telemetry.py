@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+telemetry publisher: only changed values are sent (deadband per metric),
+a heartbeat interval makes sure every value is repeated now and then.
+Values go out on their own topics (like before), as one batched JSON
+message per tick, or both.
+"""
+
+import time
+import json
+
+__all__ = ['TelemetryPublisher', 'Metric']
+
+MODE_TOPICS = 'topics' #one message per metric, iot/Hydroponic/<name>
+MODE_JSON = 'json' #one message per flush on iot/Hydroponic/Telemetry
+MODE_BOTH = 'both'
+
+
+class Metric():
+    """one telemetry value and its publishing rules"""
+    def __init__(self, name, deadband=0.0, heartbeat=600, precision=None, retain=False, mininterval=0):
+        self.name = name
+        self.deadband = deadband #numeric change that has to be exceeded
+        self.heartbeat = heartbeat #republish after this many seconds anyway, 0 = never
+        self.precision = precision #decimals, None = as is
+        self.retain = retain
+        self.mininterval = mininterval #don't send more often than this
+        self.value = None
+        self.sentvalue = None
+        self.senttime = None
+
+
+    def format(self, value):
+        if self.precision is not None and isinstance(value, float):
+            return round(value, self.precision)
+        return value
+
+
+    def isdue(self, now):
+        if self.value is None:
+            return False
+        if self.senttime is None:
+            return True
+        age = now - self.senttime
+        if age < self.mininterval:
+            return False
+        if self.heartbeat and age >= self.heartbeat:
+            return True
+        if isinstance(self.value, (int, float)) and isinstance(self.sentvalue, (int, float)):
+            return abs(self.value - self.sentvalue) > self.deadband
+        return self.value != self.sentvalue
+
+
+class TelemetryPublisher():
+    """collects metric values and publishes the due ones on flush()"""
+    def __init__(self, mqttclient, prefix="iot/Hydroponic", mode=MODE_TOPICS, batchtopic="Telemetry"):
+        self.mqttclient = mqttclient
+        self.prefix = prefix
+        self.mode = mode
+        self.batchtopic = batchtopic
+        self.metrics = {}
+        self.messages = 0 #published messages, for comparing the modes
+
+
+    def addmetric(self, name, **rules):
+        self.metrics[name] = Metric(name, **rules)
+
+
+    def update(self, name, value):
+        metric = self.metrics[name]
+        metric.value = metric.format(value)
+
+
+    def flush(self, now=None):
+        '''publish all due metrics, returns their names'''
+        if now is None:
+            now = time.monotonic()
+        due = [metric for metric in self.metrics.values() if metric.isdue(now)]
+        if not due:
+            return []
+
+        if self.mode in (MODE_TOPICS, MODE_BOTH):
+            for metric in due:
+                self.mqttclient.publish(self.prefix + "/" + metric.name, metric.value, retain=metric.retain)
+                self.messages += 1
+        if self.mode in (MODE_JSON, MODE_BOTH):
+            payload = {"ts": int(time.time())}
+            payload.update((metric.name, metric.value) for metric in due)
+            self.mqttclient.publish(self.prefix + "/" + self.batchtopic, json.dumps(payload, separators=(',', ':')))
+            self.messages += 1
+
+        for metric in due:
+            metric.sentvalue = metric.value
+            metric.senttime = now
+        return [metric.name for metric in due]
@@ -0,0 +1,403 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+raw data traces: what the sensors and inputs really said, for reproducing
+field issues offline. TraceRecorder appends fixed size records to a file
+per day in the trace directory: raw bme280 data frames (with the
+calibration of the chip once per file), raw bh1750 result registers, the
+debounced gpio levels (all watched inputs at the start of the file, then
+the changes), pump switches and the mqtt commands received.
+The oldest files are deleted when the directory grows beyond maxbytes.
+
+File: 32 byte header (magic, version, record size, wall and monotonic
+clock at the start), then 16 byte records, little endian
+
+    uint32 ms     monotonic milliseconds since the start of the file
+    uint8  kind   KIND_*
+    uint8  addr   i2c address or board pin
+    uint16 aux    bh1750 mode, gpio level, pump state or blob length
+    8 bytes data  bme280 frame, bh1750 result, first bytes of a blob
+
+Blobs (calibration, mqtt command) continue in KIND_MORE records. The files
+can be mapped with numpy.memmap(path, TRACEDTYPE, offset=HEADERSIZE).
+TraceReader maps a file and iterates the records lazily, airsamples() and
+lightsamples() run them through the driver compensation again. A day of
+both sensors sampled every second is 2.7 MB.
+
+usage: hydro_trace.py [--dump] file...
+"""
+
+import os
+import sys
+import time
+import mmap
+import glob
+import struct
+import threading
+from collections import namedtuple
+
+#our own modules
+from hydro_logger import my_logger
+import hydro_metrics
+import bme280
+import bh1750
+
+__all__ = ['TraceRecorder', 'TraceReader', 'TraceRecord', 'airsamples', 'lightsamples', 'gpiolevels',
+           'istrace', 'tracepoints', 'TRACEDTYPE']
+
+MAGIC = b'HYTRACE1'
+VERSION = 1
+HEADER = struct.Struct('<8sHHIdd') #magic, version, record size, reserved, wall start, monotonic start
+RECORD = struct.Struct('<IBBH8s')
+HEADERSIZE = HEADER.size
+TRACEDTYPE = [('ms', '<u4'), ('kind', 'u1'), ('addr', 'u1'), ('aux', '<u2'), ('data', 'u1', (8,))]
+
+KIND_BME280 = 1 #data: 8 byte frame 0xF7..0xFE
+KIND_CALIBRATION = 2 #blob: the 18 bme280.Calibration values as int32
+KIND_BH1750 = 3 #aux: measurement mode, data[:2]: result register
+KIND_GPIO = 4 #addr: board pin, aux: level after debouncing
+KIND_PUMP = 5 #addr: board pin, aux: 1 on, 0 off
+KIND_COMMAND = 6 #blob: topic, zero byte, payload
+KIND_MORE = 7 #next 8 bytes of a blob
+KINDNAMES = {KIND_BME280: 'bme280', KIND_CALIBRATION: 'calibration', KIND_BH1750: 'bh1750',
+             KIND_GPIO: 'gpio', KIND_PUMP: 'pump', KIND_COMMAND: 'command', KIND_MORE: 'more'}
+BLOBKINDS = (KIND_CALIBRATION, KIND_COMMAND)
+MAXBLOB = 1024 #longer commands are cut
+MAXMS = 0xFFFFFFFF #49 days, a new file is started long before
+RETRYSECONDS = 60 #records are dropped that long after a file couldn't be opened
+CALIBRATION = struct.Struct('<18i')
+
+TRACERECORDS = hydro_metrics.counter('hydro_trace_records_total', 'records written to the raw data trace')
+TRACEDROPS = hydro_metrics.counter('hydro_trace_dropped_total', 'records dropped because the trace file could not be opened')
+
+#time: unix time, data: the bytes of the record or the whole blob
+TraceRecord = namedtuple('TraceRecord', ['time', 'kind', 'addr', 'aux', 'data'])
+
+
+class TraceRecorder():
+    """appends records to trace-<date>-<time>.bin in directory, one file per
+    day and process start. Records are buffered, flush() writes them"""
+    def __init__(self, directory, maxbytes=64 * 1024 * 1024, buffersize=65536):
+        self.directory = directory
+        self.maxbytes = maxbytes
+        self.buffersize = buffersize
+        self.lock = threading.Lock()
+        self.buffer = bytearray()
+        self.file = None
+        self.path = None
+        self.monostart = 0.0
+        self.rotateat = 0.0 #unix time of the next local midnight
+        self.retryat = 0.0 #monotonic time of the next try after open() failed
+        self.calibrations = set() #bme280 addresses whose calibration is in the file
+        self.levels = None #func() -> {pin: level} of the watched inputs, see watch()
+        self.records = 0
+        os.makedirs(directory, exist_ok=True)
+
+
+    def open(self, now):
+        '''new file, lock must be held'''
+        self.write()
+        if self.file is not None:
+            self.file.close()
+        day = time.localtime(now)
+        self.rotateat = time.mktime((day.tm_year, day.tm_mon, day.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+        self.path = os.path.join(self.directory, time.strftime('trace-%Y%m%d-%H%M%S.bin', day))
+        self.monostart = time.monotonic()
+        self.file = open(self.path, 'ab')
+        self.file.write(HEADER.pack(MAGIC, VERSION, RECORD.size, 0, now, self.monostart))
+        self.calibrations = set()
+        my_logger.info('Trace %s', self.path)
+        self.prune()
+        self.appendlevels()
+
+
+    def watch(self, levels):
+        '''levels() gives {pin: level} of the watched inputs, every file starts
+        with them, gpio() only records the changes'''
+        with self.lock:
+            self.levels = levels
+            if self.file is not None:
+                self.appendlevels()
+
+
+    def appendlevels(self):
+        '''lock must be held'''
+        if self.levels is not None:
+            for pin, level in sorted(self.levels().items()):
+                self.append(KIND_GPIO, pin, level, b'')
+
+
+    def append(self, kind, addr, aux, data):
+        '''lock must be held. Never raises for the trace file, the callers
+        switch pumps and read sensors'''
+        if self.file is None or time.time() >= self.rotateat:
+            if self.file is None and time.monotonic() < self.retryat:
+                TRACEDROPS.inc()
+                return
+            try:
+                self.open(time.time())
+            except OSError as e:
+                self.fail(e)
+                TRACEDROPS.inc()
+                return
+        ms = int((time.monotonic() - self.monostart) * 1000)
+        self.buffer += RECORD.pack(min(ms, MAXMS), kind, addr, aux, data)
+        self.records += 1
+        TRACERECORDS.inc()
+
+
+    def fail(self, e):
+        '''open() failed, drop the records for a while, lock must be held'''
+        my_logger.error('Trace error %s, recording stops for %d s', e, RETRYSECONDS)
+        if self.file is not None:
+            try:
+                self.file.close()
+            except OSError:
+                pass
+        self.file = None
+        self.buffer = bytearray()
+        self.retryat = time.monotonic() + RETRYSECONDS
+
+
+    def appendblob(self, kind, addr, data):
+        '''lock must be held'''
+        data = data[:MAXBLOB]
+        self.append(kind, addr, len(data), data[:8])
+        for i in range(8, len(data), 8):
+            self.append(KIND_MORE, addr, 0, data[i:i + 8])
+
+
+    def bme280(self, addr, frame, calibration):
+        '''raw data frame of a bme280.BME280, the calibration goes into every file once'''
+        with self.lock:
+            if self.file is None or time.time() >= self.rotateat:
+                self.open(time.time())
+            if addr not in self.calibrations:
+                self.appendblob(KIND_CALIBRATION, addr, CALIBRATION.pack(*calibration))
+                self.calibrations.add(addr)
+            self.append(KIND_BME280, addr, 0, bytes(frame))
+        self.flushfull()
+
+
+    def bh1750(self, addr, raw, mode):
+        with self.lock:
+            self.append(KIND_BH1750, addr, mode, bytes(raw))
+        self.flushfull()
+
+
+    def gpio(self, pin, level):
+        with self.lock:
+            self.append(KIND_GPIO, pin, level, b'')
+
+
+    def pump(self, pin, state):
+        with self.lock:
+            self.append(KIND_PUMP, pin, 1 if state else 0, b'')
+
+
+    def command(self, topic, payload):
+        with self.lock:
+            self.appendblob(KIND_COMMAND, 0, topic.encode('utf-8') + b'\0' + bytes(payload))
+
+
+    def flushfull(self):
+        if len(self.buffer) >= self.buffersize:
+            self.flush()
+
+
+    def write(self):
+        '''lock must be held'''
+        if self.buffer and self.file is not None:
+            self.file.write(self.buffer)
+            self.file.flush()
+            self.buffer = bytearray()
+
+
+    def flush(self):
+        '''write the buffered records, call it every few seconds'''
+        with self.lock:
+            try:
+                self.write()
+            except OSError as e:
+                my_logger.error('Trace write error %s', e)
+                self.buffer = bytearray() #rather lose records than memory
+
+
+    def prune(self):
+        '''delete the oldest files while the directory is larger than maxbytes'''
+        files = sorted(glob.glob(os.path.join(self.directory, 'trace-*.bin')))
+        sizes = {path: os.path.getsize(path) for path in files}
+        total = sum(sizes.values())
+        for path in files:
+            if total <= self.maxbytes or path == self.path:
+                break
+            os.remove(path)
+            total -= sizes[path]
+            my_logger.info('Trace %s deleted', path)
+
+
+    def close(self):
+        with self.lock:
+            self.write()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def istrace(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+class TraceReader():
+    """a trace file mapped into memory, iterating reads one record at a time.
+    A record cut off by a crash at the end is left out"""
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        if size < HEADERSIZE:
+            self.file.close()
+            raise ValueError("%s: no trace file" % path)
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, recordsize, _, self.wallstart, self.monostart = HEADER.unpack_from(self.map)
+        if magic != MAGIC or recordsize != RECORD.size:
+            self.close()
+            raise ValueError("%s: no trace file of version %d" % (path, VERSION))
+        self.count = (size - HEADERSIZE) // RECORD.size
+
+
+    def __len__(self):
+        return self.count
+
+
+    def __iter__(self):
+        view = memoryview(self.map)[HEADERSIZE:HEADERSIZE + self.count * RECORD.size]
+        blob = None #[time, kind, addr, length, data]
+        try:
+            for ms, kind, addr, aux, data in RECORD.iter_unpack(view):
+                if kind == KIND_MORE:
+                    if blob is not None:
+                        blob[4] += data
+                        if len(blob[4]) >= blob[3]:
+                            yield TraceRecord(blob[0], blob[1], blob[2], blob[3], blob[4][:blob[3]])
+                            blob = None
+                    continue
+                t = self.wallstart + ms / 1000.0
+                if kind in BLOBKINDS:
+                    blob = [t, kind, addr, aux, data]
+                    if aux <= 8:
+                        yield TraceRecord(t, kind, addr, aux, data[:aux])
+                        blob = None
+                else:
+                    yield TraceRecord(t, kind, addr, aux, data)
+        finally:
+            view.release()
+
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def airsamples(records, addr=None):
+    '''(time, addr, degC, hPa, %rH) of the bme280 frames, compensated with the
+    calibration recorded before them like bme280.BME280.read() does'''
+    calibrations = {}
+    for record in records:
+        if addr is not None and record.addr != addr:
+            continue
+        if record.kind == KIND_CALIBRATION:
+            calibrations[record.addr] = bme280.Calibration(*CALIBRATION.unpack(record.data))
+        elif record.kind == KIND_BME280 and record.addr in calibrations:
+            yield (record.time, record.addr) + tuple(bme280.compensate(calibrations[record.addr], record.data))
+
+
+def lightsamples(records, addr=None):
+    '''(time, addr, lux) of the bh1750 results'''
+    for record in records:
+        if record.kind == KIND_BH1750 and (addr is None or record.addr == addr):
+            lux = bh1750.convertToNumber(record.data)
+            if record.aux in (bh1750.CONTINUOUS_HIGH_RES_MODE_2, bh1750.ONE_TIME_HIGH_RES_MODE_2):
+                lux /= 2
+            yield record.time, record.addr, lux
+
+
+def gpiolevels(records):
+    '''(time, pin, level) of the inputs'''
+    for record in records:
+        if record.kind == KIND_GPIO:
+            yield record.time, record.addr, record.aux
+
+
+def tracepoints(path, origin):
+    '''weather and level events of a trace for hydro_sim, the first sensors
+    (lowest addresses) only. The start of the trace is moved to origin.
+    Returns (points for TraceWeather, [(unix time, pin, level), ...])'''
+    with TraceReader(path) as reader:
+        shift = origin - reader.wallstart
+        points = {}
+        events = []
+        airaddr = lightaddr = None
+        for record in reader:
+            if record.kind == KIND_BME280 and airaddr is None:
+                airaddr = record.addr
+            elif record.kind == KIND_BH1750 and lightaddr is None:
+                lightaddr = record.addr
+        for t, _, temp, press, hum in airsamples(reader, airaddr):
+            for field, value in (('temp', temp), ('press', press), ('hum', hum)):
+                points.setdefault(field, []).append((t + shift, value))
+        for t, _, lux in lightsamples(reader, lightaddr):
+            points.setdefault('lux', []).append((t + shift, lux))
+        for t, pin, level in gpiolevels(reader):
+            events.append((t + shift, pin, level))
+    return points, events
+
+
+def describe(record):
+    if record.kind == KIND_COMMAND:
+        topic, _, payload = record.data.partition(b'\0')
+        return "%s %r" % (topic.decode('utf-8', 'replace'), payload)
+    if record.kind == KIND_CALIBRATION:
+        return str(CALIBRATION.unpack(record.data))
+    if record.kind in (KIND_GPIO, KIND_PUMP):
+        return "%d" % record.aux
+    return "%s aux %d" % (record.data.hex(), record.aux)
+
+
+def main():
+    paths = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    for path in paths:
+        with TraceReader(path) as reader:
+            counts = {}
+            first = last = None
+            for record in reader:
+                counts[record.kind] = counts.get(record.kind, 0) + 1
+                first = record.time if first is None else first
+                last = record.time
+                if '--dump' in sys.argv:
+                    print("{:.3f} {} 0x{:02X} {}".format(record.time, KINDNAMES.get(record.kind, record.kind),
+                                                         record.addr, describe(record)))
+            span = (last - first) / 3600 if first is not None else 0.0
+            print("{}: {} records, {} bytes, {:.1f} h from {}".format(path, len(reader), os.path.getsize(path), span,
+                                                                     time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(reader.wallstart))))
+            print("  " + ", ".join("{} {}".format(KINDNAMES.get(kind, kind), n) for kind, n in sorted(counts.items())))
+            air = list(airsamples(reader))
+            if air:
+                temps = [sample[2] for sample in air]
+                print("  air: {} samples, {:.2f}..{:.2f} C".format(len(air), min(temps), max(temps)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+supervisor of the controller threads: every subsystem (event loop, sensor
+sampler, gpio debounce, mqtt) beats a heartbeat and says when the next
+beat is due at the latest. A subsystem that misses its deadline is
+recovered in place by its recover function (re-open the i2c bus and set
+the sensors up again, re-arm the gpio edge detection, restart the mqtt
+network loop), in a thread of its own, so a recovery that hangs too can't
+stop the supervisor.
+
+Under systemd (Type=notify, WatchdogSec=) the supervisor sends READY=1
+and then WATCHDOG=1 every round while the controller is fine. When a
+critical subsystem can't be recovered after some attempts (or has no
+recover function, like the event loop) the pings stop and systemd restarts
+the service, the last resort. Without systemd that is only logged.
+"""
+
+import os
+import time
+import socket
+import threading
+
+#our own modules
+from hydro_logger import my_logger
+import hydro_metrics
+
+__all__ = ['Watchdog', 'SystemdNotifier']
+
+STALLS = hydro_metrics.counter('hydro_watchdog_stalls_total', 'subsystems that missed their heartbeat deadline', ('subsystem',))
+RECOVERIES = hydro_metrics.counter('hydro_watchdog_recoveries_total', 'in place recovery attempts', ('subsystem',))
+RECOVERYERRORS = hydro_metrics.counter('hydro_watchdog_recovery_errors_total', 'recovery attempts that raised', ('subsystem',))
+RECOVERYSECONDS = hydro_metrics.histogram('hydro_watchdog_recovery_seconds', 'seconds from a missed deadline to the next heartbeat',
+                                          ('subsystem',), buckets=(1, 2, 5, 10, 20, 30, 60, 120, 300, 600))
+HEALTHY = hydro_metrics.gauge('hydro_watchdog_healthy', '1 while the subsystem beats in time', ('subsystem',))
+
+
+class SystemdNotifier():
+    """sd_notify without libsystemd: datagrams to $NOTIFY_SOCKET"""
+    def __init__(self):
+        path = os.environ.get('NOTIFY_SOCKET', '')
+        self.address = '\0' + path[1:] if path.startswith('@') else path #abstract namespace
+        self.sock = None
+        #seconds between watchdog pings, half of WatchdogSec like systemd suggests
+        usec = os.environ.get('WATCHDOG_USEC', '')
+        pid = os.environ.get('WATCHDOG_PID', '')
+        self.pinginterval = None
+        if usec.isdigit() and int(usec) > 0 and (not pid or pid == str(os.getpid())):
+            self.pinginterval = int(usec) / 2e6
+
+
+    def notify(self, *states):
+        '''send states like 'READY=1', False if there is no systemd to tell'''
+        if not self.address:
+            return False
+        try:
+            if self.sock is None:
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.sock.sendto('\n'.join(states).encode(), self.address)
+            return True
+        except OSError as e:
+            my_logger.debug('sd_notify error %s', e)
+            return False
+
+
+class Subsystem():
+    def __init__(self, name, deadline, recover, critical):
+        self.name = name
+        self.deadline = deadline
+        self.recover = recover
+        self.critical = critical
+        self.due = time.monotonic() + deadline #latest time of the next beat
+        self.stalled = False
+        self.attempts = 0 #recoveries since the last beat
+        self.nextattempt = 0.0
+        self.thread = None #running recovery
+        self.stalls = STALLS.labels(name)
+        self.recoveries = RECOVERIES.labels(name)
+        self.recoveryerrors = RECOVERYERRORS.labels(name)
+        self.recoveryseconds = RECOVERYSECONDS.labels(name)
+        self.healthy = HEALTHY.labels(name)
+        self.healthy.set(1)
+
+
+class Watchdog(threading.Thread):
+    """checks the heartbeats of the subsystems every interval seconds,
+    recovers the late ones and pings the systemd watchdog while all
+    critical ones are fine"""
+    def __init__(self, attempts=3, interval=1.0, notifier=None):
+        super().__init__(name='watchdog', daemon=True)
+        self.attempts = attempts
+        self.interval = interval
+        self.notifier = notifier or SystemdNotifier()
+        self.subsystems = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.failed = False #a critical subsystem is beyond recovery
+        self.lastping = 0.0
+
+
+    def add(self, name, deadline, recover=None, critical=True):
+        '''supervise name, its first beat is due within deadline seconds.
+        Returns its heartbeat function beat(nextin=0.0). Non critical
+        subsystems are recovered but never stop the systemd pings'''
+        with self.lock:
+            self.subsystems[name] = Subsystem(name, deadline, recover, critical)
+        return lambda nextin=0.0: self.beat(name, nextin)
+
+
+    def beat(self, name, nextin=0.0):
+        '''name is alive and beats again within nextin seconds plus its
+        deadline. Beats of subsystems that aren't supervised are ignored'''
+        subsystem = self.subsystems.get(name)
+        if subsystem is None:
+            return
+        now = time.monotonic()
+        if subsystem.stalled:
+            subsystem.recoveryseconds.observe(now - subsystem.due)
+            subsystem.healthy.set(1)
+            my_logger.info('Watchdog %s is back after %.1f s', name, now - subsystem.due)
+        subsystem.due = now + nextin + subsystem.deadline
+        subsystem.stalled = False
+        subsystem.attempts = 0
+
+
+    def recover(self, subsystem):
+        subsystem.recoveries.inc()
+        try:
+            subsystem.recover()
+            my_logger.warning('Watchdog %s recovered, attempt %d', subsystem.name, subsystem.attempts)
+        except Exception as e:
+            subsystem.recoveryerrors.inc()
+            my_logger.error('Watchdog %s recovery failed: %s', subsystem.name, e)
+
+
+    def check(self, now=None):
+        '''recover the subsystems that missed their deadline, returns False
+        if a critical one is beyond recovery'''
+        if now is None:
+            now = time.monotonic()
+        healthy = True
+        with self.lock:
+            subsystems = list(self.subsystems.values())
+        for subsystem in subsystems:
+            if now <= subsystem.due:
+                continue
+            if not subsystem.stalled:
+                subsystem.stalled = True
+                subsystem.stalls.inc()
+                subsystem.healthy.set(0)
+                my_logger.warning('Watchdog %s missed its heartbeat by %.1f s', subsystem.name, now - subsystem.due)
+            recovering = subsystem.thread is not None and subsystem.thread.is_alive()
+            #non critical ones are tried again and again, e.g. mqtt while the broker is down
+            if subsystem.recover is not None and not recovering and now >= subsystem.nextattempt \
+                    and (subsystem.attempts < self.attempts or not subsystem.critical):
+                #the next attempt only if this one didn't bring the heartbeat back in time
+                subsystem.attempts += 1
+                subsystem.nextattempt = now + subsystem.deadline
+                subsystem.thread = threading.Thread(target=self.recover, args=(subsystem,),
+                                                    name='recover-' + subsystem.name, daemon=True)
+                subsystem.thread.start()
+            elif subsystem.critical and (subsystem.recover is None or
+                                         (subsystem.attempts >= self.attempts and now >= subsystem.nextattempt)):
+                healthy = False
+        return healthy
+
+
+    def ready(self, status='running'):
+        '''the controller is up, for Type=notify services'''
+        self.notifier.notify('READY=1', 'STATUS=' + status)
+
+
+    def stop(self):
+        self.stopped.set()
+        self.notifier.notify('STOPPING=1')
+
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            healthy = self.check()
+            if not healthy and not self.failed:
+                late = ', '.join(s.name for s in self.subsystems.values() if s.stalled)
+                my_logger.critical('Watchdog: %s not recoverable, %s', late,
+                                   'systemd restarts the controller' if self.notifier.pinginterval else 'no systemd watchdog')
+                self.notifier.notify('STATUS=stalled: ' + late)
+            elif healthy and self.failed:
+                my_logger.warning('Watchdog: all subsystems are back')
+                self.notifier.notify('STATUS=running')
+            self.failed = not healthy
+            now = time.monotonic()
+            if healthy and self.notifier.pinginterval and now - self.lastping >= self.notifier.pinginterval:
+                self.notifier.notify('WATCHDOG=1')
+                self.lastping = now
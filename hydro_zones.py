@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+grow zones: every tray has its own pump, level switches, optional sensors,
+watering cycle and mqtt topics. The zones are declared in the config file
+(see hydro_config), e.g.
+
+[[zones]]
+name = "main"
+pump = 15
+tanklevel = 16
+returnlevel = 18
+bme280 = "0x76"
+bh1750 = "0x23"
+wateron = 5
+wateroff = 180
+
+[[zones]]
+name = "tray2"
+pump = 22
+tanklevel = 31
+bme280 = "0x77"
+bh1750 = "0x5C"
+
+Everything but name and pump is optional. The zone named main keeps the
+names the single tray controller used (topics iot/Hydroponic/..., schedule
+'pump', history 'air.temp', ...), the others get their name as prefix
+(iot/Hydroponic/tray2/..., 'tray2.pump', 'tray2.air.temp', ...).
+Without zones in the config there is just the main zone with the classic pins.
+"""
+
+#our own modules
+from hydro_logger import my_logger
+from hydro_gpio import GpioInterface
+
+__all__ = ['Zone', 'makezones', 'defaultzones']
+
+DEFAULTZONE = 'main'
+TOPICROOT = 'iot/Hydroponic'
+BME280ADDRS = (0x76, 0x77)
+BH1750ADDRS = (0x23, 0x5C)
+
+#pins the gpio interface always drives or watches, only the main zone may use them and only in that role
+CLASSICPINS = {'pump': GpioInterface.WATERPUMPOUTPUT, 'tanklevel': GpioInterface.WATERTANKLEVELINPUT,
+               'returnlevel': GpioInterface.WATERLEVELRETURNINPUT}
+#pins of the controller itself, no zone may use them
+RESERVEDPINS = (GpioInterface.HEARTBEATLED, GpioInterface.SHUTDOWNBUTTON, GpioInterface.STATUS1LED,
+                GpioInterface.STATUS2LED, GpioInterface.BUTTONUP, GpioInterface.BUTTONDOWN,
+                GpioInterface.BUTTONOK, GpioInterface.BUTTONCANCEL) + tuple(CLASSICPINS.values())
+
+
+class Zone():
+    """one grow tray, pins are board numbers, sensor addresses None if the
+    zone has no sensor of that kind"""
+    def __init__(self, name, pump, tanklevel=None, returnlevel=None, bme280=None, bh1750=None,
+                 wateron=5, wateroff=180, topic=None, root=TOPICROOT):
+        self.name = name
+        self.pump = pump
+        self.tanklevel = tanklevel
+        self.returnlevel = returnlevel
+        self.bme280 = bme280
+        self.bh1750 = bh1750
+        self.wateron = wateron
+        self.wateroff = wateroff
+        if topic is None:
+            topic = root if name == DEFAULTZONE else root + '/' + name
+        self.topic = topic
+
+
+    def key(self, name):
+        '''name of a schedule, sampler source or history metric of this zone'''
+        return name if self.name == DEFAULTZONE else self.name + '.' + name
+
+
+    def pins(self):
+        return [pin for pin in (self.pump, self.tanklevel, self.returnlevel) if pin is not None]
+
+
+    def __repr__(self):
+        return 'Zone(%s, pump %d)' % (self.name, self.pump)
+
+
+def defaultzones(root=TOPICROOT):
+    '''the single tray of the original controller'''
+    return [Zone(DEFAULTZONE, GpioInterface.WATERPUMPOUTPUT, GpioInterface.WATERTANKLEVELINPUT,
+                 GpioInterface.WATERLEVELRETURNINPUT, 0x76, 0x23, root=root)]
+
+
+def checkzones(zones):
+    '''raises ValueError for shared names, pins or sensor addresses'''
+    names, pins, addrs = set(), set(), set()
+    for zone in zones:
+        if not zone.name or '/' in zone.name or '.' in zone.name or zone.name in names:
+            raise ValueError("bad or duplicate zone name " + repr(zone.name))
+        names.add(zone.name)
+        for role, classic in CLASSICPINS.items():
+            pin = getattr(zone, role)
+            if pin is None or (zone.name == DEFAULTZONE and pin == classic):
+                continue
+            if pin in RESERVEDPINS or pin in pins:
+                raise ValueError("zone %s: pin %d is already in use" % (zone.name, pin))
+            pins.add(pin)
+        for addr, valid in ((zone.bme280, BME280ADDRS), (zone.bh1750, BH1750ADDRS)):
+            if addr is None:
+                continue
+            if addr not in valid or addr in addrs:
+                raise ValueError("zone %s: sensor address 0x%02X is invalid or already in use" % (zone.name, addr))
+            addrs.add(addr)
+
+
+def makezones(zoneconfigs, root=TOPICROOT):
+    '''Zone objects of the ZoneConfig entries of a Config, the default zone if there are none.
+    root is the topic of the main zone, see hydro_config.topicroot()'''
+    if not zoneconfigs:
+        return defaultzones(root)
+    zones = [Zone(root=root, **entry._asdict()) for entry in zoneconfigs]
+    checkzones(zones)
+    my_logger.info('Zones %s', ', '.join(zone.name for zone in zones))
+    return zones
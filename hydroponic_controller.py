@@ -8,139 +8,156 @@ monitors water level, air temp, light, humidity and controls water pump
 import sys
 import os
 import time
-import datetime
-import socket
-import paho.mqtt.client as mqtt
-import traceback
-from threading import Timer
-from smbus2 import SMBus
-from lib_oled96 import ssd1306
-import image
-from PIL import ImageFont
+import json
+import asyncio
 
 #our own modules
-from hydro_logger import my_logger
-from hydro_globals import SERIAL, MQTTSERVER
+from hydro_logger import my_logger, setlevel, setflushinterval, setlogfile
+from hydro_startup import startup
 import hydro_globals
-from bme280 import readBME280All
-from bh1750 import readLight
-from hydro_gpio import GpioInterface
-
-mqtt_disconnect_timestamp = None
-
-def internet(host="8.8.8.8", port=53, timeout=3):
-   """
-   Host: 8.8.8.8 (google-public-dns-a.google.com)
-   OpenPort: 53/tcp
-   Service: domain (DNS/TCP)
-   https://stackoverflow.com/questions/3764291/checking-network-connection
-   """
-   try:
-     socket.setdefaulttimeout(timeout)
-     socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect((host, port))
-     return True
-   except Exception as ex:
-     my_logger.critical(time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime()) + ' Network Error ' + str(ex))
-     return False
-
-
-def on_mqtt_connect(client, userdata, flags, rc):
-    global mqtt_disconnect_timestamp
-    my_logger.debug(time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime()) + " MQTT Connected with result code "+str(rc))
+import hydro_config
+import hydro_hal
+import hydro_metrics
+from bme280 import BME280, STANDBY_1000MS, FILTER_4
+from bh1750 import BH1750, CONTINUOUS_HIGH_RES_MODE_1, ONE_TIME_HIGH_RES_MODE_1
+from hydro_gpio import GpioInterface, GpioEventEngine, EVENT_SHUTDOWN, EVENT_TANKLEVEL, EVENT_RETURNLEVEL, EVENT_SENSOR
+from hydro_sampler import Sampler
+from hydro_i2c import bus as i2cbus
+from hydro_tasks import TaskRunner, ThreadsafeQueue
+from hydro_scheduler import Scheduler
+from hydro_telemetry import TelemetryPublisher
+from hydro_spool import Spool, StoreAndForward
+from hydro_history import HistoryStore
+from hydro_zones import makezones
+from hydro_interlock import Interlock, configrules
+from hydro_commands import CommandRouter, choice, integer, boolean, jsondoc
+from hydro_filters import airfilter, lightfilter, DailyLightIntegral
+from hydro_adaptive import AdaptiveRate
+from hydro_watchdog import Watchdog
+from hydro_trace import TraceRecorder
+
+#the settings that may change are in hydro_config
+SAMPLEMAXAGE = 5.0 #older samples count as measurement error
+SCHEDULEFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schedule.json')
+SPOOLDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spool')
+TRACEDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'trace')
+SPOOLDRAINRATE = 20 #spooled messages sent per second after a reconnect
+SPOOLMAXAGE = 3600 #seconds, older telemetry is dropped instead of sent late (mqtt 3.1.1)
+HISTORYFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'history.db')
+MQTTPROBETIMEOUT = 3 #seconds for opening a tcp connection to the broker
+MQTTPROBEMINDELAY = 1 #seconds between broker probes, doubled after every failure
+MQTTPROBEMAXDELAY = 60
+MAXMINUTES = 7 * 24 * 60 #longest watering phase settable by mqtt
+HISTORYMAXHOURS = 2 * 365 * 24
+
+MQTTCONNECTS = hydro_metrics.counter('hydro_mqtt_connects_total', 'mqtt connects, reconnects included')
+MQTTDISCONNECTS = hydro_metrics.counter('hydro_mqtt_disconnects_total', 'unexpected mqtt disconnects')
+MQTTRECONNECTS = hydro_metrics.counter('hydro_mqtt_forced_reconnects_total', 'reconnects after a long disconnect')
+STARTTIME = hydro_metrics.gauge('hydro_start_time_seconds', 'unix time the controller started')
+
+def on_mqtt_connect(client, userdata, flags, rc, properties=None):
+    my_logger.debug("MQTT Connected with result code %s", rc)
+    MQTTCONNECTS.inc()
+    startup.mark('mqttconnected')
     # Subscribing in on_connect() means that if we lose the connection and
-    # reconnect then subscriptions will be renewed.
-    client.subscribe("iot/Hydroponic/wateronminutes")
-    client.subscribe("iot/Hydroponic/wateroffminutes")
-    client.subscribe("iot/Hydroponic/setpumpon")
-    mqtt_disconnect_timestamp = None
+    # reconnect then subscriptions will be renewed. All topics in one request
+    subscriptions = userdata["router"].subscriptions()
+    if subscriptions:
+        client.subscribe(subscriptions)
 
 
 def on_mqtt_message(client, userdata, msg):
-    my_logger.debug(time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime()) + " Msg Rcvd: " + msg.topic+" "+str(msg.payload))
-    if msg.topic == "iot/Hydroponic/wateronminutes":
-        userdata["on"] = int(msg.payload)
-        if userdata["on"] < 2:
-             userdata["on"] = 2
-    if msg.topic == "iot/Hydroponic/wateroffminutes":
-        userdata["off"] = int(msg.payload)
-        if userdata["off"] < 30:
-             userdata["off"] = 30
-    if msg.topic == "iot/Hydroponic/setpumpon":
-        if userdata["pumpcallback"] is not None:
-            userdata["pumpcallback"](True if int(msg.payload)==1 else False)
-
-
-def on_mqtt_disconnect(client, userdata, rc):
-    global mqtt_disconnect_timestamp
-    if rc != 0:
-        my_logger.debug(time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime()) + " MQTT unexpected disconnect with resultcode " + str(rc))
-        mqtt_disconnect_timestamp = datetime.datetime.now()
-
-
-watertimer = Timer(0,None)
-waterison = False
-watertime = {"on":5, "off":180, "pumpcallback":None}
-nextwateron = None
-nextwateroff = None
-def operatewatertimer(waterswitchfunc):
-    global watertimer
-    global waterison
-    global watertime #in minutes
-    global nextwateron
-    global nextwateroff
-
-    try:
-        if watertimer.is_alive():
-            return
-
-        waterison = not waterison
+    my_logger.debug("Msg Rcvd: %s %s", msg.topic, msg.payload)
+    if userdata.get("recorder") is not None:
+        userdata["recorder"].command(msg.topic, msg.payload)
+    userdata["router"].onmessage(client, msg)
 
-        watertimer = Timer(watertime["on"] * 60 if waterison else watertime["off"] * 60, waterswitchfunc, [not waterison])
-        watertimer.start()
-        nextwateron = datetime.datetime.now()+datetime.timedelta(minutes=watertime["off"]) if not waterison else None
-        nextwateroff = datetime.datetime.now()+datetime.timedelta(minutes=watertime["on"]) if waterison else None
-    except Exceptions as e:
-        my_logger.critical(time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime()) + ' operate water timer Error ' + str(ex))
 
-
-def displayInit(oled):
-    try:
-        oled.cls()
-        oled.display()
-        font = ImageFont.truetype('FreeSans.ttf', 20)
-        draw = oled.canvas
-        draw.text((12, 10), "Hydroponic", font=font, fill=1)
-        draw.text((20, 35), "Controller", font=font, fill=1)
-        oled.display()
-    except:
-        pass
-
-
-def showValues(oled, temp, humidity, info):
-    try:
-        oled.cls()
-        oled.display()
-        draw = oled.canvas
-        font = ImageFont.truetype('FreeSans.ttf', 18)
-        draw.text((5, 1), "Temp: {:.1f}°C".format(temp), font=font, fill=1)
-        draw.text((5, 25), "Hum:  {:.0f} %".format(humidity), font=font, fill=1)
-        font = ImageFont.truetype('FreeSans.ttf', 14)
-        draw.text((5, 50), info, font=font, fill=1)
-        oled.display()
-    except:
-        pass
+def setloglevel(request):
+    setlevel(request.value)
+    my_logger.warning("Log level %s", request.value)
 
 
-def showInfo(oled, info):
-    try:
-        oled.cls()
-        oled.display()
-        draw = oled.canvas
-        font = ImageFont.truetype('FreeSans.ttf', 15)
-        draw.text((5, 1), info, font=font, fill=1)
-        oled.display()
-    except:
-        pass
+def on_mqtt_disconnect(client, userdata, rc, properties=None):
+    if rc != 0:
+        MQTTDISCONNECTS.inc()
+        my_logger.debug("MQTT unexpected disconnect with resultcode %s", rc)
+
+
+def zonereadings(zone, gpio, interlock, sampler):
+    '''latest samples and level switches of zone'''
+    result = {"time": round(time.time(), 1), "pump": bool(gpio.getpump(zone.pump))}
+    for name in (zone.key('air'), zone.key('light')):
+        sample = sampler.latest(name, SAMPLEMAXAGE) if name in sampler.sources else None
+        if sample is not None:
+            result.update(zip(sampler.buffer(name).fields, (round(value, 2) for value in sample.values)))
+    if zone.tanklevel is not None:
+        result["tankempty"] = not gpio.iswatertanklevelok(zone.tanklevel)
+    if zone.returnlevel is not None:
+        result["returnfull"] = not gpio.iswaterreturnlevelok(zone.returnlevel)
+    result["alarms"] = [rule.alarm for rule in interlock.active() if zone.pump in rule.pumps]
+    return result
+
+
+def zoneschedule(zone, scheduler):
+    schedule = zone.key('pump')
+    return {"wateron": zone.wateron, "wateroff": zone.wateroff, "pumpon": scheduler.ison(schedule),
+            "remaining": int(scheduler.remaining(schedule))}
+
+
+def zonehistory(zone, history, query):
+    '''points of one metric of zone, query is {"metric": "air.temp", "hours": 24, "tier": "1m"},
+    hours and tier are optional'''
+    metric = query.get("metric")
+    if not isinstance(metric, str):
+        raise ValueError("metric is missing")
+    hours = query.get("hours", 24)
+    if isinstance(hours, bool) or not isinstance(hours, (int, float)) or not 0 < hours <= HISTORYMAXHOURS:
+        raise ValueError("hours out of range 0..%d" % HISTORYMAXHOURS)
+    tier = query.get("tier")
+    if tier is not None and tier not in history.tiers:
+        raise ValueError("tier is one of " + ', '.join(history.tiers))
+    end = time.time()
+    tier = tier or history.tierfor(hours * 3600)
+    points = history.query(zone.key(metric), end - hours * 3600, end, tier)
+    return {"metric": metric, "tier": tier, "points": [[round(value, 3) for value in point] for point in points]}
+
+
+def zonequery(request, zone, gpio, interlock, scheduler, sampler, history):
+    '''<zone topic>/get/<what>, the payload is the query of history'''
+    what = request.args[0]
+    if what == "readings":
+        return zonereadings(zone, gpio, interlock, sampler)
+    if what == "schedule":
+        return zoneschedule(zone, scheduler)
+    if what == "history":
+        return zonehistory(zone, history, request.value)
+    raise ValueError("unknown query " + what)
+
+
+def setzonecycle(scheduler, zone, onminutes, offminutes):
+    setpumpschedule(scheduler, zone, onminutes, offminutes)
+    return zoneschedule(zone, scheduler) #the minimum may have raised the values
+
+
+def setzonepump(zone, gpio, state):
+    gpio.setpump(zone.pump, state)
+    return bool(gpio.getpump(zone.pump)) #the interlock may have said no
+
+
+def mqttcommands(router, zones, gpio, interlock, scheduler, sampler, history):
+    '''the commands of the controller, the settings and queries of every zone are below its topic'''
+    router.add('loglevel', hydro_config.topicroot() + "/loglevel", setloglevel, choice(*hydro_config.LOGLEVELS))
+    for zone in zones:
+        router.add('wateronminutes', zone.topic + "/wateronminutes",
+                   lambda request, zone=zone: setzonecycle(scheduler, zone, request.value, None), integer(1, MAXMINUTES))
+        router.add('wateroffminutes', zone.topic + "/wateroffminutes",
+                   lambda request, zone=zone: setzonecycle(scheduler, zone, None, request.value), integer(1, MAXMINUTES))
+        router.add('setpumpon', zone.topic + "/setpumpon",
+                   lambda request, zone=zone: setzonepump(zone, gpio, request.value), boolean)
+        router.add('get', zone.topic + "/get/+", lambda request, zone=zone: zonequery(
+            request, zone, gpio, interlock, scheduler, sampler, history), jsondoc)
+    return router
 
 
 def initmqtt(mqttclient):
@@ -148,132 +165,564 @@ def initmqtt(mqttclient):
     mqttclient.on_message = on_mqtt_message
     mqttclient.on_disconnect = on_mqtt_disconnect
     mqttclient.enable_logger()
-    mqttclient.will_set("iot/Hydroponic/Disconnect", "lost connection", retain=True)
+    mqttclient.will_set(hydro_config.topicroot() + "/Disconnect", "lost connection", retain=True)
     mqttclient.reconnect_delay_set(min_delay=1, max_delay=120)
+    config = hydro_config.get()
+    mqttclient.connect_async(config.mqtt.server, config.mqtt.port)
     mqttclient.loop_start()
-    mqttclient.connect(MQTTSERVER, 1883)
+
+
+async def probebroker(host, port, timeout=MQTTPROBETIMEOUT):
+    '''True if the broker accepts a tcp connection'''
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except (OSError, asyncio.TimeoutError) as e:
+        my_logger.debug('MQTT broker %s:%d not reachable %s', host, port, e)
+        return False
+    writer.close()
+    return True
+
+
+async def connectmqtt(mqttclient, watchdog):
+    '''probe the broker with exponential backoff, then connect. The controller
+    runs meanwhile, telemetry is spooled until the connection is up'''
+    delay = MQTTPROBEMINDELAY
+    while True:
+        config = hydro_config.get().mqtt
+        if await probebroker(config.server, config.port):
+            break
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, MQTTPROBEMAXDELAY)
+    startup.mark('brokerreachable')
+    initmqtt(mqttclient)
+    #a broker that is down is no reason for systemd to restart us
+    watchdog.add('mqtt', hydro_config.get().watchdog.mqttdeadline, lambda: recovermqtt(mqttclient), critical=False)
 
 
 def mqttdisconnectandshutdown(mqttclient):
     msg = time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime()) + ': Shutdown button pressed'
-    my_logger.info(msg)
-    mqttclient.publish("iot/Hydroponic/Shutdown", msg, retain=True).wait_for_publish()
+    my_logger.info('Shutdown button pressed')
+    if mqttclient.is_connected():
+        mqttclient.publish(hydro_config.topicroot() + "/Shutdown", msg, retain=True).wait_for_publish()
     mqttclient.disconnect()
     os.system("shutdown now -h")
     exit(0)
 
 
+def handlegpioevent(event, gpio, mqttclient, zones, telemetries):
+    '''react on a debounced input change right away'''
+    my_logger.debug("GPIO event %s %s", event.kind, event.state)
+    if event.kind == EVENT_SHUTDOWN and event.state:
+        hydro_globals.keep_running = False
+        mqttdisconnectandshutdown(mqttclient) #never returns
+    elif event.kind in (EVENT_TANKLEVEL, EVENT_RETURNLEVEL):
+        for zone in zones:
+            if event.pin == zone.tanklevel:
+                telemetries[zone.name].update("TankEmpty", "0" if event.state else "1")
+            elif event.pin == zone.returnlevel:
+                telemetries[zone.name].update("ReturnFull", "0" if event.state else "1")
+            else:
+                continue
+            telemetries[zone.name].flush()
+            break
+
+
+def initinterlock(config, zones, gpio):
+    '''dry run and overflow protection of every zone plus the configured sensors,
+    from now on every pump switch goes through the interlock'''
+    for entry in config.interlocks:
+        gpio.watchinput(entry.pin, EVENT_SENSOR, active=1 - entry.triplevel)
+    interlock = Interlock(gpio, configrules(config, zones), config.interlock.minoff)
+    gpio.interlock = interlock
+    for rule in interlock.active():
+        my_logger.warning('Interlock %s active at start', rule.name)
+    return interlock
+
+
+def publishalarm(rule, active, zones, telemetries):
+    '''alarm topic of the zones whose pumps the rule stopped or released'''
+    for zone in zones:
+        if zone.pump in rule.pumps:
+            telemetries[zone.name].update("Alarm/" + rule.alarm, "1" if active else "0")
+            telemetries[zone.name].flush()
+
+
+def setpumpschedule(scheduler, zone, onminutes, offminutes):
+    '''new watering cycle of zone, too short phases are raised to the minimum'''
+    limits = hydro_config.get().pump
+    if onminutes is not None:
+        zone.wateron = max(limits.minon, onminutes)
+    if offminutes is not None:
+        zone.wateroff = max(limits.minoff, offminutes)
+    scheduler.setdurations(zone.key('pump'), None if onminutes is None else zone.wateron * 60,
+                           None if offminutes is None else zone.wateroff * 60)
+
+
+def addpumpschedules(scheduler, zones, gpio):
+    '''one on/off cycle per zone, all switched by the one scheduler thread'''
+    for zone in zones:
+        scheduler.add(zone.key('pump'), zone.wateron * 60, zone.wateroff * 60,
+                      lambda state, pin=zone.pump: gpio.setpump(pin, state), startison=True)
+
+
+def inittelemetry(forwarder, zone, interlock=None):
+    '''which changes are worth a message, the heartbeat repeats every value after 10 minutes'''
+    telemetry = TelemetryPublisher(forwarder, prefix=zone.topic, mode=hydro_config.get().telemetry.mode)
+    if zone.bme280 is not None:
+        telemetry.addmetric("AirTemp", deadband=0.1, precision=2, retain=True)
+        telemetry.addmetric("AirPress", deadband=0.5, precision=1, retain=True)
+        telemetry.addmetric("AirRelHum", deadband=0.5, precision=1, retain=True)
+        telemetry.addmetric("DewPoint", deadband=0.2, precision=1, retain=True)
+        telemetry.addmetric("VPD", deadband=0.02, precision=2, retain=True)
+    if zone.bh1750 is not None:
+        telemetry.addmetric("Lux", deadband=5.0, precision=0, retain=True)
+        telemetry.addmetric("DLI", deadband=0.05, precision=2, retain=True, mininterval=60)
+    telemetry.addmetric("WaterPump")
+    if zone.tanklevel is not None:
+        telemetry.addmetric("TankEmpty")
+    if zone.returnlevel is not None:
+        telemetry.addmetric("ReturnFull")
+    telemetry.addmetric("wateroffcountdown", mininterval=60)
+    telemetry.addmetric("wateroncountdown", mininterval=60)
+    if interlock is not None:
+        active = interlock.active()
+        for rule in interlock.rules:
+            if zone.pump in rule.pumps:
+                telemetry.addmetric("Alarm/" + rule.alarm, retain=True)
+                telemetry.update("Alarm/" + rule.alarm, "1" if rule in active else "0")
+    return telemetry
+
+
+def airpower(sensor, low):
+    '''bme280 measuring on its own every second, or only when read'''
+    if low:
+        sensor.setForcedMode()
+    else:
+        sensor.setNormalMode(STANDBY_1000MS, FILTER_4)
+
+
+def lightpower(sensor, low):
+    '''bh1750 measuring all the time, or powered down between reads'''
+    sensor.setMode(ONE_TIME_HIGH_RES_MODE_1 if low else CONTINUOUS_HIGH_RES_MODE_1)
+
+
+def samplingpolicy(interval, steps, power):
+    '''AdaptiveRate of a sensor, None if sampling.slow is 0'''
+    settings = hydro_config.get().sampling
+    if not settings.slow:
+        return None
+    return AdaptiveRate(interval, settings.slow, steps, settings.settle, settings.lowpower, power)
+
+
+def initsampler(history, zones, interval=None, recorder=None):
+    '''sensors measure on their own, the sampler keeps the latest values. They are
+    read faster while the values change and after pump switches, see hydro_adaptive.
+    The raw values go to the recorder too, if there is one'''
+    if interval is None:
+        interval = hydro_config.get().intervals.sample
+    settings = hydro_config.get().filters
+    sampling = hydro_config.get().sampling
+    sampler = Sampler()
+    for zone in zones:
+        if zone.bme280 is not None:
+            airsensor = BME280(zone.bme280)
+            airsensor.recorder = recorder
+            policy = samplingpolicy(interval, {'temp': sampling.tempstep, 'hum': sampling.humstep},
+                                    lambda low, sensor=airsensor: airpower(sensor, low))
+            sampler.addsource(zone.key('air'), airsensor.read, interval, ('temp', 'press', 'hum'),
+                              setup=lambda sensor=airsensor, policy=policy: airpower(sensor, policy is not None and policy.low),
+                              pipeline=airfilter(settings), policy=policy)
+        if zone.bh1750 is not None:
+            lightsensor = BH1750(zone.bh1750)
+            lightsensor.recorder = recorder
+            #the light of today counts from before a restart
+            dli = DailyLightIntegral(settings.luxtoppfd)
+            last = history.last(zone.key('light.dli'))
+            if last is not None:
+                dli.resume(*last)
+            policy = samplingpolicy(interval, {'lux': sampling.luxstep}, lambda low, sensor=lightsensor: lightpower(sensor, low))
+            sampler.addsource(zone.key('light'), lightsensor.read, interval, ('lux',),
+                              setup=lambda sensor=lightsensor, policy=policy: lightpower(sensor, policy is not None and policy.low),
+                              pipeline=lightfilter(settings, dli), policy=policy)
+    sampler.addlistener(history.recordsample)
+    return sampler
+
+
+def boostsampling(gpio, sampler, zones):
+    '''the sensors of a zone are read fast for a while after its pump switched'''
+    boost = hydro_config.get().sampling.pumpboost
+    if not boost:
+        return
+    names = {zone.pump: (zone.key('air'), zone.key('light')) for zone in zones}
+    gpio.addpumplistener(lambda pin, state: sampler.boost(boost, names.get(pin, ())))
+
+
+def inittrace(config):
+    '''raw data recorder, None if trace.maxmb is 0'''
+    if not config.trace.maxmb:
+        return None
+    try:
+        return TraceRecorder(TRACEDIR, config.trace.maxmb * 1024 * 1024)
+    except OSError as e:
+        my_logger.error('Trace error %s', e)
+        return None
+
+
+def publishreadings(zone, telemetry, gpio, sampler, scheduler, history, readings):
+    '''publish the latest samples, pump state and countdown of zone, keep them for the display'''
+    try:
+        temp = hum = None
+        if zone.bme280 is not None:
+            air = sampler.latest(zone.key('air'), SAMPLEMAXAGE)
+            if air is None:
+                raise Exception("no recent sensor sample")
+            temp, press, hum, dew, deficit = air.values
+            telemetry.update("AirTemp", temp)
+            telemetry.update("AirPress", press)
+            telemetry.update("AirRelHum", hum)
+            telemetry.update("DewPoint", dew)
+            telemetry.update("VPD", deficit)
+        if zone.bh1750 is not None:
+            light = sampler.latest(zone.key('light'), SAMPLEMAXAGE)
+            if light is None:
+                raise Exception("no recent sensor sample")
+            telemetry.update("Lux", light.values[0])
+            telemetry.update("DLI", light.values[1])
+
+        now = time.time()
+        pumpon = bool(gpio.getpump(zone.pump))
+        telemetry.update("WaterPump", "1" if pumpon else "0")
+        history.record(zone.key("pump.on"), now, 1.0 if pumpon else 0.0)
+        if zone.tanklevel is not None:
+            tankok = gpio.iswatertanklevelok(zone.tanklevel)
+            telemetry.update("TankEmpty", "0" if tankok else "1")
+            history.record(zone.key("tank.empty"), now, 0.0 if tankok else 1.0)
+        if zone.returnlevel is not None:
+            returnok = gpio.iswaterreturnlevelok(zone.returnlevel)
+            telemetry.update("ReturnFull", "0" if returnok else "1")
+            history.record(zone.key("return.full"), now, 0.0 if returnok else 1.0)
+
+        schedule = zone.key('pump')
+        diff = int(scheduler.remaining(schedule))
+        countdown = "%02d:%02d:%02d" % (diff // (60 * 60), (diff // 60) % 60, diff % 60)
+        if scheduler.ison(schedule):
+            info = "AUS in " + countdown
+            telemetry.update("wateroffcountdown", countdown)
+            telemetry.update("wateroncountdown", None)
+
+        else:
+            info = "AN in " + countdown
+            telemetry.update("wateroncountdown", countdown)
+            telemetry.update("wateroffcountdown", None)
+    except Exception as e:
+        my_logger.debug("Measurement loop err %s: %s", zone.name, e)
+        readings["error"] = str(e)
+    else:
+        readings.update(temp=temp, hum=hum, info=info, error=None)
+    telemetry.flush()
+
+
+def publishzones(zones, telemetries, gpio, sampler, scheduler, history, readings):
+    '''publishreadings() of every zone, readings are kept per zone name'''
+    for zone in zones:
+        publishreadings(zone, telemetries[zone.name], gpio, sampler, scheduler, history,
+                        readings.setdefault(zone.name, {}))
+
+
+def reportstartup(mqttclient):
+    '''the startup phases, once after the first values went to the broker'''
+    if 'firstpublish' in startup.phases or not mqttclient.is_connected():
+        return
+    startup.mark('firstpublish')
+    my_logger.info('Startup %s', startup.summary())
+    mqttclient.publish(hydro_config.topicroot() + "/Startup", json.dumps(startup.asdict(), separators=(',', ':')), retain=True)
+
+
+def markfirstsample(name, fields, sample):
+    if 'firstsample' not in startup.phases:
+        startup.mark('firstsample')
+
+
+def refreshdisplay(display, readings, zones):
+    '''the display shows the configured zone, the first one by default'''
+    config = hydro_config.get().display
+    if config.mode == 'off':
+        display.show(())
+        return
+    readings = readings.get(config.zone or zones[0].name)
+    if not readings:
+        return #keep the start screen until the first values arrive
+    if readings["error"] is not None:
+        display.showinfo("Measurement Err")
+    elif readings["temp"] is None:
+        display.showinfo(readings["info"])
+    else:
+        display.showvalues(readings["temp"], readings["hum"], readings["info"])
+
+
+def supervisemqtt(mqttclient, watchdog):
+    '''the mqtt heartbeat, while paho is connected'''
+    if mqttclient.is_connected():
+        watchdog.beat('mqtt')
+
+
+def recovermqtt(mqttclient):
+    '''paho didn't get the connection back in time, connect now. loop_stop()
+    would join the network thread, which may hang just as long'''
+    MQTTRECONNECTS.inc()
+    try:
+        mqttclient.reconnect()
+    finally:
+        mqttclient.loop_start() #does nothing while the network thread is there
+
+
+def recoversampler(sampler):
+    '''a sensor read hangs: new i2c file descriptor, new sampler thread, sensors set up again'''
+    i2cbus.reset()
+    sampler.revive()
+
+
+def heartbeat(gpio, beat):
+    '''blink the heartbeat led and tell the watchdog the event loop runs'''
+    gpio.setheartbeatled(not gpio.getheartbeatled())
+    beat()
+
+
+def reporttaskstats(runner, mqttclient):
+    my_logger.debug("Tasks %s", runner.summary())
+    mqttclient.publish(hydro_config.topicroot() + "/TaskStats", json.dumps(runner.statsdict()))
+
+
+def publishmetrics(mqttclient):
+    '''self-metrics of this controller, the same values as on /metrics'''
+    mqttclient.publish(hydro_config.topicroot() + "/Metrics", json.dumps(hydro_metrics.registry.snapshot(), separators=(',', ':')))
+
+
+async def consumegpioevents(events, gpio, mqttclient, zones, telemetries):
+    while True:
+        event = await events.get()
+        try:
+            handlegpioevent(event, gpio, mqttclient, zones, telemetries)
+        except Exception:
+            my_logger.error('Gpio event %s error', event, exc_info=True)
+
+
+def applyconfig(old, new, zones, interlock, scheduler, sampler, history, runner, telemetries):
+    '''take over what changed in the config file, in the event loop thread.
+    new keeps the old values of what needs a restart, see hydro_config.reloadable()'''
+    if new.log != old.log:
+        setlevel(new.log.level)
+        setflushinterval(new.log.flushinterval)
+        setlogfile(new.log.file)
+    if new.intervals != old.intervals:
+        sampler.setinterval(new.intervals.sample)
+        history.flushinterval = new.intervals.historyflush
+        runner.setinterval('publish', new.intervals.publish)
+        runner.setinterval('display', new.intervals.display)
+        runner.setinterval('historyflush', new.intervals.historyflush)
+        runner.setinterval('selfmetrics', new.intervals.metrics)
+    for telemetry in telemetries.values():
+        telemetry.mode = new.telemetry.mode
+
+    #only watering cycles are changed live, mqtt may have changed them too
+    oldzones = {zone.name: zone for zone in old.zones}
+    newzones = {zone.name: zone for zone in new.zones}
+    for zone in zones:
+        before, after = oldzones.get(zone.name), newzones.get(zone.name)
+        if before is None or after is None or before == after:
+            continue
+        if before._replace(wateron=after.wateron, wateroff=after.wateroff) == after:
+            setpumpschedule(scheduler, zone, after.wateron if after.wateron != before.wateron else None,
+                            after.wateroff if after.wateroff != before.wateroff else None)
+            my_logger.info('Zone %s watering %d/%d min', zone.name, zone.wateron, zone.wateroff)
+
+    #the stop time is safe to change, the rules themselves are compiled once
+    interlock.minoff = new.interlock.minoff
+
+
+async def runcontroller(zones, gpio, interlock, sampler, scheduler, history, display, mqttclient, forwarder, watchdog, recorder=None):
+    '''all periodic work runs as independent tasks on the monotonic clock'''
+    runner = TaskRunner()
+    loop = asyncio.get_running_loop()
+    intervals = hydro_config.get().intervals
+    deadline = hydro_config.get().watchdog.deadline
+
+    #gpio changes are handled as soon as they arrive
+    events = ThreadsafeQueue(loop)
+    gpioevents = GpioEventEngine(gpio, events=events)
+    telemetries = {zone.name: inittelemetry(forwarder, zone, interlock) for zone in zones}
+    #the interlock stops the pumps in the gpio thread, the alarm is published from the loop
+    gpioevents.addlistener(interlock.onevent)
+    if recorder is not None:
+        gpioevents.addlistener(lambda event: recorder.gpio(event.pin, gpio.pincache.get(event.pin, 0)))
+        runner.every('traceflush', hydro_config.get().trace.flushinterval, recorder.flush, blocking=True)
+    interlock.addlistener(lambda rule, active: loop.call_soon_threadsafe(publishalarm, rule, active, zones, telemetries))
+    gpioevents.heartbeat = watchdog.add('gpio', deadline, gpioevents.restart)
+    gpioevents.start()
+    if recorder is not None:
+        recorder.watch(lambda: {pin: gpio.input(pin) for pin in gpioevents.inputs})
+    runner.spawn('gpioevents', consumegpioevents(events, gpio, mqttclient, zones, telemetries))
+    runner.every('interlock', 1, interlock.runpending)
+
+    readings = {}
+    #a hung event loop can't be recovered in place, systemd restarts the controller then
+    beat = watchdog.add('loop', deadline)
+    runner.every('heartbeat', 1, lambda: heartbeat(gpio, beat))
+    def publish():
+        publishzones(zones, telemetries, gpio, sampler, scheduler, history, readings)
+        reportstartup(mqttclient)
+
+    runner.every('publish', intervals.publish, publish)
+    runner.every('display', intervals.display, lambda: refreshdisplay(display, readings, zones), offset=0.2)
+    runner.every('historyflush', intervals.historyflush, history.flush, blocking=True, offset=intervals.historyflush)
+    runner.every('spooldrain', 1, forwarder.drain, blocking=True)
+    runner.every('spoolsync', 30, forwarder.spool.sync, blocking=True)
+    runner.every('mqttwatch', 5, lambda: supervisemqtt(mqttclient, watchdog))
+    runner.every('i2cstats', 120, lambda: my_logger.debug("I2C %s", i2cbus.summary()), offset=120)
+    runner.every('taskstats', 600, lambda: reporttaskstats(runner, mqttclient), offset=600)
+    runner.every('selfmetrics', intervals.metrics, lambda: publishmetrics(mqttclient), offset=intervals.metrics)
+
+    #the broker may take a while, everything else runs already
+    runner.once('mqttconnect', connectmqtt(mqttclient, watchdog))
+
+    #config file changes are applied without a restart
+    watcher = hydro_config.ConfigWatcher(hydro_config.CONFIGFILE, lambda old, new: loop.call_soon_threadsafe(
+        applyconfig, old, new, zones, interlock, scheduler, sampler, history, runner, telemetries))
+    watcher.start()
+    watchdog.ready()
+
+    try:
+        await runner.run()
+    finally:
+        watcher.stop()
+        gpioevents.stop()
+
+
+def gatewaymain():
+    '''--gateway: no tray of its own, follows the controllers below gateway.prefix'''
+    try:
+        config = hydro_config.load(hydro_config.CONFIGFILE)
+        hydro_config.activate(config)
+        setlogfile(config.log.file)
+        setlevel(config.log.level)
+        setflushinterval(config.log.flushinterval)
+        if config.metrics.port:
+            try:
+                hydro_metrics.MetricsServer(config.metrics.port).start()
+            except Exception as e:
+                my_logger.error('Metrics server error %s', e)
+        from hydro_gateway import rungateway
+        rungateway(config)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        hydro_globals.keep_running = False
+        my_logger.info('Hydroponic Gateway: main loop ended')
+
+
 def main():
-    global mqtt_disconnect_timestamp
-    global nextwateron
-    global nextwateroff
-    global waterison
-    global watertime
     ''' main
     '''
+    if '--gateway' in sys.argv:
+        gatewaymain()
+        return
     my_logger.debug('Start Debug Log hydroponic controller')
+    STARTTIME.set(time.time())
+    startup.mark('imports')
 
     try:
-        gpio = GpioInterface()
-        #initially, switch water on
-        gpio.setwaterpump(True)
-
-        i2cbus = SMBus(1)
-        oled = ssd1306(i2cbus)
-        displayInit(oled)
-
-        #wait for network. run on after some retries, so that control is working anyhow
-        for _ in range(20):
-            if internet() is True:
-                break
-            else:
-                time.sleep(30)
-
-        mqttclient = mqtt.Client(SERIAL, transport="tcp")
-        initmqtt(mqttclient)
-        watertime["pumpcallback"] = gpio.setwaterpump
-        mqttclient.user_data_set(watertime)
-
-        loopcnt = 0
-        minute2action = False
-
-        ### main loop
-        while(hydro_globals.keep_running):
-            minute = int(time.strftime('%M'))
-            time.sleep(1)
-
-            #every second
-            if gpio.isshutdownpressed():
-                hydro_globals.keep_running = False
-                mqttdisconnectandshutdown(mqttclient) #never returns
-
-            gpio.setheartbeatled(not gpio.getheartbeatled())
-            loopcnt += 1
-
-            #every 10 secs
-            if loopcnt % 10 == 0:
-                operatewatertimer(gpio.setwaterpump)
-
-                try:
-                    temp, press, hum = readBME280All()
-                    mqttclient.publish("iot/Hydroponic/AirTemp", temp, retain=True)
-                    mqttclient.publish("iot/Hydroponic/AirPress", press, retain=True)
-                    mqttclient.publish("iot/Hydroponic/AirRelHum", hum, retain=True)
-                    lux = readLight()
-                    mqttclient.publish("iot/Hydroponic/Lux", lux, retain=True)
-
-                    mqttclient.publish("iot/Hydroponic/WaterPump", "1" if gpio.getwaterpump() else "0")
-                    mqttclient.publish("iot/Hydroponic/TankEmpty", "0" if gpio.iswatertanklevelok() else "1")
-                    mqttclient.publish("iot/Hydroponic/ReturnFull", "0" if gpio.iswaterreturnlevelok() else "1")
-
-                    if waterison:
-                        diff = nextwateroff-datetime.datetime.now()
-                        countdown = "%02d:%02d:%02d" % (int(diff.seconds // (60 * 60)), int((diff.seconds // 60) % 60), int(diff.seconds%60))
-                        info = "AUS in " + countdown
-                        mqttclient.publish("iot/Hydroponic/wateroffcountdown", countdown)
-
-                    else:
-                        diff = nextwateron-datetime.datetime.now()
-                        countdown = "%02d:%02d:%02d" % (int(diff.seconds // (60 * 60)), int((diff.seconds // 60) % 60), int(diff.seconds%60))
-                        info = "AN in " + countdown
-                        mqttclient.publish("iot/Hydroponic/wateroncountdown", countdown)
-                except Exception as e:
-                    my_logger.debug(time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime()) + " Measurement loop err: " + str(e))
-                    showInfo(oled, "Measurement Err")
-                else:
-                    showValues(oled, temp, hum, info)
-
-            if minute%2 == 0 and not minute2action:
-                #every other minute
-                minute2action = True
-
-                if mqtt_disconnect_timestamp is not None:
-                    span = datetime.datetime.now() - mqtt_disconnect_timestamp
-                    if span.seconds > 600:
-                        mqttclient.reconnect()
-
-            #reset done-flags after a minute is over
-            if minute != int(time.strftime('%M')):
-                minute2action = False
-
-        mqttclient.publish("iot/Hydroponic/Shutdown", msg, retain=True).wait_for_publish()
+        config = hydro_config.load(hydro_config.CONFIGFILE)
+        hydro_config.activate(config)
+        setlogfile(config.log.file)
+        setlevel(config.log.level)
+        setflushinterval(config.log.flushinterval)
+        startup.mark('config')
+
+        if config.metrics.port:
+            try:
+                hydro_metrics.MetricsServer(config.metrics.port).start()
+            except Exception as e:
+                my_logger.error('Metrics server error %s', e)
+
+        #raw sensor frames, gpio levels and commands for reproducing field issues
+        recorder = inittrace(config)
+
+        #the threads beat heartbeats, hung ones are recovered in place
+        watchdog = Watchdog(config.watchdog.attempts)
+        watchdog.start()
+
+        zones = makezones(config.zones, hydro_config.topicroot(config))
+        gpio = GpioInterface(zones)
+        interlock = initinterlock(config, zones, gpio)
+        if recorder is not None:
+            gpio.addpumplistener(recorder.pump)
+
+        #resume the pump cycles where they were, switch water on if there is no saved state
+        scheduler = Scheduler(SCHEDULEFILE)
+        addpumpschedules(scheduler, zones, gpio)
+        scheduler.start()
+        startup.mark('pump')
+
+        history = HistoryStore(HISTORYFILE, config.intervals.historyflush)
+        sampler = initsampler(history, zones, recorder=recorder)
+        sampler.addlistener(markfirstsample)
+        boostsampling(gpio, sampler, zones)
+        sampler.heartbeat = watchdog.add('sampler', config.watchdog.deadline, lambda: recoversampler(sampler))
+        sampler.start()
+        startup.mark('sampler')
+
+        #pil and the oled driver are imported only now, they are slow to load.
+        #Rendering and i2c transfer happen in the display thread
+        from hydro_display import Display
+        display = Display(hydro_hal.getoled(i2cbus))
+        display.start()
+        display.showinit()
+        startup.mark('display')
+
+        #commands run in their own thread, not in paho's
+        router = mqttcommands(CommandRouter(), zones, gpio, interlock, scheduler, sampler, history)
+        router.start()
+
+        #connecting is left to the event loop, see connectmqtt()
+        import paho.mqtt.client as mqtt
+        protocol = mqtt.MQTTv5 if config.mqtt.protocol == 5 else mqtt.MQTTv311
+        mqttclient = mqtt.Client(config.controller.serial, transport="tcp", protocol=protocol, userdata={"router": router, "recorder": recorder})
+        startup.mark('mqttclient')
+
+        #telemetry is spooled to the sd card while the broker is not reachable
+        forwarder = StoreAndForward(mqttclient, Spool(SPOOLDIR), SPOOLDRAINRATE,
+                                    timestamps=config.mqtt.protocol == 5, maxage=SPOOLMAXAGE)
+
+        asyncio.run(runcontroller(zones, gpio, interlock, sampler, scheduler, history, display, mqttclient, forwarder, watchdog, recorder))
+
+        msg = time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime()) + ': Controller stopped'
+        if mqttclient.is_connected():
+            mqttclient.publish(hydro_config.topicroot() + "/Shutdown", msg, retain=True).wait_for_publish()
         mqttclient.disconnect()
         mqttclient.loop_stop()
 
     except KeyboardInterrupt:
         pass
     except:
-        my_logger.error(time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime()) + ' Hydroponic Controller: Unexpected error: ' + traceback.format_exc())
+        my_logger.error('Hydroponic Controller: Unexpected error', exc_info=True)
         raise
         #return
     finally:
         try:
-            gpio.setwaterpump(False)
+            for pin in gpio.pumps:
+                gpio.setpump(pin, False)
             gpio.setheartbeatled(False)
+            scheduler.stop()
+            router.stop()
+            forwarder.spool.close()
+            history.close()
+            if recorder is not None:
+                recorder.close()
+            watchdog.stop()
         except:
             pass
         hydro_globals.keep_running = False
-        my_logger.info(time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime()) + ' Hydroponic Controller: main loop ended')
+        my_logger.info('Hydroponic Controller: main loop ended')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+"""
+pytest setup: the modules are imported from the repository root and use
+the simulated devices of hydro_sim, so the tests run on any box
+"""
+
+import os
+import sys
+
+os.environ.setdefault('HYDRO_BACKEND', 'sim')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
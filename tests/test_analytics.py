@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+hydro_analytics: period statistics and reading the history tiers
+"""
+
+import time
+
+import numpy as np
+import pytest
+
+from hydro_history import HistoryStore
+from hydro_analytics import PeriodStats, historychunks, analyse
+
+DAY = 86400.0
+START = (time.time() // DAY - 1) * DAY #midnight utc yesterday, the history prunes older raw data
+OPTIONS = {'period': 'day', 'resample': None, 'humlow': 40.0, 'humhigh': 80.0,
+           'maxgap': 300.0, 'utc': True, 'config': None}
+
+
+def test_mean_is_time_weighted():
+    stats = PeriodStats(DAY, utc=True)
+    stats.add(np.array([0.0, 100.0, 400.0]), np.array([10.0, 20.0, 20.0]))
+    stats.finish()
+    result = stats.result(0)
+    assert result['seconds'] == 400.0
+    assert result['mean'] == pytest.approx((10.0 * 100 + 20.0 * 300) / 400)
+    assert (result['min'], result['max'], result['count']) == (10.0, 20.0, 3)
+
+
+def test_gaps_count_up_to_maxgap():
+    stats = PeriodStats(DAY, maxgap=60.0, utc=True)
+    stats.add(np.array([0.0, 1000.0]), np.array([1.0, 1.0]))
+    stats.finish()
+    assert stats.result(0)['seconds'] == 60.0
+
+
+def test_held_value_is_split_at_midnight():
+    stats = PeriodStats(DAY, high=0.5, maxgap=float('inf'), utc=True)
+    stats.add(np.array([DAY - 3600.0, DAY + 1800.0]), np.array([1.0, 0.0]))
+    stats.finish()
+    first, second = stats.result(0), stats.result(1)
+    assert (first['excursions'], first['excursionseconds']) == (1, 3600.0)
+    assert (second['excursions'], second['excursionseconds']) == (0, 1800.0)
+    assert second['count'] == 1 #the carried over part is no value of its own
+
+
+def test_chunks_give_the_same_result_as_one_array():
+    ts = np.arange(0.0, 3 * DAY, 7.0)
+    values = 60.0 + 30.0 * np.sin(ts / 5000.0)
+    whole = PeriodStats(DAY, 40.0, 80.0, utc=True)
+    whole.add(ts, values)
+    whole.finish()
+    chunked = PeriodStats(DAY, 40.0, 80.0, utc=True)
+    for i in range(0, len(ts), 1000):
+        chunked.add(ts[i:i + 1000], values[i:i + 1000])
+    chunked.finish()
+    assert sorted(whole.periods) == sorted(chunked.periods)
+    for key in whole.periods:
+        assert whole.result(key) == pytest.approx(chunked.result(key))
+
+
+def test_history_shorter_than_an_hour_is_read_raw(tmp_path):
+    path = str(tmp_path / 'history.db')
+    history = HistoryStore(path)
+    for i in range(243):
+        history.record('air.temp', START + 600 + i * 10.0, 20.0 + i / 100)
+    history.close()
+
+    chunks = list(historychunks(path))
+    assert [(zone, metric, maxgap) for zone, metric, _, _, _, _, maxgap in chunks] == [('main', 'air.temp', 0.0)]
+    assert len(chunks[0][2]) == 243
+
+    rows = analyse('test', [path], OPTIONS)
+    assert len(rows) == 1
+    assert rows[0]['hours'] == pytest.approx(242 * 10 / 3600, abs=0.01)
+    assert rows[0]['temp_min'] == 20.0
+
+
+def test_history_tiers_are_handed_over(tmp_path):
+    path = str(tmp_path / 'history.db')
+    tiers = {'raw': (0, 3600), '1m': (60, 2 * 3600), '1h': (3600, 100 * 3600)}
+    history = HistoryStore(path, tiers=tiers)
+    start = time.time() - 4 * 3600
+    for i in range(4 * 360):
+        history.record('air.temp', start + i * 10.0, 20.0)
+    history.flush() #prunes to the retention of the tiers
+    history.close()
+
+    chunks = list(historychunks(path))
+    assert [maxgap for *_, maxgap in chunks] == [3600.0, 60.0, 0.0]
+    ts = np.concatenate([chunk[2] for chunk in chunks])
+    assert np.all(np.diff(ts) > 0)
+    hours, minutes, raw = (chunk[2] for chunk in chunks)
+    assert hours[-1] + 3600 <= minutes[0] and minutes[-1] + 60 <= raw[0]
+    assert raw[-1] - raw[0] > 3000 #the last hour is all raw
+
+
+def lighthistory(path, days, seconds=3600, lux=10000.0):
+    history = HistoryStore(path)
+    for day in range(days):
+        for i in range(int(seconds // 10)):
+            history.record('light.lux', START + day * DAY + 12 * 3600 + i * 10.0, lux)
+        history.record('light.lux', START + day * DAY + 12 * 3600 + seconds, 0.0) #lights off
+    history.close()
+
+
+def test_dli_counts_only_the_light_measured(tmp_path):
+    path = str(tmp_path / 'history.db')
+    lighthistory(path, 1, seconds=360) #0.1 h of 10000 lux
+    rows = analyse('test', [path], OPTIONS)
+    assert rows[0]['dli'] == pytest.approx(10000 * 360 * 0.0185 / 1e6, abs=0.01)
+
+
+def test_weekly_dli_is_the_mean_of_the_days_with_data(tmp_path):
+    path = str(tmp_path / 'history.db')
+    lighthistory(path, 2)
+    day = 10000 * 3600 * 0.0185 / 1e6
+    daily = analyse('test', [path], OPTIONS)
+    assert [row['dli'] for row in daily] == [pytest.approx(day, abs=0.01)] * 2
+    weekly = analyse('test', [path], dict(OPTIONS, period='week'))
+    #both days in one week or, on a monday, one day in each
+    assert [row['dli'] for row in weekly] == [pytest.approx(day, abs=0.01)] * len(weekly)
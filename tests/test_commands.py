@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+hydro_commands: topic trie and command router
+"""
+
+import json
+from collections import namedtuple
+
+import pytest
+
+from hydro_commands import CommandRouter, TopicTrie, integer
+
+Message = namedtuple('Message', ['topic', 'payload'])
+
+
+class Client():
+    def __init__(self):
+        self.published = [] #(topic, payload)
+
+
+    def publish(self, topic, payload=None, properties=None):
+        self.published.append((topic, payload))
+
+
+def matches(trie, topic):
+    return sorted(trie.match(topic))
+
+
+def test_exact_and_wildcard_filters():
+    trie = TopicTrie()
+    trie.insert('a/b/c', 'exact')
+    trie.insert('a/+/c', 'plus')
+    trie.insert('a/#', 'hash')
+    trie.insert('+/+', 'two')
+    assert matches(trie, 'a/b/c') == [('exact', ()), ('hash', ('b/c',)), ('plus', ('b',))]
+    assert matches(trie, 'a/x') == [('hash', ('x',)), ('two', ('a', 'x'))]
+    assert matches(trie, 'b/c/d') == []
+
+
+def test_hash_matches_the_parent_level():
+    trie = TopicTrie()
+    trie.insert('a/#', 'hash')
+    assert trie.match('a') == [('hash', ('',))]
+
+
+def test_wildcards_at_the_first_level_leave_dollar_topics_alone():
+    trie = TopicTrie()
+    trie.insert('#', 'all')
+    trie.insert('+/broker', 'plus')
+    trie.insert('$SYS/#', 'sys')
+    assert trie.match('$SYS/broker') == [('sys', ('broker',))]
+
+
+def test_several_values_under_one_filter():
+    trie = TopicTrie()
+    trie.insert('a/b', 1)
+    trie.insert('a/b', 2)
+    assert matches(trie, 'a/b') == [(1, ()), (2, ())]
+
+
+@pytest.mark.parametrize('topicfilter', ['', 'a/#/b', 'a/b#', 'a+/b', 'a\0b'])
+def test_invalid_filters_are_refused(topicfilter):
+    with pytest.raises(ValueError):
+        TopicTrie().insert(topicfilter, None)
+
+
+def test_router_replies_to_the_request_topic():
+    router = CommandRouter()
+    router.add('minutes', 'hydro/+/minutes', lambda request: (request.args[0], request.value), integer(1, 60))
+    client = Client()
+    router.onmessage(client, Message('hydro/tray2/minutes', b'15'))
+    router.onmessage(client, Message('hydro/tray2/minutes', b'99')) #no result, no response topic: no reply
+    router.onmessage(client, Message('hydro/unknown', b'1'))
+    router.runpending()
+    assert [(topic, json.loads(payload)) for topic, payload in client.published] == [
+        ('hydro/tray2/minutes/reply', {"ok": True, "result": ["tray2", 15]})]
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+hydro_config: reloading keeps what needs a restart
+"""
+
+import pytest
+
+import hydro_config
+
+BEFORE = '''
+[mqtt]
+server = "broker1"
+topicroot = "iot/Hydroponic"
+[intervals]
+publish = 10.0
+[interlock]
+holdoff = 60.0
+minoff = 120.0
+[[zones]]
+name = "main"
+pump = 15
+wateron = 5
+'''
+
+AFTER = '''
+[mqtt]
+server = "broker2"
+topicroot = "iot/Hydroponic/{serial}"
+[intervals]
+publish = 5.0
+[interlock]
+holdoff = 10.0
+minoff = 30.0
+[display]
+zone = "tray2"
+[[zones]]
+name = "main"
+pump = 15
+wateron = 7
+[[zones]]
+name = "tray2"
+pump = 22
+'''
+
+
+@pytest.fixture
+def active():
+    yield
+    hydro_config.activate(None)
+
+
+def test_reload_keeps_the_restart_only_settings(tmp_path, active):
+    path = tmp_path / 'hydro.toml'
+    path.write_text(BEFORE)
+    hydro_config.activate(hydro_config.load(str(path)))
+    changes = []
+    watcher = hydro_config.ConfigWatcher(str(path), lambda old, new: changes.append((old, new)))
+    path.write_text(AFTER)
+    watcher.signature = None #as if the file had changed on disk
+
+    config = watcher.reload()
+    assert hydro_config.get() is config and changes == [(changes[0][0], config)]
+    assert config.mqtt.server == 'broker1'
+    assert hydro_config.topicroot() == 'iot/Hydroponic'
+    assert config.interlock == (60.0, 30.0)
+    assert [(zone.name, zone.wateron) for zone in config.zones] == [('main', 7)]
+    assert config.display.zone == ''
+    assert config.intervals.publish == 5.0
+
+
+def test_reload_of_restart_only_changes_activates_nothing(tmp_path, active):
+    path = tmp_path / 'hydro.toml'
+    path.write_text(BEFORE)
+    hydro_config.activate(hydro_config.load(str(path)))
+    old = hydro_config.get()
+    watcher = hydro_config.ConfigWatcher(str(path), lambda old, new: None)
+    path.write_text(BEFORE.replace('broker1', 'broker2'))
+    watcher.signature = None
+    assert watcher.reload() is None
+    assert hydro_config.get() is old
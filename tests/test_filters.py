@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+hydro_filters: the stages, sample filters and derived values
+"""
+
+import math
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from hydro_filters import (Range, Outliers, Median, Slew, Ema, Chain, DailyLightIntegral,
+                           dewpoint, vpd, airfilter, lightfilter)
+
+SETTINGS = SimpleNamespace(outliers=4.0, median=3, smoothing=0.0, luxtoppfd=0.0185)
+
+
+def run(stage, values, interval=1.0):
+    return [stage.process(i * interval, value) for i, value in enumerate(values)]
+
+
+def test_range_drops_nan_and_values_outside():
+    assert run(Range(0.0, 100.0), [-1.0, 0.0, 100.0, 100.5, math.nan]) == [None, 0.0, 100.0, None, None]
+
+
+def test_outliers_drops_a_spike_but_follows_a_step():
+    stage = Outliers(k=4.0, floor=1.0, maxrejects=2)
+    assert run(stage, [20.0, 20.2, 35.0, 20.1]) == [20.0, 20.2, None, 20.1]
+    assert run(stage, [30.0, 30.0, 30.0, 30.1]) == [None, None, 30.0, 30.1]
+
+
+def test_median_removes_single_spikes_and_keeps_steps():
+    assert run(Median(3), [1.0, 1.0, 9.0, 1.0, 5.0, 5.0, 5.0]) == [1.0, 1.0, 1.0, 1.0, 5.0, 5.0, 5.0]
+
+
+def test_slew_limits_the_rate_per_second():
+    assert run(Slew(0.5), [20.0, 25.0, 25.0], interval=2.0) == [20.0, 21.0, 22.0]
+
+
+def test_ema_smooths_by_time_not_by_samples():
+    slow, fast = Ema(10.0), Ema(10.0)
+    run(slow, [0.0, 1.0], interval=10.0)
+    run(fast, [0.0] + [1.0] * 10, interval=1.0)
+    assert slow.value == pytest.approx(fast.value)
+    assert slow.value == pytest.approx(1.0 - math.exp(-1.0))
+
+
+def test_chain_stops_at_the_first_drop():
+    slew = Slew(1.0)
+    chain = Chain(Range(0.0, 10.0), slew)
+    assert chain.process(0.0, 5.0) == 5.0
+    assert chain.process(1.0, 50.0) is None
+    assert slew.last == 0.0 #the dropped value never got there
+
+
+def test_dewpoint_and_vpd():
+    assert dewpoint(20.0, 100.0) == pytest.approx(20.0, abs=0.01)
+    assert dewpoint(25.0, 50.0) == pytest.approx(13.85, abs=0.05)
+    assert vpd(25.0, 100.0) == 0.0
+    assert vpd(25.0, 60.0) == pytest.approx(1.27, abs=0.01)
+
+
+def test_daily_light_integral_caps_gaps_and_starts_at_midnight():
+    midnight = time.mktime(time.localtime()[:3] + (0, 0, 0, 0, 0, -1))
+    dli = DailyLightIntegral(factor=0.02, maxgap=60.0)
+    dli.process(midnight + 3600, 10000.0) #200 umol/m2/s
+    assert dli.process(midnight + 3630, 10000.0) == pytest.approx(200 * 30 * 1e-6)
+    assert dli.process(midnight + 7200, 0.0) == pytest.approx(200 * 90 * 1e-6) #gap counts 60 s
+    assert dli.process(midnight + 86400 + 10, 10000.0) == 0.0
+
+
+def test_air_filter_adds_dew_point_and_vpd():
+    pipeline = airfilter(SETTINGS)
+    assert pipeline.fields == ('temp', 'press', 'hum', 'dewpoint', 'vpd')
+    temp, press, hum, dew, deficit = pipeline.process(0.0, (25.0, 1000.0, 60.0))
+    assert (temp, press, hum) == (25.0, 1000.0, 60.0)
+    assert deficit == pytest.approx(vpd(25.0, 60.0))
+    assert pipeline.process(1.0, (25.0, 1000.0, 120.0)) is None #humidity out of range drops the sample
+
+
+def test_light_filter_keeps_steps():
+    pipeline = lightfilter(SETTINGS)
+    values = [pipeline.process(float(i), (lux,))[0] for i, lux in enumerate([0.0, 0.0, 20000.0, 20000.0, 20000.0])]
+    assert values == [0.0, 0.0, 0.0, 20000.0, 20000.0]
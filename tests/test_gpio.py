@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+"""
+hydro_gpio: pump switching on the simulated pins
+"""
+
+from hydro_gpio import GpioInterface
+
+PUMP = GpioInterface.WATERPUMPOUTPUT
+
+
+def test_failing_pump_listener_does_not_stop_the_others():
+    gpio = GpioInterface()
+    switched = []
+
+    def broken(pin, state):
+        raise OSError('No space left on device')
+
+    gpio.addpumplistener(broken)
+    gpio.addpumplistener(lambda pin, state: switched.append((pin, state)))
+    gpio.outputpump(PUMP, True)
+    gpio.outputpump(PUMP, False)
+    assert switched == [(PUMP, True), (PUMP, False)]
+    assert not gpio.getpump(PUMP)
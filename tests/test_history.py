@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+hydro_history: batches, rollups, retention and failed flushes
+"""
+
+import sqlite3
+import time
+
+import pytest
+
+from hydro_history import HistoryStore, MAXPENDING
+
+START = time.time() // 3600 * 3600 - 3 * 3600 #recent, older raw data is pruned
+
+
+@pytest.fixture
+def history(tmp_path):
+    store = HistoryStore(str(tmp_path / 'history.db'))
+    yield store
+    store.close()
+
+
+def test_raw_points_and_rollups(history):
+    for i in range(120):
+        history.record('air.temp', START + i * 1.0, float(i % 60))
+    assert history.flush() == 120
+    assert len(history.query('air.temp', START, START + 200, 'raw')) == 120
+    minutes = history.query('air.temp', START, START + 200, '1m')
+    assert minutes == [(START, 0.0, 59.0, 29.5), (START + 60, 0.0, 59.0, 29.5)]
+    assert history.query('air.temp', START, START + 200, '1h') == [(START, 0.0, 59.0, 29.5)]
+    assert history.last('air.temp') == (START + 119, 59.0)
+
+
+def test_rollups_add_up_over_flushes(history):
+    history.record('air.hum', START, 10.0)
+    history.flush()
+    history.record('air.hum', START + 30, 30.0)
+    history.flush()
+    assert history.query('air.hum', START, START + 60, '1m') == [(START, 10.0, 30.0, 20.0)]
+
+
+def test_prune_keeps_the_retention_of_each_tier(history):
+    history.record('air.temp', START, 1.0)
+    history.flush()
+    history.prune(START + 3 * 24 * 3600)
+    assert history.query('air.temp', START - 1, START + 1, 'raw') == []
+    assert history.query('air.temp', START - 1, START + 1, '1m') != []
+
+
+def test_failed_flush_keeps_the_samples_and_no_metric_ids(history):
+    history.db.execute("CREATE TRIGGER full BEFORE INSERT ON raw BEGIN SELECT RAISE(ABORT, 'disk full'); END")
+    history.record('air.temp', START, 20.0)
+    history.record('air.hum', START, 50.0)
+    with pytest.raises(sqlite3.DatabaseError):
+        history.flush()
+    assert history.metricids == {} #the inserts into metrics were rolled back
+    assert len(history.pending) == 2
+
+    history.db.execute('DROP TRIGGER full')
+    history.record('light.lux', START, 300.0)
+    assert history.flush() == 3
+    assert len(set(history.metricids.values())) == 3
+    assert history.last('air.temp') == (START, 20.0)
+    assert history.last('air.hum') == (START, 50.0)
+    assert history.last('light.lux') == (START, 300.0)
+
+
+def test_pending_samples_are_bounded_while_flushing_fails(history, monkeypatch):
+    def fail(batch):
+        raise sqlite3.OperationalError('database is locked')
+    monkeypatch.setattr(history, 'write', fail)
+    for i in range(MAXPENDING + 10):
+        history.pending.append(('air.temp', START + i, 1.0))
+    with pytest.raises(sqlite3.OperationalError):
+        history.flush()
+    assert len(history.pending) == MAXPENDING
+    assert history.pending[-1][1] == START + MAXPENDING + 9 #the newest are kept
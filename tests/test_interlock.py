@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+hydro_interlock: tripping, holdoff, minimum off time and shared pumps
+"""
+
+import pytest
+
+import hydro_interlock
+from hydro_interlock import Interlock, Rule
+
+PUMP = 15
+TANK = 16
+LEAK = 22
+
+
+class Gpio():
+    """the pins the interlock reads and the pump outputs it switches"""
+    def __init__(self):
+        self.levels = {TANK: 0, LEAK: 0}
+        self.pumps = {}
+
+
+    def input(self, pin):
+        return self.levels[pin]
+
+
+    def getpump(self, pin):
+        return self.pumps.get(pin, False)
+
+
+    def outputpump(self, pin, state):
+        self.pumps[pin] = state
+
+
+    def switch(self, pin, state):
+        '''what GpioInterface.setpump hands the interlock'''
+        self.outputpump(pin, state)
+
+
+class Clock():
+    def __init__(self, monkeypatch):
+        self.now = 1000.0
+        monkeypatch.setattr(hydro_interlock.time, 'monotonic', lambda: self.now)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    return Clock(monkeypatch)
+
+
+def setlevel(interlock, gpio, pin, level):
+    gpio.levels[pin] = level
+    return interlock.evaluate(pin, level)
+
+
+def test_trip_stops_the_pump_and_holdoff_releases_it(clock):
+    gpio = Gpio()
+    alarms = []
+    interlock = Interlock(gpio, [Rule('dryrun', 'dryrun', TANK, 1, (PUMP,), 10.0)])
+    interlock.addlistener(lambda rule, active: alarms.append((rule.name, active)))
+    assert interlock.request(PUMP, True, gpio.switch)
+    setlevel(interlock, gpio, TANK, 1)
+    assert gpio.pumps[PUMP] is False
+    assert not interlock.request(PUMP, True, gpio.switch) #refused, but remembered
+    assert setlevel(interlock, gpio, TANK, 0) == 10.0
+    clock.now += 9
+    interlock.runpending()
+    assert gpio.pumps[PUMP] is False
+    clock.now += 1
+    assert interlock.runpending() is None
+    assert gpio.pumps[PUMP] is True
+    assert alarms == [('dryrun', True), ('dryrun', False)]
+
+
+def test_input_back_within_holdoff_keeps_the_rule_latched(clock):
+    gpio = Gpio()
+    interlock = Interlock(gpio, [Rule('dryrun', 'dryrun', TANK, 1, (PUMP,), 10.0)])
+    setlevel(interlock, gpio, TANK, 1)
+    setlevel(interlock, gpio, TANK, 0)
+    clock.now += 5
+    setlevel(interlock, gpio, TANK, 1) #bouncing float switch
+    clock.now += 20
+    interlock.runpending()
+    assert [rule.name for rule in interlock.active()] == ['dryrun']
+
+
+def test_minoff_delays_the_release(clock):
+    gpio = Gpio()
+    interlock = Interlock(gpio, [Rule('dryrun', 'dryrun', TANK, 1, (PUMP,), 1.0)], minoff=30.0)
+    interlock.request(PUMP, True, gpio.switch)
+    setlevel(interlock, gpio, TANK, 1)
+    setlevel(interlock, gpio, TANK, 0)
+    clock.now += 2
+    assert interlock.runpending() == pytest.approx(28.0)
+    clock.now += 28
+    interlock.runpending()
+    assert gpio.pumps[PUMP] is True
+
+
+def test_pump_stays_off_while_another_rule_holds_it(clock):
+    gpio = Gpio()
+    interlock = Interlock(gpio, [Rule('dryrun', 'dryrun', TANK, 1, (PUMP,), 0.0),
+                                 Rule('leak', 'leak', LEAK, 1, (PUMP, 23), 0.0)])
+    interlock.request(PUMP, True, gpio.switch)
+    setlevel(interlock, gpio, TANK, 1)
+    setlevel(interlock, gpio, LEAK, 1)
+    setlevel(interlock, gpio, TANK, 0)
+    interlock.runpending()
+    assert gpio.pumps[PUMP] is False
+    assert [rule.name for rule in interlock.active()] == ['leak']
+    assert not interlock.allows(23)
+
+
+def test_tripped_at_start():
+    gpio = Gpio()
+    gpio.levels[LEAK] = 1
+    interlock = Interlock(gpio, [Rule('leak', 'leak', LEAK, 1, (PUMP,), 0.0)])
+    assert not interlock.request(PUMP, True, gpio.switch)
+
+
+def test_rule_names_are_unique():
+    rule = Rule('leak', 'leak', LEAK, 1, (PUMP,), 0.0)
+    with pytest.raises(ValueError):
+        Interlock(Gpio(), [rule, rule._replace(pin=TANK)])
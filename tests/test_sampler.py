@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+hydro_sampler: a revived sampler drops what the hung thread read
+"""
+
+import threading
+
+import hydro_sampler
+from hydro_sampler import Sampler
+
+
+def test_result_of_the_hung_read_is_dropped():
+    entered, release = threading.Event(), threading.Event()
+    reads = []
+
+    def read():
+        if not reads:
+            reads.append('hung')
+            entered.set()
+            release.wait(5)
+            return 99.0
+        reads.append('new')
+        return 1.0
+
+    sampler = Sampler()
+    sampler.addsource('probe', read, 60.0, ('value',))
+    samples, sampled = [], threading.Event()
+
+    def listener(name, fields, sample):
+        samples.append(sample.values)
+        sampled.set()
+
+    sampler.addlistener(listener)
+    sampler.start()
+    assert entered.wait(5)
+    sampler.revive()
+    assert sampled.wait(5) #the new thread reads while the old one still hangs
+    release.set()
+    sampler.join(5)
+    sampler.stop()
+    assert not sampler.is_alive()
+    assert samples and set(samples) == {(1.0,)}
+    assert set(sample.values for sample in sampler.window('probe')) == {(1.0,)}
+
+
+def test_a_late_source_waits_one_interval(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(hydro_sampler.time, 'monotonic', lambda: clock[0])
+    reads = []
+    sampler = Sampler()
+    sampler.addsource('probe', lambda: reads.append(clock[0]) or 1.0, 10.0, ('value',))
+    sampler.runpending()
+    clock[0] += 10.0
+    sampler.runpending() #on time, the cadence is kept
+    clock[0] += 25.0 #a slow i2c read or a stall
+    sampler.runpending()
+    assert sampler.runpending() == 10.0 #not right away again
+    assert reads == [1000.0, 1010.0, 1035.0]
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+hydro_scheduler: cycles, resuming from the state file
+"""
+
+import json
+
+import pytest
+
+import hydro_scheduler
+from hydro_scheduler import Scheduler
+
+
+class Clock():
+    """time.time and time.monotonic of hydro_scheduler"""
+    def __init__(self, monkeypatch):
+        self.wall = 1767225600.0
+        self.mono = 1000.0
+        monkeypatch.setattr(hydro_scheduler.time, 'time', lambda: self.wall)
+        monkeypatch.setattr(hydro_scheduler.time, 'monotonic', lambda: self.mono)
+
+
+    def advance(self, seconds):
+        self.wall += seconds
+        self.mono += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    return Clock(monkeypatch)
+
+
+def test_cycle_switches_at_the_deadlines(clock):
+    switches = []
+    scheduler = Scheduler()
+    scheduler.add('pump', 300, 600, switches.append)
+    assert switches == [True]
+    assert scheduler.runpending() == 300
+    clock.advance(300)
+    assert scheduler.runpending() == 600
+    assert switches == [True, False]
+    clock.advance(610) #late by 10 s, the next phase still starts at the deadline
+    scheduler.runpending()
+    assert switches == [True, False, True]
+    assert scheduler.remaining('pump') == 290
+
+
+def test_setdurations_changes_the_running_phase(clock):
+    scheduler = Scheduler()
+    scheduler.add('pump', 300, 600, lambda ison: None)
+    clock.advance(100)
+    scheduler.setdurations('pump', onseconds=120)
+    assert scheduler.remaining('pump') == 20
+
+
+def test_restart_resumes_the_phase(clock, tmp_path):
+    statefile = str(tmp_path / 'schedule.json')
+    Scheduler(statefile).add('pump', 300, 600, lambda ison: None)
+    clock.advance(100)
+    switches = []
+    scheduler = Scheduler(statefile)
+    scheduler.add('pump', 300, 600, switches.append)
+    assert switches == [True]
+    assert scheduler.remaining('pump') == 200
+
+
+def test_restart_skips_the_phases_missed_while_down(clock, tmp_path):
+    statefile = str(tmp_path / 'schedule.json')
+    Scheduler(statefile).add('pump', 300, 600, lambda ison: None)
+    clock.advance(300 + 600 + 50) #one cycle and 50 s of the next on phase
+    scheduler = Scheduler(statefile)
+    scheduler.add('pump', 300, 600, lambda ison: None)
+    assert scheduler.ison('pump')
+    assert scheduler.remaining('pump') == 250
+
+
+def test_durations_come_from_the_caller_not_the_state_file(clock, tmp_path):
+    statefile = str(tmp_path / 'schedule.json')
+    Scheduler(statefile).add('pump', 300, 600, lambda ison: None)
+    with open(statefile) as f:
+        state = json.load(f)
+    state['pump'].update(onseconds=3000, offseconds=6000) #written by older versions
+    with open(statefile, 'w') as f:
+        json.dump(state, f)
+    clock.advance(100)
+    scheduler = Scheduler(statefile)
+    schedule = scheduler.add('pump', 120, 900, lambda ison: None)
+    assert (schedule.onseconds, schedule.offseconds) == (120, 900)
+    assert scheduler.remaining('pump') == 120 #the 200 s left of the saved phase are cut to the new duration
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+hydro_spool: segment files, cursor, eviction and draining
+"""
+
+import os
+import time
+
+from hydro_spool import Spool, StoreAndForward, DROP_NEWEST
+
+
+class Result():
+    def __init__(self, rc):
+        self.rc = rc
+
+
+class Client():
+    """the part of the paho client StoreAndForward uses"""
+    def __init__(self, connected=True):
+        self.connected = connected
+        self.published = [] #(topic, payload, retain, properties)
+
+
+    def is_connected(self):
+        return self.connected
+
+
+    def publish(self, topic, payload=None, retain=False, properties=None):
+        self.published.append((topic, payload, retain, properties))
+        return Result(0)
+
+
+def test_messages_come_back_in_order_after_a_restart(tmp_path):
+    spool = Spool(str(tmp_path))
+    for i in range(5):
+        spool.append('a/%d' % i, 'value %d' % i, retain=i == 4, timestamp=1000.0 + i)
+    records = spool.peek(2)
+    spool.commit(records[-1][4])
+    spool.close()
+
+    spool = Spool(str(tmp_path))
+    records = spool.peek(10)
+    assert [(r[0], r[1], r[2], r[3]) for r in records] == [
+        (1002.0, 'a/2', b'value 2', False), (1003.0, 'a/3', b'value 3', False), (1004.0, 'a/4', b'value 4', True)]
+    spool.commit(records[-1][4])
+    assert spool.isempty()
+
+
+def test_torn_record_at_the_end_is_left_out(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append('a', 'complete')
+    spool.close()
+    segment = os.path.join(str(tmp_path), sorted(os.listdir(str(tmp_path)))[0])
+    with open(segment, 'ab') as f:
+        f.write(b'\x00' * 7)
+    assert [r[1] for r in Spool(str(tmp_path)).peek(10)] == ['a']
+
+
+def test_full_spool_drops_the_oldest_segment(tmp_path):
+    spool = Spool(str(tmp_path), segmentbytes=200, maxbytes=600)
+    for i in range(40):
+        assert spool.append('t', 'x' * 20, timestamp=float(i))
+    assert spool.totalbytes() <= 600
+    assert spool.evictedsegments > 0
+    timestamps = [r[0] for r in spool.peek(100)]
+    assert timestamps == sorted(timestamps) and timestamps[-1] == 39.0
+
+
+def test_full_spool_refuses_new_messages(tmp_path):
+    spool = Spool(str(tmp_path), segmentbytes=200, maxbytes=300, policy=DROP_NEWEST)
+    results = [spool.append('t', 'x' * 20) for _ in range(20)]
+    assert not all(results)
+    assert spool.dropped == results.count(False)
+
+
+def test_backlog_keeps_new_messages_behind_it(tmp_path):
+    client = Client(connected=False)
+    forwarder = StoreAndForward(client, Spool(str(tmp_path)))
+    forwarder.publish('t', '1')
+    client.connected = True
+    forwarder.publish('t', '2') #spooled, the backlog goes first
+    assert client.published == []
+    assert forwarder.drain() == 2
+    assert [payload for _, payload, _, _ in client.published] == [b'1', b'2']
+    forwarder.publish('t', '3')
+    assert client.published[-1][1] == '3'
+
+
+def test_stale_messages_are_dropped_but_retained_ones_sent(tmp_path):
+    client = Client()
+    spool = Spool(str(tmp_path))
+    old = time.time() - 7200
+    spool.append('value', 'old', timestamp=old)
+    spool.append('state', 'old', retain=True, timestamp=old)
+    spool.append('value', 'new')
+    forwarder = StoreAndForward(client, spool, maxage=3600)
+    assert forwarder.drain() == 2
+    assert [(topic, payload) for topic, payload, _, _ in client.published] == [('state', b'old'), ('value', b'new')]
+    assert spool.isempty()
+
+
+def test_timestamps_go_along_as_user_property(tmp_path):
+    client = Client()
+    spool = Spool(str(tmp_path))
+    spool.append('value', 'old', timestamp=1000.5)
+    forwarder = StoreAndForward(client, spool, timestamps=True, maxage=3600)
+    assert forwarder.drain() == 1
+    properties = client.published[0][3]
+    assert properties.UserProperty == [('ts', '1000.500')]
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+hydro_trace: records and the gpio levels at the start of a file
+"""
+
+import time
+
+from hydro_trace import TraceRecorder, TraceReader, gpiolevels
+
+
+def test_every_file_starts_with_the_watched_levels(tmp_path):
+    recorder = TraceRecorder(str(tmp_path))
+    levels = {16: 1, 18: 0}
+    recorder.watch(lambda: dict(levels))
+    recorder.gpio(16, 0)
+    levels[16] = 0
+    recorder.pump(15, True)
+    with recorder.lock:
+        recorder.open(time.time() + 1) #as at midnight
+    recorder.command('iot/Hydroponic/setpumpon', b'0')
+    recorder.close()
+
+    first, second = sorted(str(path) for path in tmp_path.iterdir())
+    with TraceReader(first) as reader:
+        assert [(pin, level) for _, pin, level in gpiolevels(reader)] == [(16, 1), (18, 0), (16, 0)]
+    with TraceReader(second) as reader:
+        records = list(reader)
+    assert [(pin, level) for _, pin, level in gpiolevels(records)] == [(16, 0), (18, 0)]
+    assert records[-1].data == b'iot/Hydroponic/setpumpon\x000'
+
+
+def test_watch_writes_the_levels_into_an_open_file(tmp_path):
+    recorder = TraceRecorder(str(tmp_path))
+    recorder.pump(15, False)
+    recorder.watch(lambda: {16: 1})
+    recorder.close()
+    with TraceReader(recorder.path) as reader:
+        assert [(pin, level) for _, pin, level in gpiolevels(reader)] == [(16, 1)]
+
+
+def test_records_are_dropped_when_the_file_cannot_be_opened(tmp_path):
+    directory = tmp_path / 'trace'
+    recorder = TraceRecorder(str(directory))
+    directory.rmdir() #as if the card was unmounted
+    recorder.pump(15, True)
+    recorder.gpio(16, 1)
+    assert recorder.file is None and recorder.records == 0
+    directory.mkdir()
+    recorder.retryat = 0.0
+    recorder.pump(15, False)
+    recorder.close()
+    with TraceReader(recorder.path) as reader:
+        assert [(record.addr, record.aux) for record in reader] == [(15, 0)]